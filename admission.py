@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+准入控制模块
+限制同时向上游扇出的请求数，超出的请求进入按租户加权公平调度的有界等待队列；
+交互通道的请求总是排在批量通道之前，批量请求最多占用一部分名额；
+队列已满或排队超时的请求立即以429拒绝，而不是让所有请求一起超时
+"""
+
+import asyncio
+import heapq
+import inspect
+import itertools
+import logging
+import math
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from key_scheduler import MAX_RETRY_AFTER
+from priority_lanes import LANE_BATCH, LANE_INTERACTIVE, LANES
+
+logger = logging.getLogger(__name__)
+
+
+class AdmissionRejected(Exception):
+    """请求未获准入"""
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionSlot:
+    """一个已获准入的请求占用的名额，release可以重复调用"""
+
+    __slots__ = ("_controller", "_admitted_at", "_released", "lane")
+
+    def __init__(self, controller: "AdmissionController", lane: str):
+        self._controller = controller
+        self._admitted_at = time.monotonic()
+        self._released = False
+        self.lane = lane
+
+    def release(self):
+        if self._released:
+            return
+        self._released = True
+        self._controller._release(self.lane, time.monotonic() - self._admitted_at)
+
+
+class AdmissionController:
+    """
+    全局并发上限加有界的加权公平等待队列。
+
+    每个排队请求按所属租户的权重获得一个虚拟完成时间标签（WFQ），名额释放时
+    交给标签最小的请求，持续发送大量请求的租户不会让其他租户一直排在后面；
+    每个租户最多占用与其权重比例相当的队列长度。
+
+    交互通道的等待者总是先于批量通道获得名额；批量请求同时最多占用
+    batch_share比例的名额，排队时间上限为batch_max_queue_time。
+    """
+
+    def __init__(self, max_concurrent: int, max_queue: int, max_queue_time: float,
+                 batch_share: float = 1.0, batch_max_queue_time: Optional[float] = None):
+        # max_concurrent为0表示不限制
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_queue_time = max_queue_time
+        self.batch_share = batch_share
+        self.batch_max_queue_time = max_queue_time if batch_max_queue_time is None else batch_max_queue_time
+        self.active = 0
+        self.active_by_lane: Dict[str, int] = {lane: 0 for lane in LANES}
+        # (通道顺序, 虚拟完成时间, 序号, future, 租户, 通道)
+        self._waiters: List[tuple] = []
+        self._queued_by_tenant: Dict[str, int] = {}
+        self._last_tag: Dict[str, float] = {}
+        self._virtual_time = 0.0
+        self._sequence = itertools.count()
+        # 每个请求占用名额的平均时长（指数加权移动平均），用于估算排队时间
+        self.service_time = 5.0
+        self.admitted = 0
+        self.queued_total = 0
+        self.rejected_queue_full = 0
+        self.rejected_timeout = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_concurrent > 0
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    @property
+    def batch_limit(self) -> int:
+        """批量通道同时可占用的名额数"""
+        return max(1, math.floor(self.max_concurrent * self.batch_share))
+
+    def _can_admit(self, lane: str) -> bool:
+        if self.active >= self.max_concurrent:
+            return False
+        return lane != LANE_BATCH or self.active_by_lane[LANE_BATCH] < self.batch_limit
+
+    def _admit(self, lane: str) -> AdmissionSlot:
+        self.active += 1
+        self.active_by_lane[lane] += 1
+        self.admitted += 1
+        return AdmissionSlot(self, lane)
+
+    def estimated_wait(self) -> float:
+        """按当前排队长度和平均占用时长估算新请求需要等待的秒数"""
+        if not self.enabled:
+            return 0.0
+        return self.service_time * (self.queued + 1) / self.max_concurrent
+
+    async def acquire(self, tenant: str = "default", weight: float = 1.0, share: float = 1.0,
+                      lane: str = LANE_INTERACTIVE) -> AdmissionSlot:
+        """
+        获取一个名额；队列已满或排队超时时抛出AdmissionRejected。
+
+        Args:
+            tenant: 请求所属租户
+            weight: 租户调度权重
+            share: 租户权重占全部租户的比例，决定该租户最多可占用的队列长度
+            lane: 优先级通道，interactive不需要等待排队中的batch请求
+        """
+        if not self.enabled:
+            return self._admit(lane)
+        # 交互请求只需让位于排队中的交互请求，批量请求需要让位于所有排队请求
+        ahead = [entry for entry in self._waiters if lane == LANE_BATCH or entry[5] == LANE_INTERACTIVE]
+        if not ahead and self._can_admit(lane):
+            return self._admit(lane)
+
+        tenant_queue_limit = max(1, math.ceil(self.max_queue * share))
+        queued_for_tenant = self._queued_by_tenant.get(tenant, 0)
+        if len(self._waiters) >= self.max_queue or queued_for_tenant >= tenant_queue_limit:
+            self.rejected_queue_full += 1
+            raise AdmissionRejected("queue_full", self.estimated_wait())
+
+        tag = max(self._virtual_time, self._last_tag.get(tenant, 0.0)) + 1.0 / weight
+        self._last_tag[tenant] = tag
+        waiter = asyncio.get_running_loop().create_future()
+        lane_order = 1 if lane == LANE_BATCH else 0
+        heapq.heappush(self._waiters, (lane_order, tag, next(self._sequence), waiter, tenant, lane))
+        self._queued_by_tenant[tenant] = queued_for_tenant + 1
+        self.queued_total += 1
+        max_queue_time = self.batch_max_queue_time if lane == LANE_BATCH else self.max_queue_time
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), max_queue_time)
+        except asyncio.TimeoutError:
+            self._abandon(waiter, lane)
+            self.rejected_timeout += 1
+            raise AdmissionRejected("queue_timeout", self.estimated_wait())
+        except BaseException:
+            self._abandon(waiter, lane)
+            raise
+        self.admitted += 1
+        return AdmissionSlot(self, lane)
+
+    def _dequeued(self, tenant: str):
+        remaining = self._queued_by_tenant.get(tenant, 1) - 1
+        if remaining > 0:
+            self._queued_by_tenant[tenant] = remaining
+        else:
+            self._queued_by_tenant.pop(tenant, None)
+
+    def _abandon(self, waiter: asyncio.Future, lane: str):
+        """放弃排队；若名额已经分配给该等待者，则归还并转交给下一个"""
+        if waiter.done() and not waiter.cancelled():
+            self._release(lane, None)
+            return
+        waiter.cancel()
+        for index, entry in enumerate(self._waiters):
+            if entry[3] is waiter:
+                self._waiters.pop(index)
+                heapq.heapify(self._waiters)
+                self._dequeued(entry[4])
+                break
+        # 排在前面的批量请求离开后，后面的请求可能已经可以获得名额
+        self._dispatch()
+
+    def _release(self, lane: str, held: Optional[float]):
+        if held is not None:
+            self.service_time = 0.8 * self.service_time + 0.2 * held
+        self.active = max(0, self.active - 1)
+        self.active_by_lane[lane] = max(0, self.active_by_lane[lane] - 1)
+        self._dispatch()
+
+    def _dispatch(self):
+        """按通道和虚拟完成时间顺序把空闲名额分配给等待者"""
+        while self._waiters:
+            _, tag, _, waiter, tenant, lane = self._waiters[0]
+            if waiter.done():
+                heapq.heappop(self._waiters)
+                self._dequeued(tenant)
+                continue
+            # 队首是批量请求时说明没有交互请求在排队；批量名额已满时继续等待
+            if not self._can_admit(lane):
+                return
+            heapq.heappop(self._waiters)
+            self._dequeued(tenant)
+            self._virtual_time = tag
+            self.active += 1
+            self.active_by_lane[lane] += 1
+            waiter.set_result(None)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "active": self.active,
+            "queued": self.queued,
+            "queued_by_tenant": dict(self._queued_by_tenant),
+            "active_by_lane": dict(self.active_by_lane),
+            "queued_by_lane": {lane: sum(1 for entry in self._waiters if entry[5] == lane) for lane in LANES},
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "queued_total": self.queued_total,
+            "rejected_queue_full": self.rejected_queue_full,
+            "rejected_timeout": self.rejected_timeout,
+            "avg_service_time": round(self.service_time, 3),
+        }
+
+
+def per_worker_limit(limit: int, workers: int) -> int:
+    """
+    把实例的并发数或队列长度上限平分给各工作进程（向上取整，至少为1）。
+    准入控制的状态只在进程内，多工作进程时按此拆分，使整个实例合计不超过配置的上限；0（不限制）保持为0。
+    """
+    if limit <= 0 or workers <= 1:
+        return limit
+    return max(1, math.ceil(limit / workers))
+
+
+def rate_limit_headers(capacity: Dict[str, Dict[str, float]], retry_after: float) -> Dict[str, str]:
+    """按密钥池的额度生成Retry-After和OpenAI风格的x-ratelimit-*响应头"""
+    # 非有限值（例如没有可用密钥时的无穷大）不能取整
+    if not math.isfinite(retry_after):
+        retry_after = MAX_RETRY_AFTER
+    headers = {"Retry-After": str(max(1, math.ceil(retry_after)))}
+    for name, values in capacity.items():
+        headers[f"x-ratelimit-limit-{name}"] = str(int(values["limit"]))
+        headers[f"x-ratelimit-remaining-{name}"] = str(int(values["remaining"]))
+        headers[f"x-ratelimit-reset-{name}"] = f"{values['reset']:.1f}s"
+    return headers
+
+
+# 响应类 -> 在__call__结束时执行release的子类
+_guarded_response_classes: Dict[type, type] = {}
+
+
+async def _run_releases(response: Any):
+    """关闭响应体并按注册的逆序执行release，每个只执行一次"""
+    close = getattr(response.body_iterator, "aclose", None)
+    if close is not None:
+        try:
+            await close()
+        except Exception as e:
+            logger.error(f"关闭流式响应体失败: {e}")
+    releases = response.__dict__["_releases"]
+    while releases:
+        release = releases.pop()
+        try:
+            result = release()
+            if inspect.isawaitable(result):
+                await result
+        except Exception as e:
+            logger.error(f"释放流式响应占用的资源失败: {e}")
+
+
+def _guarded_response_class(cls: type) -> type:
+    guarded = _guarded_response_classes.get(cls)
+    if guarded is None:
+        async def __call__(self, scope, receive, send):
+            try:
+                await cls.__call__(self, scope, receive, send)
+            finally:
+                await _run_releases(self)
+
+        guarded = _guarded_response_classes[cls] = type(cls.__name__, (cls,), {"__call__": __call__})
+    return guarded
+
+
+def release_after_body(response: Any, release: Callable[[], Any]):
+    """
+    流式响应发送完毕后再释放名额。
+
+    release在响应的__call__结束时执行，无论响应体是否发送完毕、客户端是否在响应开始前就断开、
+    发送是否出错，每个release都只执行一次；release可以是普通函数或协程函数。
+    """
+    releases = response.__dict__.get("_releases")
+    if releases is None:
+        releases = response.__dict__["_releases"] = []
+        # ASGI服务器按类型查找__call__，替换为带try/finally的子类（isinstance判断不受影响）
+        response.__class__ = _guarded_response_class(type(response))
+    releases.append(release)
@@ -6,11 +6,13 @@ LLM代理服务 - Web版
 """
 
 import asyncio
+import itertools
 import httpx
 import os
 import sys
 import json
 import time
+import math
 import logging
 import configparser
 import threading
@@ -20,7 +22,8 @@ import socket
 import subprocess
 import webbrowser
 from pathlib import Path
-from typing import List, Dict, Any
+from contextlib import asynccontextmanager
+from typing import Iterator, List, Dict, Any, Optional
 
 # 尝试导入Flask相关模块
 try:
@@ -31,16 +34,44 @@ try:
 except ImportError:
     FLASK_AVAILABLE = False
 
-# 尝试导入FastAPI和Pydantic（用于API代理服务）
+# 尝试导入FastAPI（用于API代理服务）
 try:
     from fastapi import FastAPI, Request, HTTPException
-    from fastapi.responses import JSONResponse, StreamingResponse
+    from fastapi.responses import Response, StreamingResponse
     from fastapi.middleware.cors import CORSMiddleware
-    from pydantic import BaseModel
+    from json_codec import FastJSONResponse
     FASTAPI_AVAILABLE = True
 except ImportError:
     FASTAPI_AVAILABLE = False
 
+# 尝试导入h2（用于上游HTTP/2多路复用，可选）
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+from key_scheduler import KeyScheduler, build_key_pool, estimate_request_tokens, parse_retry_after
+from fanout_engine import (ClientDisconnected, LatencyTracker, cancel_on_disconnect, fanout_stats,
+                           resolve_hedge_delay, run_fanout)
+from selection_policy import SelectionPolicy, has_structured_output, resolve_selection_policy, response_content
+from response_cache import (CACHE_STATUS_HEADER, cache_directives, canonical_request_key,
+                            create_response_cache, is_cacheable_request)
+from single_flight import SINGLE_FLIGHT_HEADER, SingleFlight
+from admission import AdmissionController, AdmissionRejected, rate_limit_headers, release_after_body
+from tenants import TenantQuotaExceeded, build_tenant_registry
+from priority_lanes import LANE_BATCH, LANE_INTERACTIVE, resolve_lane
+from upstream_router import UpstreamRouter, UpstreamTarget, build_upstreams
+from upstream_stream import build_upstream_payload, race_upstream_streams
+from connection_warmup import ConnectionWarmer
+from json_codec import ChunkEnvelope, DecodeError, backend_name, loads, set_backend
+from stream_pacing import paced_events, resolve_pacing
+from request_ingest import InvalidChatRequest, OutboundPayload, parse_chat_request, payload_stats
+from config_snapshot import ConfigSnapshot, file_stamp, watch_config
+from key_ledger import create_key_ledger
+from proxy_metrics import (CONTENT_TYPE as METRICS_CONTENT_TYPE, collect_admission_metrics, collect_key_metrics,
+                           gauge, proxy_metrics)
+
 # ==================== 辅助函数 ====================
 def get_resource_path(relative_path: str) -> str:
     """获取资源的绝对路径，兼容开发环境和PyInstaller打包环境"""
@@ -59,12 +90,18 @@ class ConfigManager:
     def __init__(self, config_file: str = "config.ini"):
         self.config_file = get_resource_path(config_file)
         self.config = configparser.ConfigParser()
+        # 请求处理读取的只读配置快照，每次加载或保存配置时整体替换
+        self.snapshot: Optional[ConfigSnapshot] = None
+        self._version = 0
+        self._stamp = None
+        self._lock = threading.RLock()
         self.load_config()
     
     def load_config(self):
         """加载配置文件"""
         if os.path.exists(self.config_file):
             self.config.read(self.config_file, encoding='utf-8')
+            self.publish()
         else:
             self.create_default_config()
     
@@ -95,8 +132,167 @@ class ConfigManager:
             ])
         }
         
+        # protocol为openai时使用OpenAI兼容接口，为gemini时直接调用原生generateContent接口
         self.config['API'] = {
-            'base_url': 'https://generativelanguage.googleapis.com/v1beta'
+            'base_url': 'https://generativelanguage.googleapis.com/v1beta',
+            'protocol': 'openai'
+        }
+        
+        self.config['UPSTREAM'] = {
+            'max_connections': '100',
+            'max_keepalive_connections': '20',
+            'keepalive_expiry': '30',
+            'http2': 'false'
+        }
+        
+        self.config['STREAM'] = {
+            'mode': 'passthrough'
+        }
+        
+        self.config['FANOUT'] = {
+            'mode': 'all',
+            'hedge_delay': 'auto',
+            'hedge_percentile': '90',
+            'hedge_delay_initial': '5',
+            'hedge_delay_min': '0.5',
+            'hedge_delay_max': '30'
+        }
+        
+        self.config['SCHEDULER'] = {
+            'rpm': '0',
+            'tpm': '0',
+            'rpd': '0',
+            'max_in_flight': '0',
+            'fanout_width': 'auto',
+            'overrides': '{}'
+        }
+        
+        self.config['BREAKER'] = {
+            'cooldown_base': '5',
+            'cooldown_max': '300',
+            'quarantine_invalid': 'true'
+        }
+        
+        self.config['SELECTION'] = {
+            'policy': 'first_valid',
+            'deadline': '15',
+            'best_of': '0',
+            'fallback_short': 'true',
+            'scorer': 'length'
+        }
+        
+        self.config['CACHE'] = {
+            'enabled': 'true',
+            'deterministic_only': 'true',
+            'ttl': '3600',
+            'max_entries': '1000',
+            'max_bytes': '67108864',
+            'max_entry_bytes': '1048576',
+            'disk_path': '',
+            'disk_max_entries': '10000'
+        }
+        
+        self.config['COALESCE'] = {
+            'enabled': 'true',
+            'follower_timeout': '120'
+        }
+        
+        self.config['ADMISSION'] = {
+            'max_concurrent': '64',
+            'max_queue': '128',
+            'max_queue_time': '10'
+        }
+        
+        # 每个租户一行: 租户名 = {"key": "客户端密钥", "weight": 1, "rpm": 0, "tpm": 0, "rpd": 0, "priority": "interactive"}
+        self.config['TENANTS'] = {}
+        
+        self.config['PRIORITY'] = {
+            'default_lane': 'interactive',
+            'batch_reserve': '0.2',
+            'batch_share': '0.5',
+            'batch_fanout_width': '1',
+            'batch_max_queue_time': '60'
+        }
+        
+        # 每个上游一行: 名称 = {"base_url": "https://...", "keys": ["..."], "path": "/openai/chat/completions",
+        #                       "protocol": "gemini", "thinking_budget": 1024}
+        # 不配置时使用[API]中的base_url；某个上游不写keys时使用主密钥池，不写protocol时使用[API]的protocol
+        self.config['UPSTREAMS'] = {}
+        
+        self.config['ROUTING'] = {
+            'ewma_alpha': '0.2',
+            'error_penalty': '4',
+            'failover_error_rate': '0.5',
+            'probe_interval': '30'
+        }
+        
+        # 原生Gemini接口的默认参数，客户端可以在请求体中用thinking_budget、reasoning_effort、
+        # include_thoughts、safety_settings按请求覆盖
+        self.config['GEMINI'] = {
+            'thinking_budget': '',
+            'include_thoughts': 'false',
+            'safety_threshold': ''
+        }
+        
+        self.config['WARMUP'] = {
+            'enabled': 'true',
+            'connections': '2',
+            'idle_rewarm': '25',
+            'dns_ttl': '300',
+            'timeout': '10',
+            'method': 'HEAD',
+            'path': '/'
+        }
+        
+        # 伪流式节奏: slices平均切分为slices段，段间等待frame_delay秒；instant一次性发送；
+        # fixed每帧frame_bytes字节，帧间等待frame_delay秒；
+        # rate按tokens_per_second的速率每frame_interval秒发送一帧，总时长不超过max_duration秒
+        self.config['PACING'] = {
+            'mode': 'slices',
+            'slices': '50',
+            'frame_bytes': '256',
+            'frame_delay': '0.01',
+            'tokens_per_second': '100',
+            'frame_interval': '0.05',
+            'max_duration': '2',
+            'coalesce_bytes': '4096'
+        }
+        
+        # JSON编解码后端: auto时优先使用orjson，其次msgspec，都未安装时使用标准库json
+        self.config['JSON'] = {
+            'backend': 'auto'
+        }
+        
+        # 配置热加载: 每隔watch_interval秒检查配置文件的修改时间，变化时重新加载（0为不检查）
+        self.config['RELOAD'] = {
+            'watch_interval': '2'
+        }
+        
+        # 管理接口: token为空时使用服务器的api_key；平滑关闭时最多等待drain_timeout秒
+        self.config['ADMIN'] = {
+            'token': '',
+            'drain_timeout': '30'
+        }
+        
+        # 多工作进程: count个uvicorn工作进程共用端口，count大于1时通过state_path的SQLite账本
+        # 每隔sync_interval秒交换密钥用量、并发数、熔断状态和租户额度的用量；
+        # [ADMISSION]的max_concurrent和max_queue是整个实例的上限，按count平分给各工作进程
+        self.config['WORKERS'] = {
+            'count': '1',
+            'state_path': 'key_state.db',
+            'sync_interval': '0.5'
+        }
+        
+        # 集群模式: 多个代理实例（例如服务器和几台Termux手机）共用同一组密钥时，
+        # 通过支持Redis协议的服务器共享密钥用量、冷却、隔离状态和租户额度；服务器不可用时各实例独立运行。
+        # 准入控制（[ADMISSION]）保护的是单个实例，每个实例各自按自己的上限执行
+        self.config['CLUSTER'] = {
+            'enabled': 'false',
+            'backend_url': 'redis://127.0.0.1:6379/0',
+            'key_prefix': 'llm_proxy',
+            'instance': '',
+            'sync_interval': '1',
+            'timeout': '2'
         }
         
         self.save_config()
@@ -110,6 +306,36 @@ class ConfigManager:
         except Exception as e:
             logger.error(f"保存配置失败: {e}")
             raise
+        self.publish()
+    
+    def publish(self):
+        """按当前配置生成新的只读快照并整体替换；请求处理只读取快照，不再解析配置"""
+        with self._lock:
+            self._stamp = file_stamp(self.config_file)
+            self._version += 1
+            self.snapshot = ConfigSnapshot(self, self._version)
+    
+    def reload_if_changed(self, force: bool = False) -> bool:
+        """
+        配置文件的修改时间或大小变化（force为True时无论是否变化）时重新加载并替换快照，返回是否重新加载。
+        新配置无法解析时保留原来的配置和快照，直到文件再次变化。
+        """
+        with self._lock:
+            stamp = file_stamp(self.config_file)
+            if stamp is None or (stamp == self._stamp and not force):
+                return False
+            previous = self.config
+            self.config = configparser.ConfigParser()
+            try:
+                self.config.read(self.config_file, encoding='utf-8')
+                self.publish()
+            except Exception as e:
+                self.config = previous
+                self._stamp = stamp
+                logger.error(f"重新加载配置文件失败，继续使用原配置: {e}")
+                return False
+            logger.info(f"已重新加载配置文件 (版本 {self._version})")
+            return True
     
     def get_server_config(self) -> Dict[str, Any]:
         """获取服务器配置"""
@@ -157,6 +383,286 @@ class ConfigManager:
         """设置基础URL"""
         self.config['API']['base_url'] = base_url
         self.save_config()
+    
+    def get_api_protocol(self) -> str:
+        """获取上游协议：openai（OpenAI兼容接口）或gemini（原生generateContent接口）"""
+        return self.config.get('API', 'protocol', fallback='openai').strip().lower() or 'openai'
+    
+    def get_upstream_config(self) -> Dict[str, Any]:
+        """获取上游连接池配置（旧配置文件缺少该节时使用默认值）"""
+        return {
+            'max_connections': self.config.getint('UPSTREAM', 'max_connections', fallback=100),
+            'max_keepalive_connections': self.config.getint('UPSTREAM', 'max_keepalive_connections', fallback=20),
+            'keepalive_expiry': self.config.getfloat('UPSTREAM', 'keepalive_expiry', fallback=30.0),
+            'http2': self.config.getboolean('UPSTREAM', 'http2', fallback=False)
+        }
+    
+    def get_stream_mode(self) -> str:
+        """获取流式模式: passthrough(真流式转发) 或 fake(完整响应后伪流式)"""
+        mode = self.config.get('STREAM', 'mode', fallback='passthrough').strip().lower()
+        return mode if mode in ('passthrough', 'fake') else 'passthrough'
+    
+    def get_scheduler_config(self) -> Dict[str, Any]:
+        """
+        获取密钥调度配置
+        
+        rpm/tpm/rpd/max_in_flight为每个密钥的限额，0表示不限制；
+        overrides为按完整密钥或末4位覆盖限额的JSON；
+        fanout_width为每个请求最多使用的密钥数，auto表示密钥池的一半。
+        """
+        fanout_width = self.config.get('SCHEDULER', 'fanout_width', fallback='auto').strip().lower()
+        return {
+            'limits': {
+                'rpm': self.config.getint('SCHEDULER', 'rpm', fallback=0),
+                'tpm': self.config.getint('SCHEDULER', 'tpm', fallback=0),
+                'rpd': self.config.getint('SCHEDULER', 'rpd', fallback=0),
+                'max_in_flight': self.config.getint('SCHEDULER', 'max_in_flight', fallback=0)
+            },
+            'overrides': json.loads(self.config.get('SCHEDULER', 'overrides', fallback='{}')),
+            'fanout_width': None if fanout_width == 'auto' else int(fanout_width)
+        }
+    
+    def get_fanout_config(self) -> Dict[str, Any]:
+        """
+        获取扇出配置
+        
+        mode为all时一次性请求整组密钥；为hedge时先请求一个密钥，
+        超过hedge_delay秒仍无可用结果再逐个追加。hedge_delay为auto时按观测延迟的百分位推算。
+        """
+        mode = self.config.get('FANOUT', 'mode', fallback='all').strip().lower()
+        hedge_delay = self.config.get('FANOUT', 'hedge_delay', fallback='auto').strip().lower()
+        return {
+            'mode': mode if mode in ('all', 'hedge') else 'all',
+            'hedge_delay': None if hedge_delay == 'auto' else float(hedge_delay),
+            'hedge_percentile': self.config.getfloat('FANOUT', 'hedge_percentile', fallback=90.0),
+            'hedge_delay_initial': self.config.getfloat('FANOUT', 'hedge_delay_initial', fallback=5.0),
+            'hedge_delay_min': self.config.getfloat('FANOUT', 'hedge_delay_min', fallback=0.5),
+            'hedge_delay_max': self.config.getfloat('FANOUT', 'hedge_delay_max', fallback=30.0)
+        }
+    
+    def get_breaker_config(self) -> Dict[str, Any]:
+        """
+        获取密钥熔断配置
+        
+        429和5xx错误后密钥冷却cooldown_base秒，连续失败时冷却时间翻倍，最长cooldown_max秒；
+        quarantine_invalid为true时，无效密钥（401/403/API_KEY_INVALID）被永久隔离。
+        """
+        return {
+            'cooldown_base': self.config.getfloat('BREAKER', 'cooldown_base', fallback=5.0),
+            'cooldown_max': self.config.getfloat('BREAKER', 'cooldown_max', fallback=300.0),
+            'quarantine_invalid': self.config.getboolean('BREAKER', 'quarantine_invalid', fallback=True)
+        }
+    
+    def get_selection_config(self) -> Dict[str, Any]:
+        """
+        获取响应选择配置
+        
+        policy为first_valid时返回第一个满足最小长度的响应；为best_of时在deadline秒内
+        收集最多best_of个（0为不限）满足条件的响应，按scorer评分选出最佳；
+        fallback_short为true时，没有满足条件的响应则返回评分最高的过短响应而不是503。
+        """
+        policy = self.config.get('SELECTION', 'policy', fallback='first_valid').strip().lower()
+        return {
+            'policy': policy if policy in ('first_valid', 'best_of') else 'first_valid',
+            'deadline': self.config.getfloat('SELECTION', 'deadline', fallback=15.0),
+            'best_of': self.config.getint('SELECTION', 'best_of', fallback=0),
+            'fallback_short': self.config.getboolean('SELECTION', 'fallback_short', fallback=True),
+            'scorer': self.config.get('SELECTION', 'scorer', fallback='length').strip()
+        }
+    
+    def get_cache_config(self) -> Dict[str, Any]:
+        """
+        获取响应缓存配置
+        
+        deterministic_only为true时只缓存temperature为0的请求；
+        max_bytes/max_entry_bytes限制内存层的总字节数和单条大小；
+        disk_path不为空时启用SQLite磁盘层，重启后缓存仍然有效。
+        """
+        return {
+            'enabled': self.config.getboolean('CACHE', 'enabled', fallback=True),
+            'deterministic_only': self.config.getboolean('CACHE', 'deterministic_only', fallback=True),
+            'ttl': self.config.getfloat('CACHE', 'ttl', fallback=3600.0),
+            'max_entries': self.config.getint('CACHE', 'max_entries', fallback=1000),
+            'max_bytes': self.config.getint('CACHE', 'max_bytes', fallback=64 * 1024 * 1024),
+            'max_entry_bytes': self.config.getint('CACHE', 'max_entry_bytes', fallback=1024 * 1024),
+            'disk_path': self.config.get('CACHE', 'disk_path', fallback='').strip(),
+            'disk_max_entries': self.config.getint('CACHE', 'disk_max_entries', fallback=10000)
+        }
+    
+    def get_coalesce_config(self) -> Dict[str, Any]:
+        """
+        获取请求合并配置
+        
+        enabled为true时，同时到达的相同请求只向上游扇出一次并共享结果；
+        follower_timeout为等待共享结果的最长秒数，超时后单独发起请求。
+        """
+        return {
+            'enabled': self.config.getboolean('COALESCE', 'enabled', fallback=True),
+            'follower_timeout': self.config.getfloat('COALESCE', 'follower_timeout', fallback=120.0)
+        }
+    
+    def get_admission_config(self) -> Dict[str, Any]:
+        """
+        获取准入控制配置
+        
+        max_concurrent为同时向上游扇出的请求上限（0表示不限制）；超出的请求最多
+        max_queue个排队等待，排队超过max_queue_time秒或队列已满时返回429。
+        """
+        return {
+            'max_concurrent': self.config.getint('ADMISSION', 'max_concurrent', fallback=64),
+            'max_queue': self.config.getint('ADMISSION', 'max_queue', fallback=128),
+            'max_queue_time': self.config.getfloat('ADMISSION', 'max_queue_time', fallback=10.0)
+        }
+    
+    def get_tenants_config(self) -> Dict[str, Dict[str, Any]]:
+        """
+        获取租户配置
+        
+        [TENANTS]中每一项为租户名和JSON：key为客户端密钥，weight为排队时的调度权重，
+        rpm/tpm/rpd为该租户的额度（0表示不限制），priority为该租户请求默认使用的通道。服务器的api_key始终作为default租户可用。
+        """
+        if not self.config.has_section('TENANTS'):
+            return {}
+        return {name: json.loads(value) for name, value in self.config.items('TENANTS')}
+    
+    def get_priority_config(self) -> Dict[str, Any]:
+        """
+        获取优先级通道配置
+        
+        default_lane为没有通过请求头或租户指定优先级时使用的通道（interactive或batch）。
+        batch请求不能占用每个密钥最后batch_reserve比例的额度，最多占用batch_share比例的
+        准入名额，每次最多使用batch_fanout_width个密钥（0表示与交互请求相同），
+        排队最多等待batch_max_queue_time秒。
+        """
+        default_lane = self.config.get('PRIORITY', 'default_lane', fallback='interactive').strip().lower()
+        return {
+            'default_lane': default_lane if default_lane in ('interactive', 'batch') else 'interactive',
+            'batch_reserve': min(1.0, max(0.0, self.config.getfloat('PRIORITY', 'batch_reserve', fallback=0.2))),
+            'batch_share': min(1.0, max(0.0, self.config.getfloat('PRIORITY', 'batch_share', fallback=0.5))),
+            'batch_fanout_width': self.config.getint('PRIORITY', 'batch_fanout_width', fallback=1),
+            'batch_max_queue_time': self.config.getfloat('PRIORITY', 'batch_max_queue_time', fallback=60.0)
+        }
+    
+    def get_upstreams_config(self) -> Dict[str, Dict[str, Any]]:
+        """
+        获取多上游配置
+        
+        [UPSTREAMS]中每一项为上游名称和JSON：base_url为上游接口的地址，keys为该上游的
+        密钥池（省略时使用主密钥池），path为OpenAI兼容聊天接口的路径，protocol为openai或gemini，
+        thinking_budget、include_thoughts、safety_threshold覆盖[GEMINI]中的默认值。
+        没有配置时只使用[API]中的base_url。
+        """
+        if not self.config.has_section('UPSTREAMS'):
+            return {}
+        return {name: json.loads(value) for name, value in self.config.items('UPSTREAMS')}
+    
+    def get_routing_config(self) -> Dict[str, Any]:
+        """
+        获取上游路由配置
+        
+        ewma_alpha为首字节耗时和错误率移动平均的权重；排序分数为首字节耗时乘以
+        (1 + error_penalty × 错误率)，错误率达到failover_error_rate的上游排在健康上游之后；
+        超过probe_interval秒没有样本的上游会收到一个探测请求。
+        """
+        return {
+            'ewma_alpha': min(1.0, max(0.01, self.config.getfloat('ROUTING', 'ewma_alpha', fallback=0.2))),
+            'error_penalty': self.config.getfloat('ROUTING', 'error_penalty', fallback=4.0),
+            'failover_error_rate': self.config.getfloat('ROUTING', 'failover_error_rate', fallback=0.5),
+            'probe_interval': self.config.getfloat('ROUTING', 'probe_interval', fallback=30.0)
+        }
+    
+    def get_gemini_config(self) -> Dict[str, Any]:
+        """
+        获取原生Gemini接口的默认参数
+        
+        thinking_budget为思考预算（token数），留空时使用模型的默认值；include_thoughts为true时
+        以reasoning_content返回思考摘要；safety_threshold（如BLOCK_NONE）应用到所有安全类别，留空时不设置。
+        """
+        thinking_budget = self.config.get('GEMINI', 'thinking_budget', fallback='').strip()
+        return {
+            'thinking_budget': int(thinking_budget) if thinking_budget else None,
+            'include_thoughts': self.config.getboolean('GEMINI', 'include_thoughts', fallback=False),
+            'safety_threshold': self.config.get('GEMINI', 'safety_threshold', fallback='').strip()
+        }
+    
+    def get_warmup_config(self) -> Dict[str, Any]:
+        """
+        获取连接预热配置
+        
+        启动时解析每个上游的地址并建立connections个keep-alive连接；超过idle_rewarm秒
+        没有上游请求时重新预热（应小于[UPSTREAM] keepalive_expiry，为0时只在启动时预热）。
+        dns_ttl为DNS缓存秒数，为0时不缓存。method和path为预热请求的方法和路径（默认HEAD /）；
+        method为CONNECT时不发送请求，只完成TCP/TLS握手（连接不会留在连接池中）。
+        """
+        path = self.config.get('WARMUP', 'path', fallback='/').strip() or '/'
+        return {
+            'enabled': self.config.getboolean('WARMUP', 'enabled', fallback=True),
+            'connections': max(1, self.config.getint('WARMUP', 'connections', fallback=2)),
+            'idle_rewarm': max(0.0, self.config.getfloat('WARMUP', 'idle_rewarm', fallback=25.0)),
+            'dns_ttl': max(0.0, self.config.getfloat('WARMUP', 'dns_ttl', fallback=300.0)),
+            'timeout': self.config.getfloat('WARMUP', 'timeout', fallback=10.0),
+            'method': self.config.get('WARMUP', 'method', fallback='HEAD').strip().upper() or 'HEAD',
+            'path': path if path.startswith('/') else '/' + path
+        }
+    
+    def get_pacing_config(self) -> Dict[str, Any]:
+        """
+        获取伪流式节奏配置
+        
+        mode为slices时平均切分为slices段、段间等待frame_delay秒（默认）；为instant时完整内容一次发送；
+        为fixed时按UTF-8字节数切分；为rate时按目标token速率在词边界切分。
+        推理内容、正文和工具调用按此顺序发送，结束原因与完整响应一致。两次等待之间的增量合并为一次写入，单次写入不超过约coalesce_bytes字节。
+        客户端可以用X-Stream-Pacing请求头（如 slices:100、instant、fixed:512、rate:80）按请求选择。
+        """
+        mode = self.config.get('PACING', 'mode', fallback='slices').strip().lower()
+        return {
+            'mode': mode if mode in ('slices', 'instant', 'fixed', 'rate') else 'slices',
+            'slices': max(1, self.config.getint('PACING', 'slices', fallback=50)),
+            'frame_bytes': max(1, self.config.getint('PACING', 'frame_bytes', fallback=256)),
+            'frame_delay': max(0.0, self.config.getfloat('PACING', 'frame_delay', fallback=0.01)),
+            'tokens_per_second': max(1.0, self.config.getfloat('PACING', 'tokens_per_second', fallback=100.0)),
+            'frame_interval': max(0.001, self.config.getfloat('PACING', 'frame_interval', fallback=0.05)),
+            'max_duration': max(0.0, self.config.getfloat('PACING', 'max_duration', fallback=2.0)),
+            'coalesce_bytes': max(1, self.config.getint('PACING', 'coalesce_bytes', fallback=4096))
+        }
+    
+    def get_json_backend(self) -> str:
+        """获取JSON编解码后端: auto、orjson、msgspec或json"""
+        return self.config.get('JSON', 'backend', fallback='auto').strip().lower() or 'auto'
+    
+    def get_reload_config(self) -> Dict[str, Any]:
+        """获取配置热加载设置"""
+        return {
+            'watch_interval': max(0.0, self.config.getfloat('RELOAD', 'watch_interval', fallback=2.0))
+        }
+    
+    def get_admin_config(self) -> Dict[str, Any]:
+        """获取管理接口配置（重新加载配置、平滑关闭）"""
+        token = self.config.get('ADMIN', 'token', fallback='').strip()
+        return {
+            'token': token or self.config['SERVER']['api_key'],
+            'drain_timeout': max(0.0, self.config.getfloat('ADMIN', 'drain_timeout', fallback=30.0))
+        }
+    
+    def get_workers_config(self) -> Dict[str, Any]:
+        """获取多工作进程配置，count为auto时使用CPU核数"""
+        count = self.config.get('WORKERS', 'count', fallback='1').strip().lower()
+        return {
+            'count': (os.cpu_count() or 1) if count == 'auto' else max(1, int(count)),
+            'state_path': self.config.get('WORKERS', 'state_path', fallback='key_state.db').strip() or 'key_state.db',
+            'sync_interval': max(0.05, self.config.getfloat('WORKERS', 'sync_interval', fallback=0.5))
+        }
+    
+    def get_cluster_config(self) -> Dict[str, Any]:
+        """获取集群模式配置，instance为空时使用主机名"""
+        return {
+            'enabled': self.config.getboolean('CLUSTER', 'enabled', fallback=False),
+            'backend_url': self.config.get('CLUSTER', 'backend_url', fallback='redis://127.0.0.1:6379/0').strip(),
+            'key_prefix': self.config.get('CLUSTER', 'key_prefix', fallback='llm_proxy').strip() or 'llm_proxy',
+            'instance': self.config.get('CLUSTER', 'instance', fallback='').strip(),
+            'sync_interval': max(0.05, self.config.getfloat('CLUSTER', 'sync_interval', fallback=1.0)),
+            'timeout': max(0.1, self.config.getfloat('CLUSTER', 'timeout', fallback=2.0))
+        }
 
 # 配置日志
 logging.basicConfig(
@@ -174,184 +680,316 @@ config_manager = ConfigManager()
 
 # ==================== FastAPI服务 (如果可用) ====================
 if FASTAPI_AVAILABLE:
-    class ChatRequest(BaseModel):
-        model: str
-        messages: List[Dict[str, Any]]
-        temperature: float = 0.7
-        max_tokens: int = 4096
-        stream: bool = False
-
-    # 轮询计数器
-    current_group_index = 0
-
-    def get_current_api_keys():
-        """根据轮询机制返回当前应该使用的API密钥组"""
-        global current_group_index
-        api_keys = config_manager.get_api_keys()
-        
-        if current_group_index == 0:
-            keys = api_keys['group1']
-            current_group_index = 1
-        else:
-            keys = api_keys['group2']
-            current_group_index = 0
-        
-        valid_keys = [key for key in keys if key and not key.startswith("YOUR_") and len(key) > 10]
-        return valid_keys
+    # 密钥调度: 两组密钥合并为一个密钥池，按每个密钥的限额和并发数分配
+    # 请求处理只读取config_manager.snapshot（解析好的只读快照），配置文件变化或控制台保存时整体替换
+    key_scheduler = KeyScheduler([], config_manager.snapshot.scheduler['limits'],
+                                 config_manager.snapshot.scheduler['overrides'], config_manager.snapshot.breaker)
 
-    async def send_single_request(client: httpx.AsyncClient, api_key: str, request_data: dict):
-        """使用单个API密钥发送请求"""
-        cleaned_data = {}
-        supported_params = {
-            'model', 'messages', 'temperature', 'max_tokens',
-            'top_p', 'top_k', 'stop'
-        }
-        
-        for key, value in request_data.items():
-            if key in supported_params:
-                cleaned_data[key] = value
+    # 上游路由: 可配置多个上游，每个上游有自己的密钥池，按首字节耗时和错误率选择
+    upstream_router = UpstreamRouter(key_scheduler, [], config_manager.snapshot.routing)
+    # 已应用到调度器、路由和准入控制的快照版本
+    applied_version = {'version': None}
+
+    # 集群模式: 服务启动时按[CLUSTER]连接共享的密钥账本，修改后需要重启服务
+    cluster_ledger = {'ledger': None}
+
+    # /metrics: 抓取时读取准入队列和密钥状态，请求路径上只更新计数
+    proxy_metrics.add_collector(lambda: collect_admission_metrics(admission))
+    proxy_metrics.add_collector(lambda: collect_key_metrics(key_scheduler))
+    proxy_metrics.add_collector(lambda: [gauge("llm_proxy_min_response_length", "当前的最小响应长度，短于它的响应被丢弃",
+                                               config_manager.snapshot.server['min_response_length'])])
+
+    def apply_config(config: ConfigSnapshot):
+        """
+        把配置快照应用到调度器、上游路由、准入控制和连接预热。仍然存在的密钥保留用量和熔断状态，
+        进行中的请求继续使用已分配的密钥。监听地址、连接池和缓存后端需要重启后生效。
+        """
+        key_scheduler.limits = config.scheduler['limits']
+        key_scheduler.overrides = config.scheduler['overrides']
+        key_scheduler.breaker_config = config.breaker
+        key_scheduler.batch_reserve = config.priority['batch_reserve']
+        admission.max_concurrent = config.admission['max_concurrent']
+        admission.max_queue = config.admission['max_queue']
+        admission.max_queue_time = config.admission['max_queue_time']
+        admission.batch_share = config.priority['batch_share']
+        admission.batch_max_queue_time = config.priority['batch_max_queue_time']
+        connection_warmer.configure(config.warmup)
+        upstream_router.configure(config.routing)
+        upstream_router.update_upstreams(build_upstreams(
+            config.base_url, build_key_pool(config.api_keys['group1'], config.api_keys['group2']),
+            config.upstreams, config.protocol, config.gemini))
+        applied_version['version'] = config.version
+
+    def refresh_upstreams() -> List[str]:
+        """配置快照变化时（文件重新加载或控制台保存）应用新配置，返回所有上游的密钥"""
+        config = config_manager.snapshot
+        if applied_version['version'] != config.version:
+            apply_config(config)
+        return upstream_router.keys
+
+    def schedule_upstream_targets(estimated_tokens: int, lane: str = LANE_INTERACTIVE) -> Iterator[UpstreamTarget]:
+        """
+        按当前配置为一次请求按需分配上游和密钥，没有可用密钥时抛出500或429。
+
+        只预先分配第一个目标，其余目标在扇出实际发送时才从迭代器中分配；
+        对冲模式下第一个请求就胜出时，其余密钥从未被占用，不需要释放。
+        """
+        key_pool = refresh_upstreams()
+        if not key_pool:
+            raise HTTPException(status_code=500, detail="服务器未配置有效的API密钥")
         
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json",
-        }
+        config = config_manager.snapshot
+        priority_config = config.priority
+        width = config.scheduler['fanout_width'] or max(1, math.ceil(len(key_pool) / 2))
+        if lane == LANE_BATCH and priority_config['batch_fanout_width'] > 0:
+            width = min(width, priority_config['batch_fanout_width'])
+        targets = upstream_router.iter_targets(width, estimated_tokens, lane)
+        first_target = next(targets, None)
+        if first_target is None:
+            raise HTTPException(status_code=429, detail="所有API密钥均已达到限额或处于冷却中，请稍后重试",
+                                headers=rate_limit_headers(key_scheduler.capacity(),
+                                                           key_scheduler.retry_after(estimated_tokens, lane)))
+        return itertools.chain([first_target], targets)
+
+    # 响应缓存: 相同请求直接返回缓存的完整响应；缓存后端在启动时创建，修改后需要重启服务
+    response_cache = create_response_cache(config_manager.snapshot.cache)
+
+    # 请求合并: 同时到达的相同请求只向上游扇出一次
+    single_flight = SingleFlight()
+
+    # 多租户: 每个客户端密钥一个租户，服务器的api_key作为default租户；配置变化时重建
+    tenant_registry_cache = {'version': None, 'source': None, 'registry': None}
+
+    def get_tenant_registry():
+        """返回与当前配置一致的租户表；快照变化但租户配置未变时保留原租户表（及其用量）"""
+        config = config_manager.snapshot
+        if tenant_registry_cache['version'] != config.version:
+            tenant_registry_cache['version'] = config.version
+            api_key = config.server['api_key']
+            source = (api_key, json.dumps(config.tenants, sort_keys=True))
+            if tenant_registry_cache['source'] != source:
+                tenant_registry_cache['source'] = source
+                tenant_registry_cache['registry'] = build_tenant_registry(api_key, config.tenants)
+                if cluster_ledger['ledger'] is not None:
+                    cluster_ledger['ledger'].attach_tenants(tenant_registry_cache['registry'])
+        return tenant_registry_cache['registry']
+
+    # 准入控制: 全局并发上限和按租户加权公平的有界等待队列，交互请求排在批量请求之前
+    # 配置变化时由apply_config更新上限
+    admission = AdmissionController(config_manager.snapshot.admission['max_concurrent'],
+                                    config_manager.snapshot.admission['max_queue'],
+                                    config_manager.snapshot.admission['max_queue_time'],
+                                    config_manager.snapshot.priority['batch_share'],
+                                    config_manager.snapshot.priority['batch_max_queue_time'])
+
+    # 观测到的胜出请求耗时，用于自动推算对冲延迟
+    completion_latency = LatencyTracker()
+    stream_latency = LatencyTracker()
+
+    # 全局共享的上游客户端，在应用生命周期内复用TCP/TLS连接
+    upstream_client: Optional[httpx.AsyncClient] = None
+
+    # 连接预热: 启动时和空闲后预先解析上游地址并建立keep-alive连接
+    connection_warmer = ConnectionWarmer(config_manager.snapshot.warmup)
+
+    # JSON编解码后端: 安装了orjson或msgspec时使用，否则使用标准库
+    set_backend(config_manager.snapshot.json_backend)
+
+    def create_upstream_client() -> httpx.AsyncClient:
+        """根据配置创建带连接池的上游客户端"""
+        upstream_config = config_manager.snapshot.upstream
+        use_http2 = upstream_config['http2']
+        if use_http2 and not HTTP2_AVAILABLE:
+            logger.warning("配置启用了HTTP/2，但未安装h2依赖，回退到HTTP/1.1")
+            use_http2 = False
         
-        url = f"{config_manager.get_base_url()}/openai/chat/completions"
+        limits = httpx.Limits(
+            max_connections=upstream_config['max_connections'],
+            max_keepalive_connections=upstream_config['max_keepalive_connections'],
+            keepalive_expiry=upstream_config['keepalive_expiry'],
+        )
+        connection_warmer.configure(config_manager.snapshot.warmup)
+        return httpx.AsyncClient(
+            transport=connection_warmer.create_transport(limits, use_http2),
+            event_hooks={"request": [connection_warmer.on_request]},
+        )
+
+    def get_upstream_client() -> httpx.AsyncClient:
+        """返回共享的上游客户端，未经lifespan初始化时按需创建"""
+        global upstream_client
+        if upstream_client is None or upstream_client.is_closed:
+            upstream_client = create_upstream_client()
+        return upstream_client
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        """应用生命周期：启动时建立连接池并在后台预热、监视配置文件，关闭时释放"""
+        global upstream_client
+        upstream_client = create_upstream_client()
+
+        def warmup_urls() -> List[str]:
+            refresh_upstreams()
+            return [upstream.base_url for upstream in upstream_router.upstreams]
+
+        warmup_task = asyncio.create_task(connection_warmer.run(get_upstream_client, warmup_urls))
+        # 配置文件变化时重新加载快照并立即应用，控制台保存时由请求路径按版本应用
+        watch_task = asyncio.create_task(watch_config(config_manager, apply_config))
+        lag_task = asyncio.create_task(proxy_metrics.monitor_loop_lag())
+        ledger = create_key_ledger(config_manager.snapshot.cluster)
+        ledger_task = None
+        if ledger is not None:
+            ledger.attach(key_scheduler)
+            ledger.attach_tenants(get_tenant_registry())
+            cluster_ledger['ledger'] = ledger
+            ledger_task = asyncio.create_task(ledger.run())
+        try:
+            yield
+        finally:
+            warmup_task.cancel()
+            watch_task.cancel()
+            lag_task.cancel()
+            if ledger is not None:
+                ledger_task.cancel()
+                ledger.close()
+                key_scheduler.ledger = None
+                cluster_ledger['ledger'] = None
+            await upstream_client.aclose()
+            upstream_client = None
+            if response_cache is not None:
+                response_cache.close()
+
+    async def send_single_request(client: httpx.AsyncClient, target: UpstreamTarget, payload: OutboundPayload):
+        """使用单个API密钥向目标上游发送请求，请求体在所有尝试间共享"""
+        api_key = target.key
+        response = None
         
         try:
-            response = await client.post(url, headers=headers, json=cleaned_data,
-                                       timeout=config_manager.get_server_config()['request_timeout'])
-            response.raise_for_status()
-            
-            response_text = response.text
+            request = target.build_request(client, payload, False,
+                                           config_manager.snapshot.server['request_timeout'])
+            started = time.monotonic()
+            response = await client.send(request, stream=True)
+            proxy_metrics.observe_upstream_response(api_key, False, response.status_code, time.monotonic() - started)
+            try:
+                if response.is_error:
+                    await response.aread()
+                response.raise_for_status()
+                target.record_success(api_key, time.monotonic() - started)
+                aggregator, body = await target.read_completion_body(response, payload.model)
+            finally:
+                await response.aclose()
+                proxy_metrics.observe_upstream_total(api_key, False, time.monotonic() - started)
             
-            if "data:" in response_text:
-                lines = response_text.strip().split('\n')
-                content = ""
-                final_id = ""
-                final_model = ""
-                final_created = int(time.time())
-                
-                for line in lines:
-                    if line.startswith("data: "):
-                        try:
-                            data = json.loads(line[6:])
-                            if data == "[DONE]":
-                                continue
-                                
-                            if "choices" in data and data["choices"]:
-                                delta = data["choices"][0].get("delta", {})
-                                if "content" in delta:
-                                    content += delta["content"]
-                                
-                                if "id" in data:
-                                    final_id = data["id"]
-                                if "model" in data:
-                                    final_model = data["model"]
-                                if "created" in data:
-                                    final_created = data["created"]
-                                    
-                        except json.JSONDecodeError:
-                            continue
-                
-                if content:
-                    return {
-                        "id": final_id or "chatcmpl-" + str(int(time.time())),
-                        "object": "chat.completion",
-                        "created": final_created,
-                        "model": final_model or "gemini-2.5-flash",
-                        "choices": [
-                            {
-                                "index": 0,
-                                "message": {
-                                    "role": "assistant",
-                                    "content": content,
-                                },
-                                "finish_reason": "stop"
-                            }
-                        ],
-                        "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
-                    }
+            if aggregator is not None:
+                return aggregator.to_completion() if aggregator.has_output() else None
             
             try:
-                return response.json()
-            except ValueError as e:
+                return loads(body)
+            except DecodeError as e:
                 logger.error(f"JSON解析错误: {e}")
                 return None
                 
+        except httpx.HTTPStatusError as e:
+            logger.error(f"密钥 [***{api_key[-4:]}] HTTP状态错误: {e.response.status_code}")
+            target.record_failure(
+                api_key, e.response.status_code,
+                parse_retry_after(e.response.headers.get("retry-after"), e.response.text),
+                e.response.text)
+            return None
         except httpx.RequestError as e:
             logger.error(f"请求错误: {e}")
+            target.record_failure(api_key, 0)
+            if response is None:
+                proxy_metrics.observe_upstream_response(api_key, False, 0)
+                proxy_metrics.observe_upstream_total(api_key, False, time.monotonic() - started)
             return None
         except Exception as e:
             logger.error(f"未知错误: {e}")
             return None
 
-    async def generate_fake_stream_response(request_data: dict):
-        """获取完整的响应内容，等待15秒后选择token最长的响应，然后以流式方式发送给前端"""
+    async def send_scheduled_request(client: httpx.AsyncClient, target: UpstreamTarget, payload: OutboundPayload,
+                                     estimated_tokens: int):
+        """发送请求，结束后释放密钥的并发名额并按实际用量修正token额度"""
+        result = None
         try:
-            current_keys = get_current_api_keys()
-            if not current_keys:
-                raise HTTPException(status_code=500, detail="没有可用的API密钥")
-            
-            valid_responses = []
-            
-            async with httpx.AsyncClient() as client:
-                tasks = [
-                    asyncio.create_task(send_single_request(client, key, request_data))
-                    for key in current_keys
-                ]
-                
-                # 收集所有有效的响应
-                for future in asyncio.as_completed(tasks):
-                    try:
-                        result = await future
-                        if result and "choices" in result and result["choices"]:
-                            message_content = result["choices"][0].get("message", {}).get("content", "")
-                            if len(message_content) >= config_manager.get_server_config()['min_response_length']:
-                                valid_responses.append({
-                                    'result': result,
-                                    'content': message_content,
-                                    'token_count': len(message_content)
-                                })
-                    except asyncio.CancelledError:
-                        pass
-                
-                # 等待15秒收集更多响应
-                if valid_responses:
-                    # 已经有有效响应，继续等待其他响应
-                    remaining_tasks = [task for task in tasks if not task.done()]
-                    if remaining_tasks:
-                        try:
-                            done, pending = await asyncio.wait(remaining_tasks, timeout=15)
-                            
-                            # 处理剩余完成的任务
-                            for task in done:
-                                try:
-                                    result = task.result()
-                                    if result and "choices" in result and result["choices"]:
-                                        message_content = result["choices"][0].get("message", {}).get("content", "")
-                                        if len(message_content) >= config_manager.get_server_config()['min_response_length']:
-                                            valid_responses.append({
-                                                'result': result,
-                                                'content': message_content,
-                                                'token_count': len(message_content)
-                                            })
-                                except Exception as e:
-                                    logger.error(f"处理响应时出错: {e}")
-                                    pass
-                            
-                            # 取消仍在进行的任务
-                            for task in pending:
-                                task.cancel()
-                                
-                        except asyncio.TimeoutError:
-                            logger.warning("等待响应超时")
-                            pass
-                
-                # 选择token最长的响应
-                if valid_responses:
-                    best_response = max(valid_responses, key=lambda x: x['token_count'])
-                    return await stream_response_content(best_response['result'], best_response['content'])
+            result = await send_single_request(client, target, payload)
+            return result
+        finally:
+            usage = (result or {}).get("usage") or {}
+            key_scheduler.release(target.key, estimated_tokens, usage.get("total_tokens") or None)
+
+    async def generate_passthrough_stream_response(payload: OutboundPayload, on_complete=None,
+                                                   lane: str = LANE_INTERACTIVE):
+        """并发发起真正的上游流式请求，第一个内容足够长的流胜出并实时转发；全部失败时返回None"""
+        estimated_tokens = estimate_request_tokens(payload.data)
+        # 先取得客户端和配置再分配密钥，分配之后到开始竞速之间不会因异常而遗留已占用的密钥
+        client = get_upstream_client()
+        server_config = config_manager.snapshot.server
+        hedge_delay = resolve_hedge_delay(config_manager.snapshot.fanout, stream_latency)
+        targets = schedule_upstream_targets(estimated_tokens, lane)
+        
+        def release(api_key: str, used_tokens: Optional[int]):
+            key_scheduler.release(api_key, estimated_tokens, used_tokens)
+        
+        stream = await race_upstream_streams(
+            client,
+            targets,
+            payload,
+            server_config['min_response_length'],
+            server_config['request_timeout'],
+            hedge_delay=hedge_delay,
+            tracker=stream_latency,
+            release=release,
+        )
+        if stream is None:
+            return None
+        stream.on_complete = on_complete
+        
+        response = StreamingResponse(stream.relay(), media_type="text/event-stream")
+        # 客户端在响应体开始发送前断开时relay不会运行，仍需释放密钥并结束合并请求
+        release_after_body(response, stream.finish)
+        return response
+
+    def is_usable_response(result: Optional[dict]) -> bool:
+        """判断上游响应格式正确，且内容长度满足最小长度或者包含工具调用或推理内容"""
+        if not result or "choices" not in result or not result["choices"]:
+            return False
+        if has_structured_output(result):
+            return True
+        return len(response_content(result)) >= config_manager.snapshot.server['min_response_length']
+
+    def is_usable_fanout_response(result: Optional[dict]) -> bool:
+        """扇出时判断响应是否可用，过短的响应计入指标"""
+        if is_usable_response(result):
+            return True
+        if result and result.get("choices"):
+            proxy_metrics.record_too_short(False)
+        return False
+
+    async def fanout_completion(payload: OutboundPayload, policy: SelectionPolicy,
+                                lane: str = LANE_INTERACTIVE) -> Optional[dict]:
+        """按扇出配置发送非流式请求，按选择策略返回一个响应"""
+        estimated_tokens = estimate_request_tokens(payload.data)
+        # 先取得客户端再分配密钥，分配之后到开始扇出之间不会因异常而遗留已占用的密钥
+        client = get_upstream_client()
+        targets = schedule_upstream_targets(estimated_tokens, lane)
+        return await run_fanout(
+            targets,
+            lambda target: send_scheduled_request(client, target, payload, estimated_tokens),
+            is_usable_fanout_response,
+            hedge_delay=resolve_hedge_delay(config_manager.snapshot.fanout, completion_latency),
+            tracker=completion_latency,
+            policy=policy,
+        )
+
+    async def generate_fake_stream_response(payload: OutboundPayload, policy: SelectionPolicy, on_complete=None,
+                                            lane: str = LANE_INTERACTIVE, pacing: Optional[Dict[str, Any]] = None):
+        """按选择策略获取完整的响应内容，然后按pacing的节奏以流式方式发送给前端"""
+        try:
+            result = await fanout_completion(payload, policy, lane)
+            if result is not None:
+                if on_complete is not None:
+                    await on_complete(result)
+                return await stream_response_content(result, pacing)
 
             raise HTTPException(status_code=503, detail="所有上游API请求均失败")
         except HTTPException:
@@ -360,121 +998,197 @@ if FASTAPI_AVAILABLE:
             logger.error(f"生成流式响应时出错: {e}")
             raise HTTPException(status_code=500, detail=f"服务器内部错误: {str(e)}")
 
-    async def stream_response_content(result: dict, content: str):
-        """将完整的响应内容以流式方式发送给前端"""
+    async def replay_completion(result: dict, stream: bool, headers: Dict[str, str],
+                                pacing: Optional[Dict[str, Any]] = None):
+        """把一个已有的完整响应（缓存或合并请求的结果）按客户端要求的格式返回"""
+        if stream:
+            response = await stream_response_content(result, pacing)
+        else:
+            response = FastJSONResponse(content=result)
+        response.headers.update(headers)
+        return response
+
+    async def stream_response_content(result: dict, pacing: Optional[Dict[str, Any]] = None):
+        """将完整的响应（推理内容、正文、工具调用和结束原因）以流式方式发送给前端，pacing为空时使用配置中的节奏"""
         response_id = result.get("id", f"chatcmpl-{int(time.time())}")
         created_time = result.get("created", int(time.time()))
         model_name = result.get("model", "gemini-2.5-flash")
         
-        async def generate_stream():
-            chunk_size = max(1, len(content) // 50)
-            for i in range(0, len(content), chunk_size):
-                chunk = content[i:i+chunk_size]
-                chunk_data = {
-                    "id": response_id, "object": "chat.completion.chunk", "created": created_time, "model": model_name,
-                    "choices": [{"index": 0, "delta": {"content": chunk}, "finish_reason": None}]
-                }
-                yield f"data: {json.dumps(chunk_data)}\n\n"
-                await asyncio.sleep(0.01)
-            
-            final_data = {
-                "id": response_id, "object": "chat.completion.chunk", "created": created_time, "model": model_name,
-                "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]
-            }
-            yield f"data: {json.dumps(final_data)}\n\n"
-            yield "data: [DONE]\n\n"
+        # 增量外壳只序列化一次，每个增量只编码内容
+        envelope = ChunkEnvelope(response_id, created_time, model_name)
+        choice = result["choices"][0]
         
-        return StreamingResponse(generate_stream(), media_type="text/event-stream")
+        return StreamingResponse(paced_events(envelope, choice.get("message") or {},
+                                              pacing or config_manager.snapshot.pacing, choice.get("finish_reason")),
+                                 media_type="text/event-stream")
 
     # 初始化FastAPI应用
-    app_fastapi = FastAPI(title="LLM代理服务", version="2.0.0")
+    app_fastapi = FastAPI(title="LLM代理服务", version="2.0.0", lifespan=lifespan)
     app_fastapi.add_middleware(
         CORSMiddleware,
         allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"]
     )
 
     @app_fastapi.post("/v1/chat/completions")
-    async def chat_completions_proxy(chat_request: ChatRequest, request: Request):
+    async def chat_completions_proxy(request: Request):
+        """记录请求数和耗时（按是否流式和状态码），流式请求的耗时到响应发送完毕为止"""
+        started = time.monotonic()
+        try:
+            response = await handle_chat_completions(request)
+        except HTTPException as e:
+            proxy_metrics.observe_request(getattr(request.state, "stream", None), e.status_code,
+                                          time.monotonic() - started)
+            raise
+        except Exception:
+            proxy_metrics.observe_request(getattr(request.state, "stream", None), 500, time.monotonic() - started)
+            raise
+
+        def observe():
+            proxy_metrics.observe_request(getattr(request.state, "stream", None), response.status_code,
+                                          time.monotonic() - started)
+
+        if isinstance(response, StreamingResponse):
+            release_after_body(response, observe)
+        else:
+            observe()
+        return response
+
+    async def handle_chat_completions(request: Request):
         try:
             api_key_header = request.headers.get("Authorization")
             if not api_key_header or not api_key_header.startswith("Bearer "):
                 raise HTTPException(status_code=401, detail="缺少API密钥或格式不正确")
             
             provided_key = api_key_header.split(" ")[1]
-            server_config = config_manager.get_server_config()
-            if not provided_key or provided_key != server_config['api_key']:
+            tenant_registry = get_tenant_registry()
+            tenant = tenant_registry.authenticate(provided_key)
+            if tenant is None:
                 raise HTTPException(status_code=401, detail="API密钥无效")
             
-            request_data = await request.json()
-            
-            if chat_request.stream:
-                return await generate_fake_stream_response(request_data)
-            
-            current_keys = get_current_api_keys()
-            if not current_keys:
-                raise HTTPException(status_code=500, detail="服务器未配置有效的API密钥")
-            
-            valid_responses = []
-            
-            async with httpx.AsyncClient() as client:
-                tasks = [
-                    asyncio.create_task(send_single_request(client, key, request_data))
-                    for key in current_keys
-                ]
+            # 请求体只读取和解析一次，只校验代理用到的字段
+            try:
+                body = parse_chat_request(await request.body())
+            except InvalidChatRequest as e:
+                raise HTTPException(status_code=422, detail=e.errors)
+            request.state.stream = body.stream
+            request_data = body.data
+            # 租户额度：按估算token预扣，请求结束后按实际用量修正
+            try:
+                usage = tenant_registry.begin(tenant, estimate_request_tokens(request_data))
+            except TenantQuotaExceeded as e:
+                raise HTTPException(status_code=429, detail=f"租户 {tenant.name} 的请求额度已用完，请稍后重试",
+                                    headers=rate_limit_headers(tenant.capacity(), e.retry_after))
+            try:
+                config = config_manager.snapshot
+                policy = resolve_selection_policy(config.selection, request.headers)
+                lane = resolve_lane(config.priority, request.headers, tenant.priority)
+                pacing = resolve_pacing(config.pacing, request.headers)
+                payload = build_upstream_payload(request_data)
+                request_key = canonical_request_key(payload)
+                # 发往上游的请求体只编码一次，所有扇出、对冲和重试的尝试共享
+                outbound = OutboundPayload(payload, body.size)
                 
-                # 收集所有有效的响应
-                for future in asyncio.as_completed(tasks):
-                    try:
-                        result = await future
-                        if result and "choices" in result and result["choices"]:
-                            message_content = result["choices"][0].get("message", {}).get("content", "")
-                            if len(message_content) >= server_config['min_response_length']:
-                                valid_responses.append({
-                                    'result': result,
-                                    'content': message_content,
-                                    'token_count': len(message_content)
-                                })
-                    except asyncio.CancelledError:
-                        pass
+                # 响应缓存：命中时直接返回（流式请求以伪流式回放），未命中时在得到完整响应后写入
+                cache_status = None
+                store_result = None
+                if response_cache is not None and is_cacheable_request(
+                        payload, config_manager.snapshot.cache['deterministic_only']):
+                    directives = cache_directives(request.headers)
+                    cache_status = "MISS" if directives['read'] else "BYPASS"
+                    if directives['read']:
+                        cached = await response_cache.get(request_key)
+                        if cached is not None:
+                            usage.finish(served_locally=True)
+                            return await replay_completion(cached, body.stream, {CACHE_STATUS_HEADER: "HIT"},
+                                                           pacing)
+                    
+                    async def store_in_cache(result: dict):
+                        # 回退得到的过短响应不缓存
+                        if is_usable_response(result):
+                            await response_cache.put(request_key, result)
+                    store_result = store_in_cache if directives['write'] else None
+                
+                # 请求合并：相同请求正在进行中时等待并复用它的结果
+                flight = None
+                coalesce_config = config.coalesce
+                if coalesce_config['enabled']:
+                    flight_key = f"{policy.name}:{lane}:{request_key}"
+                    existing = single_flight.lookup(flight_key)
+                    if existing is not None:
+                        result = await cancel_on_disconnect(
+                            single_flight.follow(existing, coalesce_config['follower_timeout']),
+                            request.is_disconnected)
+                        if result is not None:
+                            usage.finish(served_locally=True)
+                            return await replay_completion(result, body.stream,
+                                                           {SINGLE_FLIGHT_HEADER: "follower"}, pacing)
+                    flight = single_flight.lead(flight_key)
                 
-                # 等待15秒收集更多响应
-                if valid_responses:
-                    # 已经有有效响应，继续等待其他响应
-                    remaining_tasks = [task for task in tasks if not task.done()]
-                    if remaining_tasks:
-                        try:
-                            done, pending = await asyncio.wait(remaining_tasks, timeout=15)
-                            
-                            # 处理剩余完成的任务
-                            for task in done:
-                                try:
-                                    result = task.result()
-                                    if result and "choices" in result and result["choices"]:
-                                        message_content = result["choices"][0].get("message", {}).get("content", "")
-                                        if len(message_content) >= server_config['min_response_length']:
-                                            valid_responses.append({
-                                                'result': result,
-                                                'content': message_content,
-                                                'token_count': len(message_content)
-                                            })
-                                except Exception as e:
-                                    logger.error(f"处理响应时出错: {e}")
-                                    pass
-                            
-                            # 取消仍在进行的任务
-                            for task in pending:
-                                task.cancel()
-                                
-                        except asyncio.TimeoutError:
-                            logger.warning("等待响应超时")
-                            pass
+                async def on_complete(result: Optional[dict]):
+                    usage.finish(result)
+                    if flight is not None:
+                        single_flight.finish(flight, result)
+                    if result is not None and store_result is not None:
+                        await store_result(result)
                 
-                # 选择token最长的响应
-                if valid_responses:
-                    best_response = max(valid_responses, key=lambda x: x['token_count'])
-                    return JSONResponse(content=best_response['result'])
+                # 真流式转发成功时，由转发结束时的on_complete结束合并请求
+                handed_off = False
+                slot = None
+                try:
+                    # 准入控制：并发已满时排队（交互请求排在批量请求之前），队列已满或排队超时立即返回429
+                    try:
+                        slot = await cancel_on_disconnect(
+                            admission.acquire(tenant.name, tenant.weight, tenant_registry.share(tenant), lane),
+                            request.is_disconnected)
+                    except AdmissionRejected as e:
+                        retry_after = max(e.retry_after,
+                                          key_scheduler.retry_after(estimate_request_tokens(request_data), lane))
+                        raise HTTPException(status_code=429, detail="服务繁忙，请稍后重试",
+                                            headers=rate_limit_headers(key_scheduler.capacity(), retry_after))
+                    
+                    if body.stream:
+                        response = None
+                        # best_of需要比较完整响应，只能使用伪流式
+                        if config.stream_mode == 'passthrough' and policy.first_valid:
+                            response = await cancel_on_disconnect(
+                                generate_passthrough_stream_response(outbound, on_complete, lane),
+                                request.is_disconnected)
+                            handed_off = response is not None
+                            if handed_off:
+                                usage.defer()
+                            else:
+                                logger.warning("所有真流式请求均失败或过短，回退到伪流式响应")
+                        if response is None:
+                            response = await cancel_on_disconnect(
+                                generate_fake_stream_response(outbound, policy, on_complete, lane, pacing),
+                                request.is_disconnected)
+                        if cache_status:
+                            response.headers[CACHE_STATUS_HEADER] = cache_status
+                        # 流式响应发送完毕后才释放准入名额
+                        release_after_body(response, slot.release)
+                        slot = None
+                        return response
+                    
+                    result = await cancel_on_disconnect(fanout_completion(outbound, policy, lane),
+                                                        request.is_disconnected)
+                    if result is not None:
+                        await on_complete(result)
+                        response = FastJSONResponse(content=result)
+                        if cache_status:
+                            response.headers[CACHE_STATUS_HEADER] = cache_status
+                        return response
+                finally:
+                    if slot is not None:
+                        slot.release()
+                    if flight is not None and not handed_off:
+                        single_flight.finish(flight, None)
 
-            raise HTTPException(status_code=503, detail="所有上游API请求均失败")
+                raise HTTPException(status_code=503, detail="所有上游API请求均失败")
+            finally:
+                usage.close()
+        except ClientDisconnected:
+            logger.info("客户端已断开连接，已取消所有未完成的上游请求")
+            return Response(status_code=499)
         except HTTPException:
             raise
         except Exception as e:
@@ -485,6 +1199,33 @@ if FASTAPI_AVAILABLE:
     def read_root():
         return {"status": "ok", "message": "LLM代理服务正在运行"}
 
+    @app_fastapi.get("/health")
+    def health_check():
+        """健康检查端点，包含每个密钥的限额余量和熔断状态"""
+        refresh_upstreams()
+        return {
+            "status": "healthy",
+            "api_keys_count": len(key_scheduler.keys),
+            "key_health": key_scheduler.health_summary(),
+            "keys": key_scheduler.snapshot(),
+            "upstreams": upstream_router.snapshot(),
+            "warmup": connection_warmer.snapshot(),
+            "json_backend": backend_name(),
+            "config_version": config_manager.snapshot.version,
+            "ledger": cluster_ledger['ledger'].snapshot() if cluster_ledger['ledger'] is not None else None,
+            "payload_memory": payload_stats.snapshot(),
+            "cancellations": fanout_stats.snapshot(),
+            "cache": response_cache.snapshot() if response_cache is not None else None,
+            "coalescing": single_flight.snapshot(),
+            "admission": admission.snapshot(),
+            "tenants": get_tenant_registry().snapshot()
+        }
+
+    @app_fastapi.get("/metrics")
+    def metrics():
+        """Prometheus文本格式的运行指标"""
+        return Response(content=proxy_metrics.render(), media_type=METRICS_CONTENT_TYPE)
+
 # ==================== Flask Web界面 (如果可用) ====================
 if FLASK_AVAILABLE:
     app_flask = Flask(__name__, 
@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+上游后端适配模块
+openai后端使用Gemini的OpenAI兼容接口（/openai/chat/completions）；
+gemini后端直接调用原生的generateContent/streamGenerateContent，把OpenAI格式的消息转换为
+Gemini的contents，再把Gemini的响应转换回OpenAI格式的chat.completion和增量，
+并支持思考预算、安全设置等兼容接口不提供的参数
+"""
+
+import logging
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+import httpx
+
+from json_codec import DecodeError, dumps, dumps_bytes, loads
+from request_ingest import OutboundPayload, encode_payload, json_value
+from sse_parser import (ChunkEvent, SSEDecoder, StreamAggregator, aggregate_sse_bytes,
+                        aiter_chunk_events)
+
+logger = logging.getLogger(__name__)
+
+BACKEND_OPENAI = "openai"
+BACKEND_GEMINI = "gemini"
+BACKENDS = (BACKEND_OPENAI, BACKEND_GEMINI)
+
+# OpenAI兼容接口支持的参数
+SUPPORTED_PARAMS = {
+    'model', 'messages', 'temperature', 'max_tokens',
+    'top_p', 'top_k', 'stop'
+}
+
+# 只有原生Gemini后端使用的参数，客户端可以在请求体中按请求指定
+NATIVE_PARAMS = {'thinking_budget', 'include_thoughts', 'safety_settings', 'reasoning_effort'}
+
+# [GEMINI]中的默认值，每个上游可以单独覆盖
+GEMINI_OPTIONS = ('thinking_budget', 'include_thoughts', 'safety_threshold')
+
+# reasoning_effort到思考预算（token数）的映射
+REASONING_EFFORT_BUDGETS = {
+    "none": 0,
+    "low": 1024,
+    "medium": 8192,
+    "high": 24576,
+}
+
+# safety_threshold应用到的安全类别
+HARM_CATEGORIES = (
+    "HARM_CATEGORY_HARASSMENT",
+    "HARM_CATEGORY_HATE_SPEECH",
+    "HARM_CATEGORY_SEXUALLY_EXPLICIT",
+    "HARM_CATEGORY_DANGEROUS_CONTENT",
+)
+
+FINISH_REASONS = {
+    "STOP": "stop",
+    "MAX_TOKENS": "length",
+    "SAFETY": "content_filter",
+    "RECITATION": "content_filter",
+    "BLOCKLIST": "content_filter",
+    "PROHIBITED_CONTENT": "content_filter",
+    "SPII": "content_filter",
+}
+
+
+class OpenAIBackend:
+    """通过OpenAI兼容接口调用上游"""
+
+    name = BACKEND_OPENAI
+
+    def encode_body(self, data: Dict[str, Any], stream: bool) -> bytes:
+        body = {key: value for key, value in data.items() if key in SUPPORTED_PARAMS}
+        if stream:
+            body["stream"] = True
+        # messages为RawJSON时原始字节直接拼接进请求体，不重新序列化
+        return encode_payload(body)
+
+    def build_request(self, client: httpx.AsyncClient, base_url: str, path: str, api_key: str,
+                      payload: OutboundPayload, stream: bool, timeout: float) -> httpx.Request:
+        headers = {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json",
+        }
+        # 同一请求的所有尝试共享编码好的请求体，只有认证请求头不同
+        content = payload.body((self.name, stream), lambda data: self.encode_body(data, stream))
+        return client.build_request("POST", f"{base_url}{path}", headers=headers, content=content, timeout=timeout)
+
+    async def read_completion_body(self, response: httpx.Response,
+                                   model: str = "") -> Tuple[Optional[StreamAggregator], bytes]:
+        """
+        读取一个非流式请求的上游响应。
+
+        SSE响应边读边增量聚合，不缓冲整个响应体；其他响应完整读取，
+        若响应体实际是SSE格式也会被聚合。
+
+        Returns:
+            (聚合器, 响应体)；响应是SSE时聚合器不为None
+        """
+        if "text/event-stream" in response.headers.get("content-type", ""):
+            aggregator = StreamAggregator()
+            async for event in aiter_chunk_events(response.aiter_bytes()):
+                aggregator.add(event)
+            return aggregator, b""
+
+        body = await response.aread()
+        if body.lstrip().startswith(b"data:"):
+            return aggregate_sse_bytes(body), body
+        return None, body
+
+    def stream_events(self, response: httpx.Response, model: str = "") -> AsyncIterator[ChunkEvent]:
+        return aiter_chunk_events(response.aiter_bytes())
+
+
+def _content_parts(content: Any) -> List[Dict[str, Any]]:
+    """把OpenAI消息的content（字符串或多段内容）转换为Gemini的parts"""
+    if content is None:
+        return []
+    if isinstance(content, str):
+        return [{"text": content}] if content else []
+
+    parts = []
+    for item in content:
+        if not isinstance(item, dict):
+            continue
+        if item.get("type") == "text" and item.get("text"):
+            parts.append({"text": item["text"]})
+        elif item.get("type") == "image_url":
+            url = (item.get("image_url") or {}).get("url", "")
+            if url.startswith("data:") and ";base64," in url:
+                mime_type, data = url[5:].split(";base64,", 1)
+                parts.append({"inlineData": {"mimeType": mime_type, "data": data}})
+            else:
+                logger.warning("原生Gemini后端只支持data URI形式的图片，已忽略一个图片链接")
+    return parts
+
+
+def build_gemini_request(payload: Dict[str, Any], options: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    把OpenAI格式的请求转换为Gemini generateContent的请求体。
+
+    system消息合并为systemInstruction，assistant映射为model角色，相邻的同角色消息合并。
+    请求体中的thinking_budget、reasoning_effort、include_thoughts、safety_settings优先于options中的默认值。
+    """
+    contents: List[Dict[str, Any]] = []
+    system_parts: List[Dict[str, Any]] = []
+    for message in json_value(payload.get("messages")) or []:
+        role = message.get("role")
+        parts = _content_parts(message.get("content"))
+        if not parts:
+            continue
+        if role in ("system", "developer"):
+            system_parts.extend(parts)
+            continue
+        gemini_role = "model" if role == "assistant" else "user"
+        if contents and contents[-1]["role"] == gemini_role:
+            contents[-1]["parts"].extend(parts)
+        else:
+            contents.append({"role": gemini_role, "parts": parts})
+
+    body: Dict[str, Any] = {"contents": contents}
+    if system_parts:
+        body["systemInstruction"] = {"parts": system_parts}
+
+    generation_config: Dict[str, Any] = {}
+    for source, target in (("temperature", "temperature"), ("max_tokens", "maxOutputTokens"),
+                           ("top_p", "topP"), ("top_k", "topK")):
+        if payload.get(source) is not None:
+            generation_config[target] = payload[source]
+    stop = payload.get("stop")
+    if stop:
+        generation_config["stopSequences"] = [stop] if isinstance(stop, str) else list(stop)
+
+    thinking_budget = payload.get("thinking_budget")
+    if thinking_budget is None and payload.get("reasoning_effort") in REASONING_EFFORT_BUDGETS:
+        thinking_budget = REASONING_EFFORT_BUDGETS[payload["reasoning_effort"]]
+    if thinking_budget is None:
+        thinking_budget = options.get("thinking_budget")
+    include_thoughts = payload.get("include_thoughts", options.get("include_thoughts", False))
+    if thinking_budget is not None or include_thoughts:
+        thinking_config: Dict[str, Any] = {}
+        if thinking_budget is not None:
+            thinking_config["thinkingBudget"] = int(thinking_budget)
+        if include_thoughts:
+            thinking_config["includeThoughts"] = True
+        generation_config["thinkingConfig"] = thinking_config
+    if generation_config:
+        body["generationConfig"] = generation_config
+
+    safety_settings = payload.get("safety_settings")
+    if safety_settings is None and options.get("safety_threshold"):
+        safety_settings = [{"category": category, "threshold": options["safety_threshold"]}
+                           for category in HARM_CATEGORIES]
+    if safety_settings:
+        body["safetySettings"] = safety_settings
+    return body
+
+
+def gemini_usage(data: Dict[str, Any]) -> Optional[Dict[str, int]]:
+    """把usageMetadata转换为OpenAI的usage，思考token计入completion_tokens"""
+    metadata = data.get("usageMetadata")
+    if not metadata:
+        return None
+    prompt_tokens = metadata.get("promptTokenCount") or 0
+    completion_tokens = (metadata.get("candidatesTokenCount") or 0) + (metadata.get("thoughtsTokenCount") or 0)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": metadata.get("totalTokenCount") or prompt_tokens + completion_tokens,
+    }
+
+
+def gemini_to_chunk(data: Dict[str, Any], response_id: str, model: str, created: int) -> Dict[str, Any]:
+    """把一个GenerateContentResponse转换为OpenAI的chat.completion.chunk"""
+    delta: Dict[str, Any] = {}
+    finish_reason = None
+    candidates = data.get("candidates") or []
+    if candidates:
+        candidate = candidates[0]
+        text_parts, thought_parts = [], []
+        for part in (candidate.get("content") or {}).get("parts") or []:
+            text = part.get("text")
+            if text:
+                (thought_parts if part.get("thought") else text_parts).append(text)
+        if text_parts:
+            delta["content"] = "".join(text_parts)
+        if thought_parts:
+            delta["reasoning_content"] = "".join(thought_parts)
+        if candidate.get("finishReason"):
+            finish_reason = FINISH_REASONS.get(candidate["finishReason"], "stop")
+    elif (data.get("promptFeedback") or {}).get("blockReason"):
+        finish_reason = "content_filter"
+
+    chunk = {
+        "id": data.get("responseId") or response_id,
+        "object": "chat.completion.chunk",
+        "created": created,
+        "model": data.get("modelVersion") or model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+    usage = gemini_usage(data)
+    if usage is not None and finish_reason is not None:
+        chunk["usage"] = usage
+    return chunk
+
+
+def _chunk_event(data: Dict[str, Any], response_id: str, model: str, created: int) -> ChunkEvent:
+    chunk = gemini_to_chunk(data, response_id, model, created)
+    return ChunkEvent(dumps(chunk), chunk)
+
+
+class GeminiBackend:
+    """直接调用Gemini原生generateContent/streamGenerateContent接口"""
+
+    name = BACKEND_GEMINI
+
+    def __init__(self, options: Optional[Dict[str, Any]] = None):
+        # thinking_budget、include_thoughts、safety_threshold的默认值
+        self.options = options or {}
+
+    def build_request(self, client: httpx.AsyncClient, base_url: str, path: str, api_key: str,
+                      payload: OutboundPayload, stream: bool, timeout: float) -> httpx.Request:
+        model = str(payload.model or "gemini-2.5-flash")
+        if model.startswith("models/"):
+            model = model[len("models/"):]
+        if stream:
+            url = f"{base_url}/models/{model}:streamGenerateContent?alt=sse"
+        else:
+            url = f"{base_url}/models/{model}:generateContent"
+        headers = {
+            "x-goog-api-key": api_key,
+            "Content-Type": "application/json",
+        }
+        # 流式和非流式的请求体相同，按默认选项区分（不同上游可能配置了不同的思考预算和安全设置）
+        key = (self.name,) + tuple(sorted(self.options.items()))
+        content = payload.body(key, lambda data: dumps_bytes(build_gemini_request(data, self.options)))
+        return client.build_request("POST", url, headers=headers, content=content, timeout=timeout)
+
+    async def read_completion_body(self, response: httpx.Response,
+                                   model: str = "") -> Tuple[Optional[StreamAggregator], bytes]:
+        """读取generateContent的响应并聚合为OpenAI格式；响应不是JSON时返回(None, 响应体)"""
+        body = await response.aread()
+        try:
+            data = loads(body)
+        except DecodeError:
+            return None, body
+        if not isinstance(data, dict):
+            return None, body
+        aggregator = StreamAggregator()
+        event = _chunk_event(data, f"chatcmpl-{int(time.time())}", model, int(time.time()))
+        aggregator.add(event)
+        # 非流式响应的usage总是可用，即使没有finishReason
+        aggregator.usage = gemini_usage(data) or aggregator.usage
+        return aggregator, body
+
+    async def stream_events(self, response: httpx.Response, model: str = "") -> AsyncIterator[ChunkEvent]:
+        """把streamGenerateContent的SSE事件逐个转换为OpenAI格式的ChunkEvent"""
+        response_id = f"chatcmpl-{int(time.time())}"
+        created = int(time.time())
+        decoder = SSEDecoder()
+
+        def convert(raws: List[str]) -> List[ChunkEvent]:
+            events = []
+            for raw in raws:
+                try:
+                    data = loads(raw)
+                except DecodeError:
+                    continue
+                if isinstance(data, dict):
+                    events.append(_chunk_event(data, response_id, model, created))
+            return events
+
+        async for chunk in response.aiter_bytes():
+            for event in convert(decoder.feed(chunk)):
+                yield event
+        for event in convert(decoder.flush()):
+            yield event
+
+
+def create_backend(protocol: str, gemini_options: Optional[Dict[str, Any]] = None):
+    """按协议名创建后端，未知协议使用openai"""
+    if protocol == BACKEND_GEMINI:
+        return GeminiBackend(gemini_options)
+    if protocol != BACKEND_OPENAI:
+        logger.warning(f"未知的上游协议 {protocol}，使用openai")
+    return OpenAIBackend()
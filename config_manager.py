@@ -7,8 +7,14 @@
 
 import os
 import json
+import logging
+import threading
 import configparser
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Optional
+
+from config_snapshot import ConfigSnapshot, file_stamp
+
+logger = logging.getLogger(__name__)
 
 class ConfigManager:
     """配置文件管理器"""
@@ -22,12 +28,18 @@ class ConfigManager:
         """
         self.config_file = config_file
         self.config = configparser.ConfigParser()
+        # 请求处理读取的只读配置快照，每次加载或保存配置时整体替换
+        self.snapshot: Optional[ConfigSnapshot] = None
+        self._version = 0
+        self._stamp = None
+        self._lock = threading.RLock()
         self.load_config()
     
     def load_config(self):
         """加载配置文件"""
         if os.path.exists(self.config_file):
             self.config.read(self.config_file, encoding='utf-8')
+            self.publish()
         else:
             # 创建默认配置
             self.create_default_config()
@@ -65,8 +77,167 @@ class ConfigManager:
             ])
         }
         
+        # protocol为openai时使用OpenAI兼容接口，为gemini时直接调用原生generateContent接口
         self.config['API'] = {
-            'base_url': 'https://generativelanguage.googleapis.com/v1beta'
+            'base_url': 'https://generativelanguage.googleapis.com/v1beta',
+            'protocol': 'openai'
+        }
+        
+        self.config['UPSTREAM'] = {
+            'max_connections': '100',
+            'max_keepalive_connections': '20',
+            'keepalive_expiry': '30',
+            'http2': 'false'
+        }
+        
+        self.config['STREAM'] = {
+            'mode': 'passthrough'
+        }
+        
+        self.config['FANOUT'] = {
+            'mode': 'all',
+            'hedge_delay': 'auto',
+            'hedge_percentile': '90',
+            'hedge_delay_initial': '5',
+            'hedge_delay_min': '0.5',
+            'hedge_delay_max': '30'
+        }
+        
+        self.config['SCHEDULER'] = {
+            'rpm': '0',
+            'tpm': '0',
+            'rpd': '0',
+            'max_in_flight': '0',
+            'fanout_width': 'auto',
+            'overrides': '{}'
+        }
+        
+        self.config['BREAKER'] = {
+            'cooldown_base': '5',
+            'cooldown_max': '300',
+            'quarantine_invalid': 'true'
+        }
+        
+        self.config['SELECTION'] = {
+            'policy': 'first_valid',
+            'deadline': '15',
+            'best_of': '0',
+            'fallback_short': 'true',
+            'scorer': 'length'
+        }
+        
+        self.config['CACHE'] = {
+            'enabled': 'true',
+            'deterministic_only': 'true',
+            'ttl': '3600',
+            'max_entries': '1000',
+            'max_bytes': '67108864',
+            'max_entry_bytes': '1048576',
+            'disk_path': '',
+            'disk_max_entries': '10000'
+        }
+        
+        self.config['COALESCE'] = {
+            'enabled': 'true',
+            'follower_timeout': '120'
+        }
+        
+        self.config['ADMISSION'] = {
+            'max_concurrent': '64',
+            'max_queue': '128',
+            'max_queue_time': '10'
+        }
+        
+        # 每个租户一行: 租户名 = {"key": "客户端密钥", "weight": 1, "rpm": 0, "tpm": 0, "rpd": 0, "priority": "interactive"}
+        self.config['TENANTS'] = {}
+        
+        self.config['PRIORITY'] = {
+            'default_lane': 'interactive',
+            'batch_reserve': '0.2',
+            'batch_share': '0.5',
+            'batch_fanout_width': '1',
+            'batch_max_queue_time': '60'
+        }
+        
+        # 每个上游一行: 名称 = {"base_url": "https://...", "keys": ["..."], "path": "/openai/chat/completions",
+        #                       "protocol": "gemini", "thinking_budget": 1024}
+        # 不配置时使用[API]中的base_url；某个上游不写keys时使用主密钥池，不写protocol时使用[API]的protocol
+        self.config['UPSTREAMS'] = {}
+        
+        self.config['ROUTING'] = {
+            'ewma_alpha': '0.2',
+            'error_penalty': '4',
+            'failover_error_rate': '0.5',
+            'probe_interval': '30'
+        }
+        
+        # 原生Gemini接口的默认参数，客户端可以在请求体中用thinking_budget、reasoning_effort、
+        # include_thoughts、safety_settings按请求覆盖
+        self.config['GEMINI'] = {
+            'thinking_budget': '',
+            'include_thoughts': 'false',
+            'safety_threshold': ''
+        }
+        
+        self.config['WARMUP'] = {
+            'enabled': 'true',
+            'connections': '2',
+            'idle_rewarm': '25',
+            'dns_ttl': '300',
+            'timeout': '10',
+            'method': 'HEAD',
+            'path': '/'
+        }
+        
+        # 伪流式节奏: slices平均切分为slices段，段间等待frame_delay秒；instant一次性发送；
+        # fixed每帧frame_bytes字节，帧间等待frame_delay秒；
+        # rate按tokens_per_second的速率每frame_interval秒发送一帧，总时长不超过max_duration秒
+        self.config['PACING'] = {
+            'mode': 'slices',
+            'slices': '50',
+            'frame_bytes': '256',
+            'frame_delay': '0.01',
+            'tokens_per_second': '100',
+            'frame_interval': '0.05',
+            'max_duration': '2',
+            'coalesce_bytes': '4096'
+        }
+        
+        # JSON编解码后端: auto时优先使用orjson，其次msgspec，都未安装时使用标准库json
+        self.config['JSON'] = {
+            'backend': 'auto'
+        }
+        
+        # 配置热加载: 每隔watch_interval秒检查配置文件的修改时间，变化时重新加载（0为不检查）
+        self.config['RELOAD'] = {
+            'watch_interval': '2'
+        }
+        
+        # 管理接口: token为空时使用服务器的api_key；平滑关闭时最多等待drain_timeout秒
+        self.config['ADMIN'] = {
+            'token': '',
+            'drain_timeout': '30'
+        }
+        
+        # 多工作进程: count个uvicorn工作进程共用端口，count大于1时通过state_path的SQLite账本
+        # 每隔sync_interval秒交换密钥用量、并发数、熔断状态和租户额度的用量；
+        # [ADMISSION]的max_concurrent和max_queue是整个实例的上限，按count平分给各工作进程
+        self.config['WORKERS'] = {
+            'count': '1',
+            'state_path': 'key_state.db',
+            'sync_interval': '0.5'
+        }
+        
+        # 集群模式: 多个代理实例（例如服务器和几台Termux手机）共用同一组密钥时，
+        # 通过支持Redis协议的服务器共享密钥用量、冷却、隔离状态和租户额度；服务器不可用时各实例独立运行。
+        # 准入控制（[ADMISSION]）保护的是单个实例，每个实例各自按自己的上限执行
+        self.config['CLUSTER'] = {
+            'enabled': 'false',
+            'backend_url': 'redis://127.0.0.1:6379/0',
+            'key_prefix': 'llm_proxy',
+            'instance': '',
+            'sync_interval': '1',
+            'timeout': '2'
         }
         
         self.save_config()
@@ -75,6 +246,36 @@ class ConfigManager:
         """保存配置到文件"""
         with open(self.config_file, 'w', encoding='utf-8') as f:
             self.config.write(f)
+        self.publish()
+    
+    def publish(self):
+        """按当前配置生成新的只读快照并整体替换；请求处理只读取快照，不再解析配置"""
+        with self._lock:
+            self._stamp = file_stamp(self.config_file)
+            self._version += 1
+            self.snapshot = ConfigSnapshot(self, self._version)
+    
+    def reload_if_changed(self, force: bool = False) -> bool:
+        """
+        配置文件的修改时间或大小变化（force为True时无论是否变化）时重新加载并替换快照，返回是否重新加载。
+        新配置无法解析时保留原来的配置和快照，直到文件再次变化。
+        """
+        with self._lock:
+            stamp = file_stamp(self.config_file)
+            if stamp is None or (stamp == self._stamp and not force):
+                return False
+            previous = self.config
+            self.config = configparser.ConfigParser()
+            try:
+                self.config.read(self.config_file, encoding='utf-8')
+                self.publish()
+            except Exception as e:
+                self.config = previous
+                self._stamp = stamp
+                logger.error(f"重新加载配置文件失败，继续使用原配置: {e}")
+                return False
+            logger.info(f"已重新加载配置文件 (版本 {self._version})")
+            return True
     
     def get_server_config(self) -> Dict[str, Any]:
         """获取服务器配置"""
@@ -117,6 +318,286 @@ class ConfigManager:
         """设置基础URL"""
         self.config['API']['base_url'] = base_url
         self.save_config()
+    
+    def get_api_protocol(self) -> str:
+        """获取上游协议：openai（OpenAI兼容接口）或gemini（原生generateContent接口）"""
+        return self.config.get('API', 'protocol', fallback='openai').strip().lower() or 'openai'
+    
+    def get_upstream_config(self) -> Dict[str, Any]:
+        """获取上游连接池配置（旧配置文件缺少该节时使用默认值）"""
+        return {
+            'max_connections': self.config.getint('UPSTREAM', 'max_connections', fallback=100),
+            'max_keepalive_connections': self.config.getint('UPSTREAM', 'max_keepalive_connections', fallback=20),
+            'keepalive_expiry': self.config.getfloat('UPSTREAM', 'keepalive_expiry', fallback=30.0),
+            'http2': self.config.getboolean('UPSTREAM', 'http2', fallback=False)
+        }
+    
+    def get_stream_mode(self) -> str:
+        """获取流式模式: passthrough(真流式转发) 或 fake(完整响应后伪流式)"""
+        mode = self.config.get('STREAM', 'mode', fallback='passthrough').strip().lower()
+        return mode if mode in ('passthrough', 'fake') else 'passthrough'
+    
+    def get_scheduler_config(self) -> Dict[str, Any]:
+        """
+        获取密钥调度配置
+        
+        rpm/tpm/rpd/max_in_flight为每个密钥的限额，0表示不限制；
+        overrides为按完整密钥或末4位覆盖限额的JSON；
+        fanout_width为每个请求最多使用的密钥数，auto表示密钥池的一半。
+        """
+        fanout_width = self.config.get('SCHEDULER', 'fanout_width', fallback='auto').strip().lower()
+        return {
+            'limits': {
+                'rpm': self.config.getint('SCHEDULER', 'rpm', fallback=0),
+                'tpm': self.config.getint('SCHEDULER', 'tpm', fallback=0),
+                'rpd': self.config.getint('SCHEDULER', 'rpd', fallback=0),
+                'max_in_flight': self.config.getint('SCHEDULER', 'max_in_flight', fallback=0)
+            },
+            'overrides': json.loads(self.config.get('SCHEDULER', 'overrides', fallback='{}')),
+            'fanout_width': None if fanout_width == 'auto' else int(fanout_width)
+        }
+    
+    def get_breaker_config(self) -> Dict[str, Any]:
+        """
+        获取密钥熔断配置
+        
+        429和5xx错误后密钥冷却cooldown_base秒，连续失败时冷却时间翻倍，最长cooldown_max秒；
+        quarantine_invalid为true时，无效密钥（401/403/API_KEY_INVALID）被永久隔离。
+        """
+        return {
+            'cooldown_base': self.config.getfloat('BREAKER', 'cooldown_base', fallback=5.0),
+            'cooldown_max': self.config.getfloat('BREAKER', 'cooldown_max', fallback=300.0),
+            'quarantine_invalid': self.config.getboolean('BREAKER', 'quarantine_invalid', fallback=True)
+        }
+    
+    def get_selection_config(self) -> Dict[str, Any]:
+        """
+        获取响应选择配置
+        
+        policy为first_valid时返回第一个满足最小长度的响应；为best_of时在deadline秒内
+        收集最多best_of个（0为不限）满足条件的响应，按scorer评分选出最佳；
+        fallback_short为true时，没有满足条件的响应则返回评分最高的过短响应而不是503。
+        """
+        policy = self.config.get('SELECTION', 'policy', fallback='first_valid').strip().lower()
+        return {
+            'policy': policy if policy in ('first_valid', 'best_of') else 'first_valid',
+            'deadline': self.config.getfloat('SELECTION', 'deadline', fallback=15.0),
+            'best_of': self.config.getint('SELECTION', 'best_of', fallback=0),
+            'fallback_short': self.config.getboolean('SELECTION', 'fallback_short', fallback=True),
+            'scorer': self.config.get('SELECTION', 'scorer', fallback='length').strip()
+        }
+    
+    def get_cache_config(self) -> Dict[str, Any]:
+        """
+        获取响应缓存配置
+        
+        deterministic_only为true时只缓存temperature为0的请求；
+        max_bytes/max_entry_bytes限制内存层的总字节数和单条大小；
+        disk_path不为空时启用SQLite磁盘层，重启后缓存仍然有效。
+        """
+        return {
+            'enabled': self.config.getboolean('CACHE', 'enabled', fallback=True),
+            'deterministic_only': self.config.getboolean('CACHE', 'deterministic_only', fallback=True),
+            'ttl': self.config.getfloat('CACHE', 'ttl', fallback=3600.0),
+            'max_entries': self.config.getint('CACHE', 'max_entries', fallback=1000),
+            'max_bytes': self.config.getint('CACHE', 'max_bytes', fallback=64 * 1024 * 1024),
+            'max_entry_bytes': self.config.getint('CACHE', 'max_entry_bytes', fallback=1024 * 1024),
+            'disk_path': self.config.get('CACHE', 'disk_path', fallback='').strip(),
+            'disk_max_entries': self.config.getint('CACHE', 'disk_max_entries', fallback=10000)
+        }
+    
+    def get_coalesce_config(self) -> Dict[str, Any]:
+        """
+        获取请求合并配置
+        
+        enabled为true时，同时到达的相同请求只向上游扇出一次并共享结果；
+        follower_timeout为等待共享结果的最长秒数，超时后单独发起请求。
+        """
+        return {
+            'enabled': self.config.getboolean('COALESCE', 'enabled', fallback=True),
+            'follower_timeout': self.config.getfloat('COALESCE', 'follower_timeout', fallback=120.0)
+        }
+    
+    def get_admission_config(self) -> Dict[str, Any]:
+        """
+        获取准入控制配置
+        
+        max_concurrent为同时向上游扇出的请求上限（0表示不限制）；超出的请求最多
+        max_queue个排队等待，排队超过max_queue_time秒或队列已满时返回429。
+        """
+        return {
+            'max_concurrent': self.config.getint('ADMISSION', 'max_concurrent', fallback=64),
+            'max_queue': self.config.getint('ADMISSION', 'max_queue', fallback=128),
+            'max_queue_time': self.config.getfloat('ADMISSION', 'max_queue_time', fallback=10.0)
+        }
+    
+    def get_tenants_config(self) -> Dict[str, Dict[str, Any]]:
+        """
+        获取租户配置
+        
+        [TENANTS]中每一项为租户名和JSON：key为客户端密钥，weight为排队时的调度权重，
+        rpm/tpm/rpd为该租户的额度（0表示不限制），priority为该租户请求默认使用的通道。服务器的api_key始终作为default租户可用。
+        """
+        if not self.config.has_section('TENANTS'):
+            return {}
+        return {name: json.loads(value) for name, value in self.config.items('TENANTS')}
+    
+    def get_priority_config(self) -> Dict[str, Any]:
+        """
+        获取优先级通道配置
+        
+        default_lane为没有通过请求头或租户指定优先级时使用的通道（interactive或batch）。
+        batch请求不能占用每个密钥最后batch_reserve比例的额度，最多占用batch_share比例的
+        准入名额，每次最多使用batch_fanout_width个密钥（0表示与交互请求相同），
+        排队最多等待batch_max_queue_time秒。
+        """
+        default_lane = self.config.get('PRIORITY', 'default_lane', fallback='interactive').strip().lower()
+        return {
+            'default_lane': default_lane if default_lane in ('interactive', 'batch') else 'interactive',
+            'batch_reserve': min(1.0, max(0.0, self.config.getfloat('PRIORITY', 'batch_reserve', fallback=0.2))),
+            'batch_share': min(1.0, max(0.0, self.config.getfloat('PRIORITY', 'batch_share', fallback=0.5))),
+            'batch_fanout_width': self.config.getint('PRIORITY', 'batch_fanout_width', fallback=1),
+            'batch_max_queue_time': self.config.getfloat('PRIORITY', 'batch_max_queue_time', fallback=60.0)
+        }
+    
+    def get_upstreams_config(self) -> Dict[str, Dict[str, Any]]:
+        """
+        获取多上游配置
+        
+        [UPSTREAMS]中每一项为上游名称和JSON：base_url为上游接口的地址，keys为该上游的
+        密钥池（省略时使用主密钥池），path为OpenAI兼容聊天接口的路径，protocol为openai或gemini，
+        thinking_budget、include_thoughts、safety_threshold覆盖[GEMINI]中的默认值。
+        没有配置时只使用[API]中的base_url。
+        """
+        if not self.config.has_section('UPSTREAMS'):
+            return {}
+        return {name: json.loads(value) for name, value in self.config.items('UPSTREAMS')}
+    
+    def get_routing_config(self) -> Dict[str, Any]:
+        """
+        获取上游路由配置
+        
+        ewma_alpha为首字节耗时和错误率移动平均的权重；排序分数为首字节耗时乘以
+        (1 + error_penalty × 错误率)，错误率达到failover_error_rate的上游排在健康上游之后；
+        超过probe_interval秒没有样本的上游会收到一个探测请求。
+        """
+        return {
+            'ewma_alpha': min(1.0, max(0.01, self.config.getfloat('ROUTING', 'ewma_alpha', fallback=0.2))),
+            'error_penalty': self.config.getfloat('ROUTING', 'error_penalty', fallback=4.0),
+            'failover_error_rate': self.config.getfloat('ROUTING', 'failover_error_rate', fallback=0.5),
+            'probe_interval': self.config.getfloat('ROUTING', 'probe_interval', fallback=30.0)
+        }
+    
+    def get_gemini_config(self) -> Dict[str, Any]:
+        """
+        获取原生Gemini接口的默认参数
+        
+        thinking_budget为思考预算（token数），留空时使用模型的默认值；include_thoughts为true时
+        以reasoning_content返回思考摘要；safety_threshold（如BLOCK_NONE）应用到所有安全类别，留空时不设置。
+        """
+        thinking_budget = self.config.get('GEMINI', 'thinking_budget', fallback='').strip()
+        return {
+            'thinking_budget': int(thinking_budget) if thinking_budget else None,
+            'include_thoughts': self.config.getboolean('GEMINI', 'include_thoughts', fallback=False),
+            'safety_threshold': self.config.get('GEMINI', 'safety_threshold', fallback='').strip()
+        }
+    
+    def get_warmup_config(self) -> Dict[str, Any]:
+        """
+        获取连接预热配置
+        
+        启动时解析每个上游的地址并建立connections个keep-alive连接；超过idle_rewarm秒
+        没有上游请求时重新预热（应小于[UPSTREAM] keepalive_expiry，为0时只在启动时预热）。
+        dns_ttl为DNS缓存秒数，为0时不缓存。method和path为预热请求的方法和路径（默认HEAD /）；
+        method为CONNECT时不发送请求，只完成TCP/TLS握手（连接不会留在连接池中）。
+        """
+        path = self.config.get('WARMUP', 'path', fallback='/').strip() or '/'
+        return {
+            'enabled': self.config.getboolean('WARMUP', 'enabled', fallback=True),
+            'connections': max(1, self.config.getint('WARMUP', 'connections', fallback=2)),
+            'idle_rewarm': max(0.0, self.config.getfloat('WARMUP', 'idle_rewarm', fallback=25.0)),
+            'dns_ttl': max(0.0, self.config.getfloat('WARMUP', 'dns_ttl', fallback=300.0)),
+            'timeout': self.config.getfloat('WARMUP', 'timeout', fallback=10.0),
+            'method': self.config.get('WARMUP', 'method', fallback='HEAD').strip().upper() or 'HEAD',
+            'path': path if path.startswith('/') else '/' + path
+        }
+    
+    def get_pacing_config(self) -> Dict[str, Any]:
+        """
+        获取伪流式节奏配置
+        
+        mode为slices时平均切分为slices段、段间等待frame_delay秒（默认）；为instant时完整内容一次发送；
+        为fixed时按UTF-8字节数切分；为rate时按目标token速率在词边界切分。
+        推理内容、正文和工具调用按此顺序发送，结束原因与完整响应一致。两次等待之间的增量合并为一次写入，单次写入不超过约coalesce_bytes字节。
+        客户端可以用X-Stream-Pacing请求头（如 slices:100、instant、fixed:512、rate:80）按请求选择。
+        """
+        mode = self.config.get('PACING', 'mode', fallback='slices').strip().lower()
+        return {
+            'mode': mode if mode in ('slices', 'instant', 'fixed', 'rate') else 'slices',
+            'slices': max(1, self.config.getint('PACING', 'slices', fallback=50)),
+            'frame_bytes': max(1, self.config.getint('PACING', 'frame_bytes', fallback=256)),
+            'frame_delay': max(0.0, self.config.getfloat('PACING', 'frame_delay', fallback=0.01)),
+            'tokens_per_second': max(1.0, self.config.getfloat('PACING', 'tokens_per_second', fallback=100.0)),
+            'frame_interval': max(0.001, self.config.getfloat('PACING', 'frame_interval', fallback=0.05)),
+            'max_duration': max(0.0, self.config.getfloat('PACING', 'max_duration', fallback=2.0)),
+            'coalesce_bytes': max(1, self.config.getint('PACING', 'coalesce_bytes', fallback=4096))
+        }
+    
+    def get_json_backend(self) -> str:
+        """获取JSON编解码后端: auto、orjson、msgspec或json"""
+        return self.config.get('JSON', 'backend', fallback='auto').strip().lower() or 'auto'
+    
+    def get_reload_config(self) -> Dict[str, Any]:
+        """获取配置热加载设置"""
+        return {
+            'watch_interval': max(0.0, self.config.getfloat('RELOAD', 'watch_interval', fallback=2.0))
+        }
+    
+    def get_admin_config(self) -> Dict[str, Any]:
+        """获取管理接口配置（重新加载配置、平滑关闭）"""
+        token = self.config.get('ADMIN', 'token', fallback='').strip()
+        return {
+            'token': token or self.config['SERVER']['api_key'],
+            'drain_timeout': max(0.0, self.config.getfloat('ADMIN', 'drain_timeout', fallback=30.0))
+        }
+    
+    def get_workers_config(self) -> Dict[str, Any]:
+        """获取多工作进程配置，count为auto时使用CPU核数"""
+        count = self.config.get('WORKERS', 'count', fallback='1').strip().lower()
+        return {
+            'count': (os.cpu_count() or 1) if count == 'auto' else max(1, int(count)),
+            'state_path': self.config.get('WORKERS', 'state_path', fallback='key_state.db').strip() or 'key_state.db',
+            'sync_interval': max(0.05, self.config.getfloat('WORKERS', 'sync_interval', fallback=0.5))
+        }
+    
+    def get_cluster_config(self) -> Dict[str, Any]:
+        """获取集群模式配置，instance为空时使用主机名"""
+        return {
+            'enabled': self.config.getboolean('CLUSTER', 'enabled', fallback=False),
+            'backend_url': self.config.get('CLUSTER', 'backend_url', fallback='redis://127.0.0.1:6379/0').strip(),
+            'key_prefix': self.config.get('CLUSTER', 'key_prefix', fallback='llm_proxy').strip() or 'llm_proxy',
+            'instance': self.config.get('CLUSTER', 'instance', fallback='').strip(),
+            'sync_interval': max(0.05, self.config.getfloat('CLUSTER', 'sync_interval', fallback=1.0)),
+            'timeout': max(0.1, self.config.getfloat('CLUSTER', 'timeout', fallback=2.0))
+        }
+    
+    def get_fanout_config(self) -> Dict[str, Any]:
+        """
+        获取扇出配置
+        
+        mode为all时一次性请求整组密钥；为hedge时先请求一个密钥，
+        超过hedge_delay秒仍无可用结果再逐个追加。hedge_delay为auto时按观测延迟的百分位推算。
+        """
+        mode = self.config.get('FANOUT', 'mode', fallback='all').strip().lower()
+        hedge_delay = self.config.get('FANOUT', 'hedge_delay', fallback='auto').strip().lower()
+        return {
+            'mode': mode if mode in ('all', 'hedge') else 'all',
+            'hedge_delay': None if hedge_delay == 'auto' else float(hedge_delay),
+            'hedge_percentile': self.config.getfloat('FANOUT', 'hedge_percentile', fallback=90.0),
+            'hedge_delay_initial': self.config.getfloat('FANOUT', 'hedge_delay_initial', fallback=5.0),
+            'hedge_delay_min': self.config.getfloat('FANOUT', 'hedge_delay_min', fallback=0.5),
+            'hedge_delay_max': self.config.getfloat('FANOUT', 'hedge_delay_max', fallback=30.0)
+        }
 
 # 全局配置管理器实例
 config_manager = ConfigManager()
\ No newline at end of file
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+配置快照模块
+ConfigManager把配置文件一次性解析为只读的ConfigSnapshot，请求处理只读取当前快照，不再解析配置；
+配置文件被修改（按修改时间轮询）或通过Web控制台保存时，重新解析并整体替换快照
+"""
+
+import asyncio
+import logging
+import os
+import time
+from typing import Any, Callable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 快照字段 -> ConfigManager中对应的getter；缺少的getter（例如config_manager.py没有web_port）不影响其他字段
+SNAPSHOT_FIELDS = {
+    'server': 'get_server_config',
+    'api_keys': 'get_api_keys',
+    'base_url': 'get_base_url',
+    'protocol': 'get_api_protocol',
+    'upstream': 'get_upstream_config',
+    'stream_mode': 'get_stream_mode',
+    'scheduler': 'get_scheduler_config',
+    'fanout': 'get_fanout_config',
+    'breaker': 'get_breaker_config',
+    'selection': 'get_selection_config',
+    'cache': 'get_cache_config',
+    'coalesce': 'get_coalesce_config',
+    'admission': 'get_admission_config',
+    'tenants': 'get_tenants_config',
+    'priority': 'get_priority_config',
+    'upstreams': 'get_upstreams_config',
+    'routing': 'get_routing_config',
+    'gemini': 'get_gemini_config',
+    'warmup': 'get_warmup_config',
+    'pacing': 'get_pacing_config',
+    'json_backend': 'get_json_backend',
+    'reload': 'get_reload_config',
+    'admin': 'get_admin_config',
+    'workers': 'get_workers_config',
+    'cluster': 'get_cluster_config',
+}
+
+
+class ConfigSnapshot:
+    """
+    某一时刻解析好的完整配置。
+
+    快照创建后不能修改属性；各字段的字典被所有请求共享，使用方需要修改时应先复制
+    （例如resolve_pacing）。version每次重新加载加一，依赖配置的对象可以据此判断是否需要重建。
+    """
+
+    __slots__ = ('version', 'loaded_at') + tuple(SNAPSHOT_FIELDS)
+
+    def __init__(self, manager: Any, version: int):
+        object.__setattr__(self, 'version', version)
+        object.__setattr__(self, 'loaded_at', time.time())
+        for field, getter in SNAPSHOT_FIELDS.items():
+            method = getattr(manager, getter, None)
+            object.__setattr__(self, field, method() if method is not None else None)
+
+    def __setattr__(self, name: str, value: Any):
+        raise AttributeError("配置快照是只读的，请修改配置文件或通过ConfigManager保存")
+
+    def __delattr__(self, name: str):
+        raise AttributeError("配置快照是只读的")
+
+
+def file_stamp(path: str) -> Optional[Tuple[int, int]]:
+    """配置文件的(修改时间, 大小)，文件不存在时返回None"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+async def watch_config(manager: Any, on_reload: Optional[Callable[[ConfigSnapshot], None]] = None):
+    """
+    后台任务：每隔[RELOAD] watch_interval秒检查配置文件是否变化，变化时重新加载并调用on_reload(新快照)。
+    watch_interval为0时只在通过ConfigManager保存时更新快照。
+    """
+    while True:
+        interval = manager.snapshot.reload['watch_interval']
+        if interval <= 0:
+            await asyncio.sleep(60)
+            continue
+        await asyncio.sleep(interval)
+        try:
+            if await asyncio.to_thread(manager.reload_if_changed) and on_reload is not None:
+                on_reload(manager.snapshot)
+        except Exception as e:
+            logger.error(f"检查配置文件变化失败: {e}")
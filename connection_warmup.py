@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+连接预热模块
+启动时和空闲一段时间后，预先解析上游域名并建立若干个keep-alive连接，
+使重启后的第一批扇出请求不必再等待DNS解析和TLS握手；解析结果按TTL缓存在进程内。
+
+DNS缓存通过httpcore的网络后端接口（AsyncNetworkBackend）实现，httpx没有公开传入网络后端的参数，
+因此requirements.txt固定了httpcore的版本；连接池不支持替换后端时不启用DNS缓存。
+"""
+
+import asyncio
+import ipaddress
+import logging
+import socket
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import httpcore
+import httpx
+
+logger = logging.getLogger(__name__)
+
+
+def _is_ip_address(host: str) -> bool:
+    try:
+        ipaddress.ip_address(host)
+        return True
+    except ValueError:
+        return False
+
+
+class DNSCache(httpcore.AsyncNetworkBackend):
+    """
+    带缓存的网络后端：按TTL缓存域名解析结果，建立连接时直接连接缓存的地址。
+
+    TLS的SNI和证书校验仍使用原始域名；缓存的所有地址都连接失败时清除该条目，下次重新解析。
+    """
+
+    def __init__(self, ttl: float, backend: Optional[httpcore.AsyncNetworkBackend] = None):
+        self.ttl = ttl
+        self.backend = backend or httpcore.AnyIOBackend()
+        # (域名, 端口) -> (地址列表, 过期时间)
+        self._entries: Dict[Tuple[str, int], Tuple[List[str], float]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def resolve(self, host: str, port: int, timeout: Optional[float] = None) -> List[str]:
+        """返回域名的地址列表，缓存未过期时不再解析"""
+        now = time.monotonic()
+        entry = self._entries.get((host, port))
+        if entry is not None and entry[1] > now:
+            self.hits += 1
+            return entry[0]
+
+        self.misses += 1
+        loop = asyncio.get_running_loop()
+        try:
+            infos = await asyncio.wait_for(
+                loop.getaddrinfo(host, port, type=socket.SOCK_STREAM), timeout)
+        except asyncio.TimeoutError as e:
+            raise httpcore.ConnectTimeout(f"解析 {host} 超时") from e
+        except OSError as e:
+            raise httpcore.ConnectError(f"解析 {host} 失败: {e}") from e
+
+        addresses = list(dict.fromkeys(info[4][0] for info in infos))
+        self._entries[(host, port)] = (addresses, now + self.ttl)
+        return addresses
+
+    def invalidate(self, host: str, port: int):
+        self._entries.pop((host, port), None)
+
+    async def connect_tcp(self, host: str, port: int, timeout: Optional[float] = None,
+                          local_address: Optional[str] = None,
+                          socket_options: Optional[Iterable[Any]] = None) -> httpcore.AsyncNetworkStream:
+        if _is_ip_address(host):
+            return await self.backend.connect_tcp(host, port, timeout, local_address, socket_options)
+
+        last_error: Optional[Exception] = None
+        for address in await self.resolve(host, port, timeout):
+            try:
+                return await self.backend.connect_tcp(address, port, timeout, local_address, socket_options)
+            except (httpcore.ConnectError, httpcore.ConnectTimeout) as e:
+                last_error = e
+        self.invalidate(host, port)
+        raise last_error or httpcore.ConnectError(f"{host} 没有可用的地址")
+
+    async def connect_unix_socket(self, path: str, timeout: Optional[float] = None,
+                                  socket_options: Optional[Iterable[Any]] = None) -> httpcore.AsyncNetworkStream:
+        return await self.backend.connect_unix_socket(path, timeout, socket_options)
+
+    async def sleep(self, seconds: float) -> None:
+        await self.backend.sleep(seconds)
+
+    def snapshot(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": {
+                f"{host}:{port}": {"addresses": addresses, "expires_in": round(max(0.0, expires - now), 1)}
+                for (host, port), (addresses, expires) in self._entries.items()
+            },
+        }
+
+
+class WarmableTransport(httpx.AsyncHTTPTransport):
+    """可以查看连接池状态、并可选使用DNSCache的httpx传输层"""
+
+    def __init__(self, dns_cache: Optional[DNSCache] = None, **kwargs):
+        super().__init__(**kwargs)
+        self.dns_cache = None
+        # httpx没有公开网络后端的参数，只能替换连接池使用的后端（httpcore版本见requirements.txt）；
+        # 代理连接池同样适用（缓存代理地址）
+        pool = getattr(self, "_pool", None)
+        if dns_cache is not None:
+            if isinstance(pool, httpcore.AsyncConnectionPool) and hasattr(pool, "_network_backend"):
+                pool._network_backend = dns_cache
+                self.dns_cache = dns_cache
+            else:
+                logger.warning("当前httpx/httpcore版本不支持替换网络后端，不启用DNS缓存")
+
+    def pool_status(self, url: str) -> Dict[str, int]:
+        """某个上游源站当前的连接数和空闲（可立即复用）连接数"""
+        pool = self._pool
+        if not isinstance(pool, httpcore.AsyncConnectionPool):
+            return {"open": 0, "idle": 0}
+        parts = urlsplit(url)
+        origin = httpcore.Origin(parts.scheme.encode("ascii"), parts.hostname.encode("ascii"),
+                                 parts.port or (443 if parts.scheme == "https" else 80))
+        connections = [connection for connection in pool.connections
+                       if connection.can_handle_request(origin) and not connection.is_closed()]
+        return {
+            "open": len(connections),
+            "idle": sum(1 for connection in connections if connection.is_idle()),
+        }
+
+
+def _origin(url: str) -> str:
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+# 只建立TCP/TLS连接、不发送HTTP请求的预热方式
+WARMUP_CONNECT = "CONNECT"
+
+# 预热请求的扩展标记，on_request据此不把预热计入上游活动
+WARMUP_EXTENSION = "llm_proxy_warmup"
+
+
+class ConnectionWarmer:
+    """
+    上游连接预热。
+
+    预热时向每个上游源站并发发送connections个预热请求（默认HEAD /，可配置方法和路径），迫使连接池建立
+    相应数量的连接，响应结束后这些连接留在池中供后续请求复用；响应状态码不重要，只要连接建立成功即可。
+    method为CONNECT时不发送任何请求，只解析地址并完成一次TCP/TLS握手后关闭，用于不接受额外请求的上游，
+    此时连接不会留在池中。超过idle_rewarm秒没有上游请求时重新预热，使连接在空闲期间也不会过期。
+    """
+
+    def __init__(self, warmup_config: Dict[str, Any]):
+        self.transport: Optional[WarmableTransport] = None
+        self.max_keepalive: Optional[int] = None
+        self.last_activity = time.monotonic()
+        self.last_warm: Optional[float] = None
+        self.warm_count = 0
+        self.warming = False
+        # 源站 -> 最近一次预热的结果
+        self.results: Dict[str, Dict[str, Any]] = {}
+        self.configure(warmup_config)
+
+    def configure(self, warmup_config: Dict[str, Any]):
+        self.enabled = warmup_config['enabled']
+        self.connections = warmup_config['connections']
+        self.idle_rewarm = warmup_config['idle_rewarm']
+        self.dns_ttl = warmup_config['dns_ttl']
+        self.timeout = warmup_config['timeout']
+        self.method = warmup_config['method']
+        self.path = warmup_config['path']
+
+    def create_transport(self, limits: httpx.Limits, http2: bool) -> WarmableTransport:
+        """创建上游客户端使用的传输层，dns_ttl大于0时启用DNS缓存"""
+        dns_cache = DNSCache(self.dns_ttl) if self.dns_ttl > 0 else None
+        self.transport = WarmableTransport(dns_cache=dns_cache, limits=limits, http2=http2)
+        self.max_keepalive = limits.max_keepalive_connections
+        return self.transport
+
+    async def on_request(self, request: httpx.Request):
+        """httpx请求事件钩子：记录上游活动时间，预热请求本身不计入"""
+        if not request.extensions.get(WARMUP_EXTENSION):
+            self.last_activity = time.monotonic()
+
+    async def _connect_only(self, origin: str):
+        """只解析地址并完成TCP/TLS握手，不发送HTTP请求"""
+        parts = urlsplit(origin)
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        dns_cache = self.transport.dns_cache if self.transport is not None else None
+        backend = dns_cache or httpcore.AnyIOBackend()
+        stream = await backend.connect_tcp(parts.hostname, port, self.timeout)
+        try:
+            if parts.scheme == "https":
+                stream = await stream.start_tls(httpx.create_ssl_context(), parts.hostname, self.timeout)
+        finally:
+            await stream.aclose()
+
+    def _send_warmup(self, client: httpx.AsyncClient, origin: str):
+        if self.method == WARMUP_CONNECT:
+            return self._connect_only(origin)
+        return client.request(self.method, origin + self.path, timeout=self.timeout,
+                              extensions={WARMUP_EXTENSION: True})
+
+    async def _warm_origin(self, client: httpx.AsyncClient, origin: str, connections: int):
+        started = time.monotonic()
+        result: Dict[str, Any] = {"connections": connections, "opened": 0, "error": None}
+        try:
+            dns_cache = self.transport.dns_cache if self.transport is not None else None
+            if dns_cache is not None:
+                parts = urlsplit(origin)
+                await dns_cache.resolve(parts.hostname, parts.port or (443 if parts.scheme == "https" else 80),
+                                        self.timeout)
+            responses = await asyncio.gather(
+                *(self._send_warmup(client, origin) for _ in range(connections)),
+                return_exceptions=True)
+            errors = [response for response in responses if isinstance(response, Exception)]
+            result["opened"] = len(responses) - len(errors)
+            if errors:
+                result["error"] = str(errors[0]) or type(errors[0]).__name__
+        except httpx.HTTPError as e:
+            result["error"] = str(e) or type(e).__name__
+        except httpcore.ConnectError as e:
+            result["error"] = str(e)
+        result["elapsed_ms"] = round((time.monotonic() - started) * 1000)
+        self.results[origin] = result
+        if result["error"]:
+            logger.warning(f"预热上游 {origin} 失败: {result['error']}")
+        else:
+            logger.info(f"已预热上游 {origin}: {result['opened']} 个连接, 耗时 {result['elapsed_ms']}ms")
+
+    async def warm(self, client: httpx.AsyncClient, urls: Iterable[str]):
+        """解析所有上游源站的地址并建立keep-alive连接"""
+        origins = list(dict.fromkeys(_origin(url) for url in urls if url))
+        if not self.enabled or not origins or self.warming:
+            return
+        # 每个源站最多占用keep-alive连接上限的平均份额，预热的连接不会被连接池立即关闭
+        max_keepalive = self.max_keepalive or self.connections * len(origins)
+        connections = max(1, min(self.connections, max_keepalive // len(origins)))
+        self.warming = True
+        try:
+            await asyncio.gather(*(self._warm_origin(client, origin, connections) for origin in origins))
+        finally:
+            self.warming = False
+            self.last_warm = time.monotonic()
+            self.warm_count += 1
+
+    async def run(self, get_client: Callable[[], httpx.AsyncClient], get_urls: Callable[[], Iterable[str]]):
+        """后台任务：立即预热一次，之后每当上游空闲超过idle_rewarm秒时重新预热"""
+        first = True
+        while True:
+            now = time.monotonic()
+            idle = (self.idle_rewarm > 0 and now - self.last_activity >= self.idle_rewarm
+                    and now - (self.last_warm or 0) >= self.idle_rewarm)
+            if self.enabled and (first or idle):
+                try:
+                    await self.warm(get_client(), get_urls())
+                except Exception as e:
+                    logger.error(f"预热上游连接失败: {e}")
+            first = False
+            await asyncio.sleep(self.idle_rewarm if self.idle_rewarm > 0 else 60)
+
+    def snapshot(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        origins = {}
+        for origin, result in self.results.items():
+            entry = dict(result)
+            if self.transport is not None:
+                entry.update(self.transport.pool_status(origin))
+            origins[origin] = entry
+        dns_cache = self.transport.dns_cache if self.transport is not None else None
+        return {
+            "enabled": self.enabled,
+            "warming": self.warming,
+            "warm_count": self.warm_count,
+            "last_warm_ago": None if self.last_warm is None else round(now - self.last_warm, 1),
+            "idle_for": round(now - self.last_activity, 1),
+            "origins": origins,
+            "dns": None if dns_cache is None else dns_cache.snapshot(),
+        }
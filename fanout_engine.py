@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+并发扇出引擎
+支持一次性向整组密钥扇出，或对冲请求（hedged requests）：
+先只用一个密钥请求，超过对冲延迟仍没有可用结果时再逐个追加密钥；
+收到的结果按选择策略（见selection_policy）决定返回哪一个
+"""
+
+import asyncio
+import logging
+import time
+from collections import Counter, deque
+from typing import Any, Awaitable, Callable, Iterable, Optional
+
+from selection_policy import POLICY_FIRST_VALID, SelectionPolicy
+
+logger = logging.getLogger(__name__)
+
+
+class LatencyTracker:
+    """记录最近若干次成功请求的耗时，用于推算对冲延迟"""
+
+    def __init__(self, window: int = 200):
+        self._samples = deque(maxlen=window)
+
+    def record(self, seconds: float):
+        self._samples.append(seconds)
+
+    def percentile(self, q: float) -> Optional[float]:
+        """返回第q百分位的耗时（秒），样本不足时返回None"""
+        if len(self._samples) < 5:
+            return None
+        ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, max(0, int(round(q / 100.0 * len(ordered))) - 1))
+        return ordered[index]
+
+    def __len__(self):
+        return len(self._samples)
+
+
+class FanoutStats:
+    """扇出请求的取消计数、胜出和落选计数"""
+
+    def __init__(self):
+        # 客户端在拿到响应前断开连接的次数
+        self.client_disconnects = 0
+        # 因调用方取消（客户端断开或服务关闭）而被取消的上游请求数
+        self.upstream_cancelled = 0
+        # 选出满足条件的结果 / 回退到过短结果 / 没有任何可用结果的扇出次数
+        self.winners = 0
+        self.fallback_winners = 0
+        self.no_winner = 0
+        # 落选原因 -> 上游请求数：failed失败或过短，outscored满足条件但未被选中，cancelled选出结果后被取消
+        self.losers = Counter({"failed": 0, "outscored": 0, "cancelled": 0})
+        # 一次扇出实际使用的密钥数 -> 扇出次数
+        self.keys_used = Counter()
+
+    def snapshot(self) -> dict:
+        return {
+            "client_disconnects": self.client_disconnects,
+            "upstream_cancelled": self.upstream_cancelled,
+            "winners": self.winners,
+            "fallback_winners": self.fallback_winners,
+            "no_winner": self.no_winner,
+            "losers": dict(self.losers),
+        }
+
+
+fanout_stats = FanoutStats()
+
+
+class ClientDisconnected(Exception):
+    """等待上游响应期间客户端已断开连接"""
+
+
+async def cancel_on_disconnect(awaitable: Awaitable[Any],
+                               is_disconnected: Callable[[], Awaitable[bool]],
+                               poll_interval: float = 0.25) -> Any:
+    """
+    等待awaitable完成，期间定时检查客户端是否断开；
+    一旦断开立即取消awaitable（连同其中所有未完成的上游请求）并抛出ClientDisconnected。
+    """
+    task = asyncio.ensure_future(awaitable)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=poll_interval)
+            if done:
+                return task.result()
+            if await is_disconnected():
+                fanout_stats.client_disconnects += 1
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                raise ClientDisconnected()
+    finally:
+        if not task.done():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+
+def resolve_hedge_delay(fanout_config: dict, tracker: Optional[LatencyTracker]) -> Optional[float]:
+    """
+    根据配置计算本次请求的对冲延迟。
+
+    Returns:
+        对冲延迟（秒）；扇出模式为all时返回None，表示一次性请求所有密钥
+    """
+    if fanout_config['mode'] != 'hedge':
+        return None
+
+    delay = fanout_config['hedge_delay']
+    if delay is None:
+        # auto: 按观测到的延迟百分位推算，样本不足时使用初始值
+        observed = tracker.percentile(fanout_config['hedge_percentile']) if tracker else None
+        delay = observed if observed is not None else fanout_config['hedge_delay_initial']
+    return min(max(delay, fanout_config['hedge_delay_min']), fanout_config['hedge_delay_max'])
+
+
+async def run_fanout(keys: Iterable[str],
+                     send: Callable[[str], Awaitable[Any]],
+                     is_usable: Callable[[Any], bool],
+                     hedge_delay: Optional[float] = None,
+                     discard: Optional[Callable[[Any], Awaitable[None]]] = None,
+                     tracker: Optional[LatencyTracker] = None,
+                     policy: Optional[SelectionPolicy] = None) -> Any:
+    """
+    按扇出策略向多个密钥发送请求，按选择策略返回一个结果。
+
+    Args:
+        keys: 候选密钥，按顺序使用；可以是按需分配密钥的迭代器
+        send: 使用单个密钥发送请求的协程函数
+        is_usable: 判断结果是否满足条件
+        hedge_delay: 对冲延迟（秒）；None表示一次性向所有密钥发送
+        discard: 胜出者之外仍需释放资源的结果的清理函数
+        tracker: 记录胜出请求耗时的LatencyTracker
+        policy: 响应选择策略，默认返回第一个满足条件的结果且不回退
+
+    Returns:
+        选出的结果；全部失败且没有可回退的结果时返回None
+    """
+    if policy is None:
+        policy = SelectionPolicy(POLICY_FIRST_VALID, fallback_short=False)
+
+    key_source = iter(keys)
+    exhausted = False
+    fanout_started = time.monotonic()
+    started_at = {}
+    pending = set()
+    # (结果, 耗时)：满足条件的候选和可回退的过短结果，选出胜者前都需要持有
+    candidates = []
+    fallbacks = []
+    winner = None
+    cancelled = False
+
+    def launch() -> bool:
+        nonlocal exhausted
+        if exhausted:
+            return False
+        key = next(key_source, None)
+        if key is None:
+            exhausted = True
+            return False
+        task = asyncio.create_task(send(key))
+        started_at[task] = time.monotonic()
+        pending.add(task)
+        return True
+
+    if hedge_delay is None:
+        while launch():
+            pass
+    else:
+        launch()
+
+    try:
+        while pending:
+            timeout = hedge_delay if (hedge_delay is not None and not exhausted) else None
+            if candidates:
+                # 已有满足条件的响应，最多等到截止时间再做选择
+                remaining = fanout_started + policy.deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                timeout = remaining if timeout is None else min(timeout, remaining)
+
+            done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                if launch():
+                    logger.info(f"{hedge_delay:.2f}秒内没有可用响应，已追加一个对冲请求")
+                continue
+
+            failed = 0
+            for task in done:
+                pending.discard(task)
+                if task.cancelled() or task.exception() is not None:
+                    failed += 1
+                    fanout_stats.losers["failed"] += 1
+                    continue
+                result = task.result()
+                elapsed = time.monotonic() - started_at[task]
+                if is_usable(result):
+                    candidates.append((result, elapsed))
+                    continue
+                failed += 1
+                if not (result is not None and policy.accepts_fallback(result)):
+                    fanout_stats.losers["failed"] += 1
+                if result is not None and policy.accepts_fallback(result):
+                    fallbacks.append((result, elapsed))
+                elif result is not None and discard is not None:
+                    await discard(result)
+
+            if policy.is_enough(len(candidates)):
+                break
+
+            if hedge_delay is not None:
+                # 失败的请求立即由下一个密钥补上，不必等待对冲延迟
+                for _ in range(failed):
+                    launch()
+
+        if candidates:
+            winner, elapsed = max(candidates, key=lambda item: policy.score(item[0]))
+            if tracker is not None:
+                tracker.record(elapsed)
+            fanout_stats.winners += 1
+            fanout_stats.losers["outscored"] += len(candidates) - 1
+            fanout_stats.losers["failed"] += len(fallbacks)
+            if len(candidates) > 1:
+                logger.info(f"从{len(candidates)}个满足条件的响应中按{policy.scorer_name}评分选出最佳响应")
+        elif fallbacks:
+            winner, _ = max(fallbacks, key=lambda item: policy.score(item[0]))
+            fanout_stats.fallback_winners += 1
+            fanout_stats.losers["failed"] += len(fallbacks) - 1
+            logger.warning("没有满足最小长度的响应，回退到评分最高的过短响应")
+        else:
+            fanout_stats.no_winner += 1
+        return winner
+    except asyncio.CancelledError:
+        cancelled = True
+        raise
+    finally:
+        if cancelled:
+            fanout_stats.upstream_cancelled += len(pending)
+        else:
+            fanout_stats.losers["cancelled"] += len(pending)
+        if started_at:
+            fanout_stats.keys_used[len(started_at)] += 1
+        for task in pending:
+            task.cancel()
+        # 未被选中的候选，以及函数被取消时持有的全部候选
+        leftovers = [result for result, _ in candidates + fallbacks if result is not winner]
+        if pending:
+            results = await asyncio.gather(*pending, return_exceptions=True)
+            # 取消前已经完成的结果同样需要释放
+            leftovers.extend(result for result in results
+                             if result is not None and not isinstance(result, BaseException))
+        if discard is not None:
+            for result in leftovers:
+                await discard(result)
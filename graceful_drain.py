@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+平滑关闭模块
+进入排空状态后不再接受新请求（返回503，客户端可以改连其他实例），
+等待进行中的扇出和流式响应在期限内结束，然后再退出进程
+"""
+
+import asyncio
+import hmac
+import logging
+import time
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def is_admin_authorized(headers: Any, token: str) -> bool:
+    """检查请求头中的 Authorization: Bearer <token>，使用恒定时间比较"""
+    value = headers.get("authorization") or ""
+    if not token or not value.startswith("Bearer "):
+        return False
+    return hmac.compare_digest(value[len("Bearer "):].encode("utf-8"), token.encode("utf-8"))
+
+
+class DrainController:
+    """记录进行中的请求数；排空时拒绝新请求并等待进行中的请求结束"""
+
+    def __init__(self):
+        self.draining = False
+        self.in_flight = 0
+        self.started: Optional[float] = None
+        self.deadline: Optional[float] = None
+        self._idle: Optional[asyncio.Event] = None
+
+    def enter(self) -> bool:
+        """开始处理一个请求；正在排空时返回False，请求应被拒绝"""
+        if self.draining:
+            return False
+        self.in_flight += 1
+        return True
+
+    def exit(self):
+        """一个请求（流式请求为整个响应体）结束"""
+        self.in_flight = max(0, self.in_flight - 1)
+        if self.in_flight == 0 and self._idle is not None:
+            self._idle.set()
+
+    async def drain(self, timeout: float) -> bool:
+        """
+        进入排空状态并等待进行中的请求结束，返回是否在timeout秒内全部结束。
+        重复调用时等待同一个排空过程。
+        """
+        if not self.draining:
+            self.draining = True
+            self.started = time.monotonic()
+            self.deadline = self.started + timeout
+            logger.info(f"开始平滑关闭: 不再接受新请求，等待 {self.in_flight} 个进行中的请求 (最多 {timeout:g} 秒)")
+        if self._idle is None:
+            self._idle = asyncio.Event()
+        if self.in_flight == 0:
+            self._idle.set()
+        try:
+            await asyncio.wait_for(self._idle.wait(), max(0.0, self.deadline - time.monotonic()))
+            logger.info(f"所有进行中的请求已结束，耗时 {time.monotonic() - self.started:.1f} 秒")
+            return True
+        except asyncio.TimeoutError:
+            logger.warning(f"平滑关闭超时，仍有 {self.in_flight} 个请求未结束")
+            return False
+
+    def retry_after(self) -> int:
+        """拒绝新请求时建议客户端等待的秒数（排空剩余时间）"""
+        if self.deadline is None:
+            return 1
+        return max(1, int(self.deadline - time.monotonic() + 0.999))
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "draining": self.draining,
+            "in_flight": self.in_flight,
+            "remaining": None if self.deadline is None else round(max(0.0, self.deadline - time.monotonic()), 1),
+        }
@@ -13,6 +13,8 @@ import os
 import sys
 import signal
 import time
+import urllib.error
+import urllib.request
 from config_manager import config_manager
 
 class LLMProxyGUI:
@@ -42,6 +44,10 @@ class LLMProxyGUI:
         # 服务进程
         self.server_process = None
         self.is_running = False
+        # 运行中的服务使用的管理接口地址和令牌（启动时的配置，重新加载成功后更新）
+        self.server_admin = None
+        self.stopping = False
+        self.stop_error = None
         
         # 创建GUI组件
         self.create_widgets()
@@ -287,6 +293,11 @@ class LLMProxyGUI:
             group2_keys = [key.strip() for key in self.group2_text.get(1.0, tk.END).split('\n') if key.strip()]
             config_manager.set_api_keys(group1_keys, group2_keys)
             
+            # 服务运行中时热加载新配置，不中断进行中的请求
+            if self.server_process and self.server_process.poll() is None:
+                self.reload_server()
+                return
+            
             messagebox.showinfo("成功", "配置已保存")
             
         except ValueError as e:
@@ -294,6 +305,36 @@ class LLMProxyGUI:
         except Exception as e:
             messagebox.showerror("错误", f"保存配置时发生错误: {str(e)}")
     
+    def reload_server(self):
+        """通知运行中的服务重新加载配置；请求在后台线程中发送，界面保持响应"""
+        admin_config = config_manager.get_admin_config()
+        result = {'ok': False}
+        
+        def notify():
+            result['ok'] = self.call_admin("/admin/reload", 5)
+        
+        self.status_var.set("正在通知运行中的服务重新加载配置...")
+        worker = threading.Thread(target=notify, daemon=True)
+        worker.start()
+        self.root.after(100, self.poll_reload, worker, result, admin_config)
+    
+    def poll_reload(self, worker, result, admin_config):
+        """在界面线程中轮询重新加载的后台线程，结束后提示结果"""
+        if worker.is_alive():
+            self.root.after(100, self.poll_reload, worker, result, admin_config)
+            return
+        
+        if self.stopping or self.server_admin is None:
+            # 等待期间服务已被停止
+            return
+        self.status_var.set("服务运行中...")
+        if result['ok']:
+            # 服务已使用新配置，之后的管理请求使用新的令牌
+            self.server_admin.update(admin_config)
+            messagebox.showinfo("成功", "配置已保存并已应用到运行中的服务")
+        else:
+            messagebox.showwarning("提示", "配置已保存，但未能通知运行中的服务重新加载，请重启服务")
+    
     def reset_config(self):
         """重置配置为默认值"""
         if messagebox.askyesno("确认", "确定要重置所有配置为默认值吗？"):
@@ -330,6 +371,9 @@ class LLMProxyGUI:
             self.server_process = subprocess.Popen([
                 sys.executable, "llm_proxy.py"
             ], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+            server_config = config_manager.get_server_config()
+            self.server_admin = {'host': server_config['host'], 'port': server_config['port'],
+                                 **config_manager.get_admin_config()}
             
             self.is_running = True
             self.start_button.config(text="停止服务")
@@ -344,32 +388,76 @@ class LLMProxyGUI:
         except Exception as e:
             messagebox.showerror("错误", f"启动服务失败: {str(e)}")
     
-    def stop_server(self):
-        """停止服务"""
+    def call_admin(self, path: str, timeout: float) -> bool:
+        """调用运行中服务的管理接口（使用服务启动时的地址和令牌），成功时返回True"""
+        if not self.server_admin:
+            return False
+        host = self.server_admin['host'] if self.server_admin['host'] not in ('0.0.0.0', '::') else '127.0.0.1'
+        request = urllib.request.Request(
+            f"http://{host}:{self.server_admin['port']}{path}", method="POST",
+            headers={"Authorization": f"Bearer {self.server_admin['token']}"})
         try:
-            if self.server_process:
-                # 终止进程
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                return response.status == 200
+        except (urllib.error.URLError, OSError):
+            return False
+    
+    def stop_server(self, on_stopped=None):
+        """
+        停止服务：先平滑关闭（等待进行中的请求结束），超时后再强制终止。
+        等待在后台线程中进行，界面保持响应；停止后调用on_stopped（未指定时提示服务已停止）。
+        """
+        if self.stopping:
+            return
+        self.stopping = True
+        self.start_button.config(state='disabled')
+        self.status_var.set("正在停止服务，等待进行中的请求结束...")
+        worker = threading.Thread(target=self.shutdown_process, args=(self.server_process,), daemon=True)
+        worker.start()
+        self.root.after(200, self.poll_stop, worker, on_stopped)
+    
+    def shutdown_process(self, process):
+        """后台线程：通知服务平滑关闭并等待进程结束，不访问界面组件"""
+        if process is None:
+            return
+        try:
+            drain_timeout = self.server_admin['drain_timeout'] if self.server_admin else 0
+            if not self.call_admin("/admin/drain", 5):
+                # 管理接口不可用时直接终止进程
+                drain_timeout = 0
                 if os.name == 'nt':  # Windows
-                    self.server_process.terminate()
+                    process.terminate()
                 else:  # Unix
-                    self.server_process.send_signal(signal.SIGTERM)
-                
-                # 等待进程结束
-                try:
-                    self.server_process.wait(timeout=5)
-                except subprocess.TimeoutExpired:
-                    self.server_process.kill()
-                
-                self.server_process = None
-            
-            self.is_running = False
-            self.start_button.config(text="启动服务")
-            self.status_var.set("服务已停止")
-            
-            messagebox.showinfo("成功", "服务已停止")
+                    process.send_signal(signal.SIGTERM)
             
+            # 等待进程结束
+            try:
+                process.wait(timeout=drain_timeout + 5)
+            except subprocess.TimeoutExpired:
+                process.kill()
         except Exception as e:
-            messagebox.showerror("错误", f"停止服务失败: {str(e)}")
+            self.stop_error = str(e)
+    
+    def poll_stop(self, worker, on_stopped):
+        """在界面线程中轮询停止服务的后台线程，结束后更新界面"""
+        if worker.is_alive():
+            self.root.after(200, self.poll_stop, worker, on_stopped)
+            return
+        
+        self.server_process = None
+        self.server_admin = None
+        self.stopping = False
+        self.is_running = False
+        self.start_button.config(text="启动服务", state='normal')
+        self.status_var.set("服务已停止")
+        
+        error, self.stop_error = self.stop_error, None
+        if on_stopped is not None:
+            on_stopped()
+        elif error:
+            messagebox.showerror("错误", f"停止服务失败: {error}")
+        else:
+            messagebox.showinfo("成功", "服务已停止")
     
     def update_log(self):
         """更新日志显示"""
@@ -502,8 +590,7 @@ class LLMProxyGUI:
         """窗口关闭事件"""
         if self.is_running:
             if messagebox.askyesno("确认", "服务正在运行，确定要关闭程序吗？"):
-                self.stop_server()
-                self.root.destroy()
+                self.stop_server(on_stopped=self.root.destroy)
         else:
             self.root.destroy()
 
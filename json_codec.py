@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+JSON编解码模块
+安装了orjson或msgspec时使用它们编解码请求、上游响应和SSE增量，否则使用标准库json；
+伪流式转发时每个响应的增量外壳只序列化一次，之后每个增量只编码内容本身
+"""
+
+import json
+import logging
+from typing import Any, Dict, Optional, Union
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+try:
+    import msgspec
+    MSGSPEC_AVAILABLE = True
+except ImportError:
+    MSGSPEC_AVAILABLE = False
+
+try:
+    from starlette.responses import JSONResponse
+    STARLETTE_AVAILABLE = True
+except ImportError:
+    STARLETTE_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+BACKEND_AUTO = "auto"
+BACKEND_ORJSON = "orjson"
+BACKEND_MSGSPEC = "msgspec"
+BACKEND_STDLIB = "json"
+
+# loads解析失败时可能抛出的异常（orjson的异常是ValueError的子类，msgspec的不是）
+DecodeError = (ValueError, msgspec.DecodeError) if MSGSPEC_AVAILABLE else (ValueError,)
+
+
+class _StdlibCodec:
+    name = BACKEND_STDLIB
+
+    def __init__(self):
+        self._encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+    def dumps(self, obj: Any) -> str:
+        return self._encoder.encode(obj)
+
+    def dumps_bytes(self, obj: Any) -> bytes:
+        return self._encoder.encode(obj).encode("utf-8")
+
+    def loads(self, data: Union[str, bytes]) -> Any:
+        return json.loads(data)
+
+
+class _OrjsonCodec:
+    name = BACKEND_ORJSON
+
+    def dumps(self, obj: Any) -> str:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+
+    def dumps_bytes(self, obj: Any) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+    def loads(self, data: Union[str, bytes]) -> Any:
+        return orjson.loads(data)
+
+
+class _MsgspecCodec:
+    name = BACKEND_MSGSPEC
+
+    def __init__(self):
+        self._encoder = msgspec.json.Encoder()
+        self._decoder = msgspec.json.Decoder()
+
+    def dumps(self, obj: Any) -> str:
+        return self._encoder.encode(obj).decode("utf-8")
+
+    def dumps_bytes(self, obj: Any) -> bytes:
+        return self._encoder.encode(obj)
+
+    def loads(self, data: Union[str, bytes]) -> Any:
+        return self._decoder.decode(data)
+
+
+def _create_codec(name: str):
+    if name in (BACKEND_AUTO, BACKEND_ORJSON) and ORJSON_AVAILABLE:
+        return _OrjsonCodec()
+    if name in (BACKEND_AUTO, BACKEND_MSGSPEC) and MSGSPEC_AVAILABLE:
+        return _MsgspecCodec()
+    if name not in (BACKEND_AUTO, BACKEND_STDLIB):
+        logger.warning(f"JSON后端 {name} 不可用，使用标准库json。请运行 'pip install {name}'")
+    return _StdlibCodec()
+
+
+_codec = _create_codec(BACKEND_AUTO)
+
+
+def set_backend(name: str) -> str:
+    """选择JSON后端（auto、orjson、msgspec、json），返回实际使用的后端名"""
+    global _codec
+    _codec = _create_codec((name or BACKEND_AUTO).strip().lower())
+    logger.info(f"JSON编解码后端: {_codec.name}")
+    return _codec.name
+
+
+def backend_name() -> str:
+    return _codec.name
+
+
+def dumps(obj: Any) -> str:
+    """序列化为紧凑的JSON字符串，非ASCII字符不转义"""
+    return _codec.dumps(obj)
+
+
+def dumps_bytes(obj: Any) -> bytes:
+    """序列化为UTF-8编码的JSON字节串"""
+    return _codec.dumps_bytes(obj)
+
+
+def loads(data: Union[str, bytes]) -> Any:
+    """解析JSON字符串或字节串，失败时抛出DecodeError中的异常"""
+    return _codec.loads(data)
+
+
+SSE_DONE = b"data: [DONE]\n\n"
+
+
+class ChunkEnvelope:
+    """
+    一个响应的chat.completion.chunk外壳。
+
+    id、created、model在创建时序列化一次，之后每个增量只编码delta，
+    直接拼接成完整的SSE事件字节串。
+    """
+
+    __slots__ = ("_prefix", "_content_suffix", "_finish_prefix")
+
+    def __init__(self, response_id: str, created: int, model: str):
+        self._prefix = (b'data: {"id":' + dumps_bytes(response_id)
+                        + b',"object":"chat.completion.chunk","created":' + dumps_bytes(created)
+                        + b',"model":' + dumps_bytes(model)
+                        + b',"choices":[{"index":0,"delta":')
+        self._content_suffix = b'},"finish_reason":null}]}\n\n'
+        self._finish_prefix = b',"finish_reason":'
+
+    def content(self, text: str) -> bytes:
+        """只包含content增量的事件"""
+        return self._prefix + b'{"content":' + dumps_bytes(text) + self._content_suffix
+
+    def delta(self, delta: Dict[str, Any], finish_reason: Optional[str] = None) -> bytes:
+        """任意delta（可带结束原因）的事件"""
+        return (self._prefix + dumps_bytes(delta) + self._finish_prefix
+                + dumps_bytes(finish_reason) + b'}]}\n\n')
+
+
+if STARLETTE_AVAILABLE:
+    class FastJSONResponse(JSONResponse):
+        """使用当前JSON后端序列化响应体的JSONResponse"""
+
+        def render(self, content: Any) -> bytes:
+            return dumps_bytes(content)
@@ -0,0 +1,540 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+共享密钥账本模块
+多个工作进程共用同一个密钥池时，通过账本交换各自的密钥用量（请求数、token数）、并发数和熔断状态，
+使每个进程的KeyScheduler都按整个密钥池的真实用量分配密钥。
+
+各进程只在本地记录变化，每隔sync_interval秒与后端交换一次（一次事务），请求处理路径上没有额外的IO；
+后端不可用时各进程独立运行，恢复后继续同步。账本中的密钥只保存哈希，不保存密钥本身。
+
+后端可替换：同一台机器上的工作进程使用SQLite（[WORKERS]），
+多台机器上的代理实例（集群模式，[CLUSTER]）使用支持Redis协议的服务器，测试时可以使用mock_ledger_server.py。
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import socket
+import sqlite3
+import ssl
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+from urllib.parse import unquote, urlsplit
+
+logger = logging.getLogger(__name__)
+
+# 超过这个时间没有同步的工作进程视为已退出，不再计入它的并发数
+WORKER_STALE_AFTER = 10.0
+# 用量记录保留的秒数（令牌桶最长按分钟补充，更早的记录已经没有意义）
+USAGE_RETENTION = 120.0
+
+
+# 租户额度在账本中的标识前缀，与密钥的标识共用同一组用量计数
+TENANT_PREFIX = "tenant:"
+
+
+def key_id(key: str) -> str:
+    """账本中使用的密钥标识（哈希），不把密钥本身写入共享存储"""
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class ExchangeResult:
+    """一次同步从后端拉取到的其他进程的变化"""
+
+    __slots__ = ("usage", "breakers", "in_flight", "cursor")
+
+    def __init__(self, usage: List[Tuple[str, float, float]], breakers: Dict[str, Dict[str, Any]],
+                 in_flight: Dict[str, int], cursor: Any):
+        # [(密钥标识, 请求数, token数)]，token数为负表示按实际用量退还
+        self.usage = usage
+        # 密钥标识 -> 熔断状态（state、failures、open_until为墙上时间、reason、updated、worker）
+        self.breakers = breakers
+        # 密钥标识 -> 其他存活进程的并发数之和
+        self.in_flight = in_flight
+        self.cursor = cursor
+
+
+class SQLiteLedgerBackend:
+    """
+    基于SQLite（WAL模式）的账本后端，适用于同一台机器上的多个工作进程。
+    exchange在线程池中调用，不阻塞事件循环。
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=5.0, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS ledger_usage ("
+            "seq INTEGER PRIMARY KEY AUTOINCREMENT, worker TEXT NOT NULL, key TEXT NOT NULL, "
+            "requests REAL NOT NULL, tokens REAL NOT NULL, created REAL NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS ledger_breakers ("
+            "key TEXT PRIMARY KEY, state TEXT NOT NULL, failures INTEGER NOT NULL, open_until REAL NOT NULL, "
+            "reason TEXT NOT NULL, updated REAL NOT NULL, worker TEXT NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS ledger_in_flight ("
+            "worker TEXT NOT NULL, key TEXT NOT NULL, in_flight INTEGER NOT NULL, heartbeat REAL NOT NULL, "
+            "PRIMARY KEY (worker, key));"
+        )
+
+    def exchange(self, worker: str, usage: List[Tuple[str, float, float]], breakers: Dict[str, Dict[str, Any]],
+                 in_flight: Dict[str, int], cursor: Optional[int]) -> ExchangeResult:
+        now = time.time()
+        with self._lock:
+            conn = self._conn
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if cursor is None:
+                    # 第一次同步：只接收之后的用量，之前的记录由各自的进程计入
+                    cursor = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM ledger_usage").fetchone()[0]
+                conn.executemany(
+                    "INSERT INTO ledger_usage (worker, key, requests, tokens, created) VALUES (?, ?, ?, ?, ?)",
+                    [(worker, key, requests, tokens, now) for key, requests, tokens in usage])
+                conn.executemany(
+                    "INSERT INTO ledger_breakers (key, state, failures, open_until, reason, updated, worker) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT(key) DO UPDATE SET "
+                    "state = excluded.state, failures = excluded.failures, open_until = excluded.open_until, "
+                    "reason = excluded.reason, updated = excluded.updated, worker = excluded.worker "
+                    "WHERE excluded.updated > ledger_breakers.updated",
+                    [(key, b['state'], b['failures'], b['open_until'], b['reason'], b['updated'], worker)
+                     for key, b in breakers.items()])
+                conn.execute("DELETE FROM ledger_in_flight WHERE worker = ?", (worker,))
+                conn.executemany(
+                    "INSERT INTO ledger_in_flight (worker, key, in_flight, heartbeat) VALUES (?, ?, ?, ?)",
+                    [(worker, key, count, now) for key, count in in_flight.items()] or [(worker, "", 0, now)])
+
+                rows = conn.execute(
+                    "SELECT seq, key, requests, tokens FROM ledger_usage WHERE seq > ? AND worker != ? ORDER BY seq",
+                    (cursor, worker)).fetchall()
+                cursor = max([cursor] + [row[0] for row in rows])
+                remote_breakers = {
+                    row[0]: {"state": row[1], "failures": row[2], "open_until": row[3],
+                             "reason": row[4], "updated": row[5], "worker": row[6]}
+                    for row in conn.execute(
+                        "SELECT key, state, failures, open_until, reason, updated, worker "
+                        "FROM ledger_breakers WHERE worker != ?", (worker,))
+                }
+                remote_in_flight = dict(conn.execute(
+                    "SELECT key, SUM(in_flight) FROM ledger_in_flight "
+                    "WHERE worker != ? AND heartbeat > ? AND key != '' GROUP BY key",
+                    (worker, now - WORKER_STALE_AFTER)).fetchall())
+
+                conn.execute("DELETE FROM ledger_usage WHERE created < ?", (now - USAGE_RETENTION,))
+                conn.execute("DELETE FROM ledger_in_flight WHERE heartbeat < ?", (now - WORKER_STALE_AFTER,))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return ExchangeResult([(row[1], row[2], row[3]) for row in rows], remote_breakers,
+                              remote_in_flight, cursor)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class RESPError(Exception):
+    """服务器返回的错误回复（-ERR ...）"""
+
+
+class RESPClient:
+    """
+    最小的Redis协议（RESP2）客户端，只支持管道方式批量发送命令。
+    连接在第一次使用时建立，网络错误后关闭，下次调用时重新连接。
+    """
+
+    def __init__(self, host: str, port: int = 6379, password: Optional[str] = None, db: int = 0,
+                 use_tls: bool = False, timeout: float = 2.0):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.db = db
+        self.use_tls = use_tls
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._sock: Optional[socket.socket] = None
+        self._reader: Any = None
+
+    @staticmethod
+    def _encode(command: Sequence[Any]) -> bytes:
+        parts = [b"*%d\r\n" % len(command)]
+        for argument in command:
+            data = argument if isinstance(argument, bytes) else str(argument).encode("utf-8")
+            parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        return b"".join(parts)
+
+    def _read_reply(self) -> Any:
+        line = self._reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("连接已被账本服务器关闭")
+        prefix, rest = line[:1], line[1:-2]
+        if prefix == b"+":
+            return rest.decode("utf-8")
+        if prefix == b"-":
+            return RESPError(rest.decode("utf-8", "replace"))
+        if prefix == b":":
+            return int(rest)
+        if prefix == b"$":
+            length = int(rest)
+            if length < 0:
+                return None
+            data = self._reader.read(length + 2)
+            if len(data) != length + 2:
+                raise ConnectionError("连接已被账本服务器关闭")
+            return data[:-2].decode("utf-8")
+        if prefix == b"*":
+            count = int(rest)
+            return None if count < 0 else [self._read_reply() for _ in range(count)]
+        raise ConnectionError(f"无法识别的回复: {line[:32]!r}")
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        if self.use_tls:
+            sock = ssl.create_default_context().wrap_socket(sock, server_hostname=self.host)
+        self._sock = sock
+        self._reader = sock.makefile("rb")
+        setup = []
+        if self.password:
+            setup.append(("AUTH", self.password))
+        if self.db:
+            setup.append(("SELECT", self.db))
+        if setup:
+            self._execute(setup)
+
+    def _execute(self, commands: Sequence[Sequence[Any]]) -> List[Any]:
+        self._sock.sendall(b"".join(self._encode(command) for command in commands))
+        # 先读完所有回复再检查错误，保证连接上的回复与命令一一对应
+        replies = [self._read_reply() for _ in commands]
+        for reply in replies:
+            if isinstance(reply, RESPError):
+                raise reply
+        return replies
+
+    def pipeline(self, commands: Sequence[Sequence[Any]]) -> List[Any]:
+        """一次发送多条命令并按顺序返回回复，任何一条命令出错时抛出RESPError"""
+        with self._lock:
+            try:
+                if self._sock is None:
+                    self._connect()
+                return self._execute(commands)
+            except (OSError, ValueError):
+                self._close()
+                raise
+
+    def _close(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+        self._sock = None
+        self._reader = None
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+
+def _pairs(reply: Optional[List[str]]) -> Dict[str, str]:
+    """HGETALL的回复 [字段, 值, 字段, 值...] 转换为字典"""
+    reply = reply or []
+    return dict(zip(reply[::2], reply[1::2]))
+
+
+class RedisLedgerBackend:
+    """
+    基于Redis协议的账本后端，适用于多台机器上的代理实例（集群模式）。
+
+    每个工作进程在自己的哈希中累加每个密钥的请求数和token数（HINCRBYFLOAT），其他进程按与上次读取的
+    差值计入用量；并发数和心跳定期覆盖写入，超过WORKER_STALE_AFTER秒没有心跳的进程由其他进程清理。
+    只使用HSET/HGETALL/HDEL/HINCRBYFLOAT/DEL/EXPIRE等基本命令，每次同步两次往返。
+    """
+
+    name = "redis"
+
+    def __init__(self, client: RESPClient, key_prefix: str = "llm_proxy"):
+        self.client = client
+        self.prefix = key_prefix
+
+    def exchange(self, worker: str, usage: List[Tuple[str, float, float]], breakers: Dict[str, Dict[str, Any]],
+                 in_flight: Dict[str, int], cursor: Optional[Dict[str, Dict[str, float]]]) -> ExchangeResult:
+        now = time.time()
+        prefix = self.prefix
+        usage_key = f"{prefix}:usage:{worker}"
+        in_flight_key = f"{prefix}:in_flight:{worker}"
+
+        commands: List[Tuple[Any, ...]] = []
+        for key, requests, tokens in usage:
+            if requests:
+                commands.append(("HINCRBYFLOAT", usage_key, f"{key}:r", repr(float(requests))))
+            if tokens:
+                commands.append(("HINCRBYFLOAT", usage_key, f"{key}:t", repr(float(tokens))))
+        commands.append(("HSET", f"{prefix}:workers", worker, repr(now)))
+        commands.append(("DEL", in_flight_key))
+        if in_flight:
+            fields = [item for key, count in in_flight.items() for item in (key, count)]
+            commands.append(("HSET", in_flight_key, *fields))
+            commands.append(("EXPIRE", in_flight_key, int(WORKER_STALE_AFTER)))
+        commands.append(("HGETALL", f"{prefix}:workers"))
+        commands.append(("HGETALL", f"{prefix}:breakers"))
+        replies = self.client.pipeline(commands)
+        heartbeats = _pairs(replies[-2])
+        stored_breakers = {key: json.loads(value) for key, value in _pairs(replies[-1]).items()}
+
+        live = [name for name, beat in heartbeats.items()
+                if name != worker and float(beat) > now - WORKER_STALE_AFTER]
+        stale = [name for name, beat in heartbeats.items()
+                 if name != worker and float(beat) <= now - WORKER_STALE_AFTER]
+        commands = []
+        for name in live:
+            commands.append(("HGETALL", f"{prefix}:usage:{name}"))
+            commands.append(("HGETALL", f"{prefix}:in_flight:{name}"))
+        for name in stale:
+            commands.append(("HDEL", f"{prefix}:workers", name))
+            commands.append(("DEL", f"{prefix}:usage:{name}", f"{prefix}:in_flight:{name}"))
+        for key, breaker in breakers.items():
+            if breaker['updated'] > stored_breakers.get(key, {}).get('updated', 0.0):
+                commands.append(("HSET", f"{prefix}:breakers", key, json.dumps(dict(breaker, worker=worker))))
+        replies = self.client.pipeline(commands) if commands else []
+
+        remote_usage: List[Tuple[str, float, float]] = []
+        remote_in_flight: Dict[str, int] = {}
+        next_cursor: Dict[str, Dict[str, float]] = {}
+        for index, name in enumerate(live):
+            totals = {field: float(value) for field, value in _pairs(replies[2 * index]).items()}
+            next_cursor[name] = totals
+            for key, count in _pairs(replies[2 * index + 1]).items():
+                remote_in_flight[key] = remote_in_flight.get(key, 0) + int(count)
+            if cursor is None:
+                # 第一次同步只记录各进程当前的累计值
+                continue
+            # 之前没见过的进程从启动开始的用量都是新的
+            previous = cursor.get(name, {})
+            deltas: Dict[str, List[float]] = {}
+            for field, total in totals.items():
+                key, _, kind = field.rpartition(":")
+                difference = total - previous.get(field, 0.0)
+                if difference:
+                    deltas.setdefault(key, [0.0, 0.0])[0 if kind == "r" else 1] += difference
+            remote_usage.extend((key, values[0], values[1]) for key, values in deltas.items())
+
+        remote_breakers = {key: breaker for key, breaker in stored_breakers.items() if breaker.get('worker') != worker}
+        return ExchangeResult(remote_usage, remote_breakers, remote_in_flight, next_cursor)
+
+    def close(self):
+        self.client.close()
+
+
+def create_ledger_backend(url: str, key_prefix: str = "llm_proxy", timeout: float = 2.0) -> Any:
+    """
+    按地址创建账本后端：
+    redis://[:密码@]主机[:端口][/库]、rediss://（TLS）使用Redis协议，sqlite:///路径 或文件路径使用SQLite
+    """
+    parts = urlsplit(url)
+    if parts.scheme in ("redis", "rediss"):
+        db = parts.path.strip("/")
+        client = RESPClient(parts.hostname or "127.0.0.1", parts.port or 6379,
+                            unquote(parts.password) if parts.password else None,
+                            int(db) if db else 0, parts.scheme == "rediss", timeout)
+        return RedisLedgerBackend(client, key_prefix)
+    if parts.scheme == "sqlite":
+        return SQLiteLedgerBackend(parts.path[1:] if parts.path.startswith("/") else parts.path)
+    if parts.scheme in ("", "file"):
+        return SQLiteLedgerBackend(parts.path or url)
+    raise ValueError(f"不支持的账本后端地址: {url}")
+
+
+class KeyLedger:
+    """
+    一个工作进程的账本客户端。
+
+    KeyScheduler在分配和释放密钥、熔断状态变化时调用record_*，只修改本地数据；
+    run()在后台每隔sync_interval秒把本地变化发送给后端，并把其他进程的变化应用到本地的KeyScheduler：
+    其他进程的用量从本地令牌桶中扣除，较新的熔断状态覆盖本地状态，其他进程的并发数计入密钥的并发上限。
+    租户额度（TenantRegistry）同样通过record_tenant_usage共享，各进程的租户令牌桶合计不超过配置的额度。
+    """
+
+    def __init__(self, backend: Any, sync_interval: float = 0.5, worker: Optional[str] = None):
+        self.backend = backend
+        self.sync_interval = sync_interval
+        self.worker = worker or default_worker_id()
+        self.scheduler: Any = None
+        self.tenants: Any = None
+        # 密钥标识 -> 密钥
+        self._keys: Dict[str, str] = {}
+        self._pending_usage: Dict[str, List[float]] = {}
+        self._pending_breakers: Dict[str, Dict[str, Any]] = {}
+        # 密钥标识 -> 已应用或已发布的熔断状态的更新时间
+        self._breaker_seen: Dict[str, float] = {}
+        self._cursor: Any = None
+        self.connected = False
+        self.last_sync: Optional[float] = None
+        self.last_error = ""
+        self.syncs = 0
+        self.failures = 0
+        self.remote_requests = 0.0
+
+    def attach(self, scheduler: Any):
+        self.scheduler = scheduler
+        scheduler.ledger = self
+
+    def attach_tenants(self, registry: Any):
+        """共享租户表的额度；配置变化重建租户表后需要重新调用"""
+        self.tenants = registry
+        registry.ledger = self
+
+    def _id(self, key: str) -> str:
+        identifier = key_id(key)
+        self._keys[identifier] = key
+        return identifier
+
+    def record_usage(self, key: str, requests: float, tokens: float):
+        pending = self._pending_usage.setdefault(self._id(key), [0.0, 0.0])
+        pending[0] += requests
+        pending[1] += tokens
+
+    def record_tenant_usage(self, tenant: str, requests: float, tokens: float):
+        self.record_usage(TENANT_PREFIX + tenant, requests, tokens)
+
+    def record_breaker(self, key: str, breaker: Any):
+        """发布本进程中某个密钥的熔断状态变化（冷却、隔离、恢复）"""
+        identifier = self._id(key)
+        now = time.time()
+        self._breaker_seen[identifier] = now
+        self._pending_breakers[identifier] = {
+            "state": breaker.state,
+            "failures": breaker.failures,
+            "open_until": now + max(0.0, breaker.open_until - time.monotonic()),
+            "reason": breaker.last_error,
+            "updated": now,
+        }
+
+    def _in_flight(self) -> Dict[str, int]:
+        return {self._id(state.key): state.in_flight
+                for state in self.scheduler.states.values() if state.in_flight > 0}
+
+    def _apply(self, result: ExchangeResult):
+        states = self.scheduler.states
+        now = time.monotonic()
+        wall = time.time()
+        for identifier, requests, tokens in result.usage:
+            key = self._keys.get(identifier, "")
+            if key.startswith(TENANT_PREFIX):
+                buckets = self.tenants.tenants.get(key[len(TENANT_PREFIX):]) if self.tenants else None
+            else:
+                buckets = states.get(key)
+                if buckets is not None:
+                    self.remote_requests += requests
+            if buckets is None:
+                continue
+            buckets.rpm.consume(requests, now)
+            buckets.rpd.consume(requests, now)
+            if tokens >= 0:
+                buckets.tpm.consume(tokens, now)
+            else:
+                buckets.tpm.refund(-tokens)
+
+        for identifier, remote in result.breakers.items():
+            state = states.get(self._keys.get(identifier, ""))
+            if state is None or remote["updated"] <= self._breaker_seen.get(identifier, 0.0):
+                continue
+            self._breaker_seen[identifier] = remote["updated"]
+            breaker = state.breaker
+            breaker.state = remote["state"]
+            breaker.failures = remote["failures"]
+            breaker.open_until = now + max(0.0, remote["open_until"] - wall)
+            breaker.last_error = remote["reason"]
+            breaker.probing = False
+
+        for state in states.values():
+            state.remote_in_flight = int(result.in_flight.get(self._id(state.key), 0))
+
+    def _discard_remote(self):
+        """后端不可用时不再计入其他进程的并发数，各进程独立运行"""
+        for state in self.scheduler.states.values():
+            state.remote_in_flight = 0
+
+    async def sync(self):
+        """与后端交换一次；失败时保留未发送的熔断状态，下次重试"""
+        if self.scheduler is None:
+            return
+        for state in self.scheduler.states.values():
+            self._id(state.key)
+        if self.tenants is not None:
+            for name in self.tenants.tenants:
+                self._id(TENANT_PREFIX + name)
+        usage = [(identifier, values[0], values[1]) for identifier, values in self._pending_usage.items()]
+        breakers = self._pending_breakers
+        self._pending_usage = {}
+        self._pending_breakers = {}
+        try:
+            result = await asyncio.to_thread(self.backend.exchange, self.worker, usage, breakers,
+                                             self._in_flight(), self._cursor)
+        except Exception as e:
+            self.failures += 1
+            self.last_error = str(e) or type(e).__name__
+            if self.connected or self.failures == 1:
+                logger.warning(f"密钥账本 ({self.backend.name}) 不可用，各进程独立分配密钥: {self.last_error}")
+            self.connected = False
+            # 恢复后重新开始计数，不把不可用期间其他进程的用量一次性计入
+            self._cursor = None
+            self._discard_remote()
+            # 用量只在令牌桶的补充周期内有意义，不可用期间的用量不再补发；熔断状态保留到恢复后发送
+            for identifier, breaker in breakers.items():
+                self._pending_breakers.setdefault(identifier, breaker)
+            return
+        if not self.connected:
+            logger.info(f"已连接密钥账本 ({self.backend.name})，工作进程 {self.worker}")
+        self.connected = True
+        self._cursor = result.cursor
+        self._apply(result)
+        self.syncs += 1
+        self.last_sync = time.monotonic()
+
+    async def run(self):
+        """后台任务：每隔sync_interval秒同步一次"""
+        while True:
+            await self.sync()
+            await asyncio.sleep(self.sync_interval)
+
+    def close(self):
+        close = getattr(self.backend, "close", None)
+        if close is not None:
+            close()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "backend": self.backend.name,
+            "worker": self.worker,
+            "connected": self.connected,
+            "syncs": self.syncs,
+            "failures": self.failures,
+            "last_error": self.last_error,
+            "last_sync_ago": None if self.last_sync is None else round(time.monotonic() - self.last_sync, 2),
+            "remote_requests": round(self.remote_requests),
+        }
+
+
+def create_key_ledger(cluster: Optional[Dict[str, Any]], workers: Optional[Dict[str, Any]] = None) -> Optional[KeyLedger]:
+    """
+    按配置创建账本：启用集群模式时使用[CLUSTER]的后端（同一实例的多个工作进程也通过它共享），
+    否则多工作进程时使用本机的SQLite；都没有启用时返回None，KeyScheduler只使用本地状态
+    """
+    if cluster and cluster['enabled']:
+        backend = create_ledger_backend(cluster['backend_url'], cluster['key_prefix'], cluster['timeout'])
+        worker = f"{cluster['instance']}:{os.getpid()}" if cluster['instance'] else None
+        return KeyLedger(backend, cluster['sync_interval'], worker)
+    if workers and workers['count'] > 1:
+        return KeyLedger(SQLiteLedgerBackend(workers['state_path']), workers['sync_interval'])
+    return None
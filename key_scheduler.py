@@ -0,0 +1,488 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+密钥调度模块
+为每个上游API密钥维护令牌桶（每分钟请求数、每分钟token数、每日请求数）和并发上限，
+只分配仍有余量的密钥，并在整个密钥池内均匀分摊负载；
+每个密钥带有熔断器，出错后按指数退避冷却，无效密钥永久隔离；
+交互请求优先使用延迟低的密钥，批量请求不能占用为交互请求保留的额度
+"""
+
+import math
+import re
+import time
+from email.utils import parsedate_to_datetime
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+from json_codec import dumps
+from priority_lanes import LANE_BATCH, LANE_INTERACTIVE
+from request_ingest import RawJSON
+
+# 建议客户端重试的最长等待秒数（Retry-After），密钥恢复时间未知或很长时使用
+MAX_RETRY_AFTER = 60.0
+
+
+def is_valid_key(key: str) -> bool:
+    """过滤掉占位符和明显无效的密钥"""
+    return bool(key) and not key.startswith("YOUR_") and len(key) > 10
+
+
+def build_key_pool(*groups: Iterable[str]) -> List[str]:
+    """合并多组密钥为一个去重后的密钥池，保持原有顺序"""
+    pool = []
+    seen = set()
+    for group in groups:
+        for key in group:
+            if is_valid_key(key) and key not in seen:
+                seen.add(key)
+                pool.append(key)
+    return pool
+
+
+def estimate_request_tokens(request_data: Dict[str, Any]) -> int:
+    """粗略估算请求的输入token数（约4个字符一个token）"""
+    messages = request_data.get("messages") or []
+    if isinstance(messages, RawJSON):
+        # 未解析的messages按原始字节数估算，不为估算而解析整个消息列表
+        return messages.size // 4
+    return len(dumps(messages)) // 4
+
+
+def parse_retry_after(header_value: Optional[str], body: str = "") -> Optional[float]:
+    """
+    从Retry-After响应头（秒数或HTTP日期）或Google错误体中的retryDelay解析需要等待的秒数，
+    inf、nan等非有限值视为无效
+    """
+    if header_value:
+        header_value = header_value.strip()
+        try:
+            seconds = float(header_value)
+            if math.isfinite(seconds):
+                return max(0.0, seconds)
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(header_value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            pass
+    match = re.search(r'"retryDelay"\s*:\s*"(\d+(?:\.\d+)?)s"', body or "")
+    if match:
+        return float(match.group(1))
+    return None
+
+
+def is_invalid_key_error(status_code: int, body: str = "") -> bool:
+    """判断上游错误是否表示密钥无效或已被停用"""
+    if status_code in (401, 403):
+        return True
+    return status_code == 400 and ("API_KEY_INVALID" in body or "API key not valid" in body)
+
+
+class TokenBucket:
+    """令牌桶：容量capacity，每period秒匀速补满"""
+
+    def __init__(self, capacity: float, period: float):
+        self.capacity = float(capacity)
+        self.rate = self.capacity / period if capacity > 0 else 0.0
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    @property
+    def unlimited(self) -> bool:
+        return self.capacity <= 0
+
+    def _refill(self, now: float):
+        if self.unlimited:
+            return
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def available(self, now: Optional[float] = None) -> float:
+        if self.unlimited:
+            return math.inf
+        self._refill(time.monotonic() if now is None else now)
+        return self.tokens
+
+    def consume(self, amount: float, now: Optional[float] = None):
+        """扣减令牌，允许透支（用于按实际用量修正估算值）"""
+        if self.unlimited:
+            return
+        self._refill(time.monotonic() if now is None else now)
+        self.tokens -= amount
+
+    def refund(self, amount: float):
+        if self.unlimited:
+            return
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+    def time_until(self, amount: float, now: Optional[float] = None) -> float:
+        """还需等待多少秒才有amount个令牌"""
+        if self.unlimited:
+            return 0.0
+        missing = min(amount, self.capacity) - self.available(now)
+        return max(0.0, missing / self.rate) if missing > 0 else 0.0
+
+
+class CircuitBreaker:
+    """
+    单个密钥的熔断器
+
+    closed: 正常使用；open: 冷却中，不分配；
+    half_open: 冷却结束，只允许一个探测请求，成功后恢复closed，失败则重新进入open；
+    quarantined: 密钥无效，永久隔离
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    QUARANTINED = "quarantined"
+
+    def __init__(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self.open_until = 0.0
+        self.probing = False
+        self.last_error = ""
+
+    def allows(self, now: float) -> bool:
+        """当前是否允许分配该密钥"""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.QUARANTINED:
+            return False
+        if self.state == self.OPEN and now < self.open_until:
+            return False
+        return not self.probing
+
+    def on_acquire(self, now: float):
+        if self.state in (self.OPEN, self.HALF_OPEN):
+            self.state = self.HALF_OPEN
+            self.probing = True
+
+    def on_release(self):
+        # 探测请求被取消或结果无法判断时，允许下一次探测
+        self.probing = False
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self.probing = False
+
+    def record_failure(self, now: float, cooldown: float, reason: str):
+        self.failures += 1
+        self.state = self.OPEN
+        self.open_until = now + cooldown
+        self.probing = False
+        self.last_error = reason
+
+    def quarantine(self, reason: str):
+        self.state = self.QUARANTINED
+        self.probing = False
+        self.last_error = reason
+
+    def wait_time(self, now: float) -> float:
+        if self.state == self.QUARANTINED:
+            return math.inf
+        if self.state == self.OPEN:
+            return max(0.0, self.open_until - now)
+        return 0.0
+
+    def snapshot(self, now: float) -> Dict[str, Any]:
+        state = self.state
+        if state == self.OPEN and now >= self.open_until:
+            state = self.HALF_OPEN
+        return {
+            "state": state,
+            "consecutive_failures": self.failures,
+            "cooldown_remaining": round(self.wait_time(now), 1) if self.state == self.OPEN else 0,
+            "last_error": self.last_error,
+        }
+
+
+class KeyState:
+    """单个密钥的限额、用量与健康状态"""
+
+    def __init__(self, key: str, limits: Dict[str, Any]):
+        self.key = key
+        self.rpm = TokenBucket(limits['rpm'], 60)
+        self.tpm = TokenBucket(limits['tpm'], 60)
+        self.rpd = TokenBucket(limits['rpd'], 86400)
+        self.max_in_flight = limits['max_in_flight']
+        self.in_flight = 0
+        # 其他工作进程（通过密钥账本同步）正在使用该密钥的请求数
+        self.remote_in_flight = 0
+        self.total_requests = 0
+        self.last_acquired = 0.0
+        # 首字节耗时（秒）的指数加权移动平均，没有样本时为None
+        self.latency: Optional[float] = None
+        self.breaker = CircuitBreaker()
+
+    @property
+    def label(self) -> str:
+        return f"***{self.key[-4:]}"
+
+    @property
+    def total_in_flight(self) -> int:
+        return self.in_flight + self.remote_in_flight
+
+    def record_latency(self, seconds: float):
+        self.latency = seconds if self.latency is None else 0.8 * self.latency + 0.2 * seconds
+
+    def max_in_flight_for(self, reserve: float) -> int:
+        """保留reserve比例的并发名额后可用的并发上限（0表示不限制）"""
+        if self.max_in_flight <= 0:
+            return 0
+        return max(1, self.max_in_flight - math.floor(self.max_in_flight * reserve))
+
+    def has_capacity(self, estimated_tokens: int, now: float, reserve: float = 0.0) -> bool:
+        """
+        密钥是否还能接受一个请求；reserve为必须留给交互请求的额度比例，
+        批量请求只能使用超出这部分的余量。
+        """
+        if not self.breaker.allows(now):
+            return False
+        max_in_flight = self.max_in_flight_for(reserve)
+        if max_in_flight > 0 and self.total_in_flight >= max_in_flight:
+            return False
+        if self.rpm.available(now) < 1 + reserve * self.rpm.capacity \
+                or self.rpd.available(now) < 1 + reserve * self.rpd.capacity:
+            return False
+        # 单个请求的估算token超过整个桶容量时，只要求桶是满的
+        return self.tpm.available(now) >= min(estimated_tokens + reserve * self.tpm.capacity, self.tpm.capacity)
+
+    def wait_time(self, estimated_tokens: int, now: float, reserve: float = 0.0) -> float:
+        """该密钥恢复可用还需等待的秒数（受并发上限阻塞或被隔离时返回inf）"""
+        max_in_flight = self.max_in_flight_for(reserve)
+        if max_in_flight > 0 and self.total_in_flight >= max_in_flight:
+            return math.inf
+        return max(self.breaker.wait_time(now),
+                   self.rpm.time_until(1 + reserve * self.rpm.capacity, now),
+                   self.rpd.time_until(1 + reserve * self.rpd.capacity, now),
+                   self.tpm.time_until(estimated_tokens + reserve * self.tpm.capacity, now))
+
+    def snapshot(self, now: float) -> Dict[str, Any]:
+        def fmt(bucket: TokenBucket):
+            return None if bucket.unlimited else round(bucket.available(now), 1)
+        return {
+            "key": self.label,
+            "in_flight": self.in_flight,
+            "remote_in_flight": self.remote_in_flight,
+            "total_requests": self.total_requests,
+            "ttfb_ms": None if self.latency is None else round(self.latency * 1000),
+            "rpm_remaining": fmt(self.rpm),
+            "tpm_remaining": fmt(self.tpm),
+            "rpd_remaining": fmt(self.rpd),
+            **self.breaker.snapshot(now),
+        }
+
+
+class KeyScheduler:
+    """按每个密钥的剩余额度和并发数分配密钥"""
+
+    def __init__(self, keys: List[str], limits: Dict[str, Any],
+                 overrides: Optional[Dict[str, Dict[str, Any]]] = None,
+                 breaker_config: Optional[Dict[str, Any]] = None,
+                 batch_reserve: float = 0.0):
+        self.limits = limits
+        # 每个密钥为交互请求保留的额度比例，批量请求不能使用
+        self.batch_reserve = batch_reserve
+        self.overrides = overrides or {}
+        self.breaker_config = breaker_config or {
+            'cooldown_base': 5.0,
+            'cooldown_max': 300.0,
+            'quarantine_invalid': True
+        }
+        self.states: Dict[str, KeyState] = {}
+        # 多进程或集群部署时共享用量和熔断状态的账本（KeyLedger.attach设置），单进程时为None
+        self.ledger = None
+        self.update_keys(keys)
+
+    def _limits_for(self, key: str) -> Dict[str, Any]:
+        override = self.overrides.get(key) or self.overrides.get(key[-4:]) or {}
+        return dict(self.limits, **override)
+
+    def update_keys(self, keys: List[str]):
+        """更新密钥池，保留仍存在的密钥的用量状态"""
+        if list(self.states) == list(keys):
+            return
+        self.states = {
+            key: self.states.get(key) or KeyState(key, self._limits_for(key))
+            for key in keys
+        }
+
+    @property
+    def keys(self) -> List[str]:
+        return list(self.states)
+
+    def _reserve_for(self, lane: str) -> float:
+        return self.batch_reserve if lane == LANE_BATCH else 0.0
+
+    def acquire(self, estimated_tokens: int = 0, exclude: Iterable[str] = (),
+                lane: str = LANE_INTERACTIVE) -> Optional[str]:
+        """
+        挑选一个仍有余量的密钥并占用一个并发名额。
+
+        优先选择并发数最少的密钥；交互请求其次选择已恢复正常、首字节耗时（按100毫秒取整）
+        最短的密钥，批量请求则把这些密钥留给交互请求；最后按每分钟剩余请求比例最高、
+        最久未使用排序，使负载在整个密钥池内均匀分布。没有可用密钥时返回None。
+        """
+        now = time.monotonic()
+        excluded = set(exclude)
+        reserve = self._reserve_for(lane)
+        candidates = [
+            state for key, state in self.states.items()
+            if key not in excluded and state.has_capacity(estimated_tokens, now, reserve)
+        ]
+        if not candidates:
+            return None
+
+        def load(state: KeyState):
+            rpm_ratio = 1.0 if state.rpm.unlimited else state.rpm.available(now) / state.rpm.capacity
+            # 还没有延迟样本的密钥视为最快，使新密钥也能被尝试
+            latency = round(state.latency or 0.0, 1)
+            probing = state.breaker.state != CircuitBreaker.CLOSED
+            if lane == LANE_BATCH:
+                return (state.total_in_flight, -probing, -latency, -rpm_ratio, state.last_acquired)
+            return (state.total_in_flight, probing, latency, -rpm_ratio, state.last_acquired)
+
+        state = min(candidates, key=load)
+        state.rpm.consume(1, now)
+        state.rpd.consume(1, now)
+        state.tpm.consume(estimated_tokens, now)
+        state.breaker.on_acquire(now)
+        state.in_flight += 1
+        state.total_requests += 1
+        state.last_acquired = now
+        if self.ledger is not None:
+            self.ledger.record_usage(state.key, 1, estimated_tokens)
+        return state.key
+
+    def release(self, key: str, estimated_tokens: int = 0, used_tokens: Optional[int] = None):
+        """释放密钥的并发名额，并按上游返回的实际token用量修正估算"""
+        state = self.states.get(key)
+        if state is None:
+            return
+        state.in_flight = max(0, state.in_flight - 1)
+        state.breaker.on_release()
+        if used_tokens is not None:
+            difference = used_tokens - estimated_tokens
+            if difference > 0:
+                state.tpm.consume(difference)
+            else:
+                state.tpm.refund(-difference)
+            if self.ledger is not None and difference:
+                self.ledger.record_usage(key, 0, difference)
+
+    def record_success(self, key: str, latency: Optional[float] = None):
+        """上游返回成功状态码，密钥恢复正常；latency为收到响应头的耗时（秒）"""
+        state = self.states.get(key)
+        if state is not None:
+            recovered = state.breaker.state != CircuitBreaker.CLOSED
+            state.breaker.record_success()
+            if latency is not None:
+                state.record_latency(latency)
+            if recovered and self.ledger is not None:
+                self.ledger.record_breaker(key, state.breaker)
+
+    def record_failure(self, key: str, status_code: int, retry_after: Optional[float] = None,
+                       body: str = ""):
+        """
+        记录上游错误并更新熔断状态。
+
+        无效密钥（401/403/API_KEY_INVALID）永久隔离；429和5xx按指数退避冷却，
+        上游给出Retry-After时冷却时间不短于它（但不超过cooldown_max）；其他4xx属于请求本身的问题，
+        网络错误（状态码0）属于上游线路的问题，都不计入密钥。
+        """
+        state = self.states.get(key)
+        if state is None:
+            return
+        breaker = state.breaker
+        reason = f"HTTP {status_code}"
+
+        if is_invalid_key_error(status_code, body):
+            if self.breaker_config['quarantine_invalid']:
+                breaker.quarantine(reason)
+                if self.ledger is not None:
+                    self.ledger.record_breaker(key, breaker)
+                return
+        elif status_code != 429 and status_code < 500:
+            return
+
+        backoff = self.breaker_config['cooldown_base'] * (2 ** breaker.failures)
+        cooldown = min(self.breaker_config['cooldown_max'], backoff)
+        if retry_after is not None and math.isfinite(retry_after):
+            cooldown = max(cooldown, min(retry_after, self.breaker_config['cooldown_max']))
+        breaker.record_failure(time.monotonic(), cooldown, reason)
+        if self.ledger is not None:
+            self.ledger.record_breaker(key, breaker)
+
+    def reset_key(self, key: str):
+        """手动恢复一个被熔断或隔离的密钥"""
+        state = self.states.get(key)
+        if state is not None:
+            state.breaker = CircuitBreaker()
+            if self.ledger is not None:
+                self.ledger.record_breaker(key, state.breaker)
+
+    def iter_keys(self, width: int, estimated_tokens: int = 0,
+                  lane: str = LANE_INTERACTIVE) -> Iterator[str]:
+        """按需逐个分配最多width个不同的密钥（配合对冲请求，未使用的密钥不会被占用）"""
+        used: List[str] = []
+        while len(used) < width:
+            key = self.acquire(estimated_tokens, exclude=used, lane=lane)
+            if key is None:
+                return
+            used.append(key)
+            yield key
+
+    def retry_after(self, estimated_tokens: int = 0, lane: str = LANE_INTERACTIVE) -> float:
+        """距离至少一个密钥恢复可用（对该通道而言）的估算秒数，最多MAX_RETRY_AFTER秒"""
+        now = time.monotonic()
+        reserve = self._reserve_for(lane)
+        waits = [state.wait_time(estimated_tokens, now, reserve) for state in self.states.values()]
+        finite = [wait for wait in waits if wait != math.inf]
+        if finite:
+            return min(min(finite), MAX_RETRY_AFTER)
+        # 全部被并发上限阻塞时，等待一个正在进行的请求结束；没有任何密钥时等待配置更新
+        return 1.0 if waits else MAX_RETRY_AFTER
+
+    def capacity(self) -> Dict[str, Dict[str, float]]:
+        """
+        汇总可用密钥（未被熔断或隔离）的每分钟请求数和token额度，用于x-ratelimit-*响应头。
+
+        Returns:
+            {"requests": {...}, "tokens": {...}}，每项包含limit、remaining和reset（秒）；
+            没有配置对应限额时该项不出现
+        """
+        now = time.monotonic()
+        usable = [state for state in self.states.values()
+                  if state.breaker.state != CircuitBreaker.QUARANTINED]
+        result = {}
+        for name, bucket_name in (("requests", "rpm"), ("tokens", "tpm")):
+            buckets = [getattr(state, bucket_name) for state in usable]
+            if not buckets or any(bucket.unlimited for bucket in buckets):
+                continue
+            remaining = [max(0.0, bucket.available(now)) for bucket in buckets]
+            # 补满所有桶所需的时间
+            reset = max((bucket.capacity - tokens) / bucket.rate
+                        for bucket, tokens in zip(buckets, remaining))
+            result[name] = {
+                "limit": sum(bucket.capacity for bucket in buckets),
+                "remaining": math.floor(sum(remaining)),
+                "reset": max(0.0, reset),
+            }
+        return result
+
+    def health_summary(self) -> Dict[str, int]:
+        """按熔断状态统计密钥数量"""
+        now = time.monotonic()
+        summary = {state: 0 for state in (CircuitBreaker.CLOSED, CircuitBreaker.OPEN,
+                                          CircuitBreaker.HALF_OPEN, CircuitBreaker.QUARANTINED)}
+        for key_state in self.states.values():
+            summary[key_state.breaker.snapshot(now)["state"]] += 1
+        return summary
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        """各密钥当前状态，用于健康检查"""
+        now = time.monotonic()
+        return [state.snapshot(now) for state in self.states.values()]
@@ -10,17 +10,47 @@ import httpx
 import uvicorn
 import os
 import logging
-import json
 import time
 import sys
+import math
+import signal
+import itertools
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import List, Dict, Any
+from typing import Dict, Any, Iterator, Optional
+
+# HTTP/2 需要额外安装 h2 (pip install httpx[http2])
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
 
 # 导入配置管理器
 from config_manager import config_manager
+from key_scheduler import KeyScheduler, build_key_pool, estimate_request_tokens, parse_retry_after
+from fanout_engine import (ClientDisconnected, LatencyTracker, cancel_on_disconnect, fanout_stats,
+                           resolve_hedge_delay, run_fanout)
+from selection_policy import SelectionPolicy, has_structured_output, resolve_selection_policy
+from response_cache import (CACHE_STATUS_HEADER, cache_directives, canonical_request_key,
+                            create_response_cache, is_cacheable_request)
+from single_flight import SINGLE_FLIGHT_HEADER, SingleFlight
+from admission import AdmissionController, AdmissionRejected, per_worker_limit, rate_limit_headers, release_after_body
+from tenants import TenantQuotaExceeded, TenantUsage, build_tenant_registry
+from priority_lanes import LANE_BATCH, LANE_INTERACTIVE, resolve_lane
+from upstream_stream import build_upstream_payload, race_upstream_streams
+from upstream_router import UpstreamRouter, UpstreamTarget, build_upstreams
+from connection_warmup import ConnectionWarmer
+from json_codec import ChunkEnvelope, DecodeError, FastJSONResponse, loads, set_backend
+from stream_pacing import paced_events, resolve_pacing
+from request_ingest import ChatRequestBody, InvalidChatRequest, OutboundPayload, parse_chat_request, payload_stats
+from config_snapshot import ConfigSnapshot, watch_config
+from graceful_drain import DrainController, is_admin_authorized
+from proxy_metrics import (CONTENT_TYPE as METRICS_CONTENT_TYPE, collect_admission_metrics, collect_key_metrics,
+                           gauge, proxy_metrics)
+from key_ledger import KeyLedger, create_key_ledger
 
 # --- 从配置管理器获取配置 ---
 
@@ -35,28 +65,265 @@ REQUEST_TIMEOUT = server_config['request_timeout']
 # 获取API配置
 BASE_URL = config_manager.get_base_url()
 
+# JSON编解码后端: 安装了orjson或msgspec时使用，否则使用标准库
+JSON_BACKEND = set_backend(config_manager.get_json_backend())
+
 # 获取API密钥
 api_keys = config_manager.get_api_keys()
 API_KEYS_GROUP_1 = api_keys['group1']
 API_KEYS_GROUP_2 = api_keys['group2']
 
-# 轮询计数器，用于跟踪当前应该使用哪组密钥
-current_group_index = 0
+# 获取上游连接池配置
+UPSTREAM_CONFIG = config_manager.get_upstream_config()
 
-# 获取当前应该使用的密钥组
-def get_current_api_keys():
-    """根据轮询机制返回当前应该使用的API密钥组"""
-    global current_group_index
-    if current_group_index == 0:
-        keys = API_KEYS_GROUP_1
-        current_group_index = 1
-    else:
-        keys = API_KEYS_GROUP_2
-        current_group_index = 0
+# 流式模式: passthrough 真流式转发, fake 完整响应后伪流式
+STREAM_MODE = config_manager.get_stream_mode()
+
+# 扇出配置: all 整组并发, hedge 对冲请求
+FANOUT_CONFIG = config_manager.get_fanout_config()
+
+# 响应选择策略: first_valid 第一个满足条件的响应, best_of 截止时间内选最佳
+SELECTION_CONFIG = config_manager.get_selection_config()
+
+# 响应缓存: 相同请求直接返回缓存的完整响应
+CACHE_CONFIG = config_manager.get_cache_config()
+response_cache = create_response_cache(CACHE_CONFIG)
+
+# 请求合并: 同时到达的相同请求只向上游扇出一次
+COALESCE_CONFIG = config_manager.get_coalesce_config()
+single_flight = SingleFlight()
+
+# 多租户: 每个客户端密钥一个租户，服务器的API_KEY作为default租户
+tenant_registry = build_tenant_registry(API_KEY, config_manager.get_tenants_config())
+
+# 优先级通道: 交互请求优先，批量请求只使用剩余的名额和密钥额度
+PRIORITY_CONFIG = config_manager.get_priority_config()
+
+# 伪流式节奏: instant一次性发送，fixed按固定字节数，rate按目标token速率
+PACING_CONFIG = config_manager.get_pacing_config()
+
+# 多工作进程: 准入控制的上限按工作进程数平分，密钥和租户额度通过账本共享（见下方key_ledger）
+WORKERS_CONFIG = config_manager.get_workers_config()
+
+# 准入控制: 全局并发上限和按租户加权公平的有界等待队列
+ADMISSION_CONFIG = config_manager.get_admission_config()
+admission = AdmissionController(per_worker_limit(ADMISSION_CONFIG['max_concurrent'], WORKERS_CONFIG['count']),
+                                per_worker_limit(ADMISSION_CONFIG['max_queue'], WORKERS_CONFIG['count']),
+                                ADMISSION_CONFIG['max_queue_time'], PRIORITY_CONFIG['batch_share'],
+                                PRIORITY_CONFIG['batch_max_queue_time'])
+
+# 观测到的胜出请求耗时，用于自动推算对冲延迟
+completion_latency = LatencyTracker()
+stream_latency = LatencyTracker()
+
+# 密钥调度: 两组密钥合并为一个密钥池，按每个密钥的限额和并发数分配
+SCHEDULER_CONFIG = config_manager.get_scheduler_config()
+key_scheduler = KeyScheduler([], SCHEDULER_CONFIG['limits'], SCHEDULER_CONFIG['overrides'],
+                             config_manager.get_breaker_config(), PRIORITY_CONFIG['batch_reserve'])
+
+# 上游路由: 可配置多个上游，每个上游有自己的密钥池，按首字节耗时和错误率选择
+UPSTREAMS = build_upstreams(BASE_URL, build_key_pool(API_KEYS_GROUP_1, API_KEYS_GROUP_2),
+                            config_manager.get_upstreams_config(), config_manager.get_api_protocol(),
+                            config_manager.get_gemini_config())
+upstream_router = UpstreamRouter(key_scheduler, UPSTREAMS, config_manager.get_routing_config())
+KEY_POOL = upstream_router.keys
+
+# 多工作进程和集群模式: 各进程的KeyScheduler和租户表通过账本共享密钥用量、并发数、熔断状态和租户额度
+# （集群模式使用[CLUSTER]的Redis协议服务器，否则多工作进程时使用本机的SQLite）
+key_ledger: Optional[KeyLedger] = create_key_ledger(config_manager.get_cluster_config(), WORKERS_CONFIG)
+if key_ledger is not None:
+    key_ledger.attach(key_scheduler)
+    key_ledger.attach_tenants(tenant_registry)
+
+# /metrics: 抓取时读取准入队列和密钥状态，请求路径上只更新计数
+proxy_metrics.add_collector(lambda: collect_admission_metrics(admission))
+proxy_metrics.add_collector(lambda: collect_key_metrics(key_scheduler))
+proxy_metrics.add_collector(lambda: [gauge("llm_proxy_min_response_length",
+                                           "当前的最小响应长度，短于它的响应被丢弃", MIN_RESPONSE_LENGTH)])
+
+# 每个请求最多使用的密钥数，auto时与原来单组密钥的数量相当
+FANOUT_WIDTH = SCHEDULER_CONFIG['fanout_width'] or max(1, math.ceil(len(KEY_POOL) / 2))
+
+def schedule_upstream_targets(estimated_tokens: int, lane: str = LANE_INTERACTIVE) -> Iterator[UpstreamTarget]:
+    """
+    为一次客户端请求按需分配上游和密钥，批量通道的请求使用较少的密钥且不占用保留额度。
+    
+    没有配置有效密钥时返回500；所有密钥都已达到限额或处于熔断冷却时返回429并附带Retry-After。
+    """
+    if not KEY_POOL:
+        raise HTTPException(
+            status_code=500,
+            detail="服务器未配置有效的API密钥。请使用GUI配置API密钥。"
+        )
+    
+    width = FANOUT_WIDTH
+    if lane == LANE_BATCH and PRIORITY_CONFIG['batch_fanout_width'] > 0:
+        width = min(width, PRIORITY_CONFIG['batch_fanout_width'])
+    targets = upstream_router.iter_targets(width, estimated_tokens, lane)
+    first_target = next(targets, None)
+    if first_target is None:
+        retry_after = key_scheduler.retry_after(estimated_tokens, lane)
+        logger.warning(f"所有API密钥均已达到限额或处于冷却中，建议 {math.ceil(retry_after)} 秒后重试")
+        raise HTTPException(
+            status_code=429,
+            detail="所有API密钥均已达到限额或处于冷却中，请稍后重试。",
+            headers=rate_limit_headers(key_scheduler.capacity(), retry_after)
+        )
+    return itertools.chain([first_target], targets)
+
+# --- 配置热加载与平滑关闭 ---
+
+# 进行中的请求计数，平滑关闭时拒绝新请求并等待它们结束
+drain_controller = DrainController()
+ADMIN_CONFIG = config_manager.get_admin_config()
+# 上一次应用的租户配置，用于判断是否需要重建租户表
+applied_tenants = {'config': config_manager.get_tenants_config()}
+
+def apply_config(config: ConfigSnapshot):
+    """
+    把配置快照应用到运行中的服务。新请求使用新的密钥池、超时和策略，
+    进行中的扇出和流式响应继续使用它们已分配的密钥，不会被中断。
+    端口、监听地址、连接池和缓存设置需要重启后生效。
+    """
+    global MIN_RESPONSE_LENGTH, REQUEST_TIMEOUT, API_KEY, BASE_URL, API_KEYS_GROUP_1, API_KEYS_GROUP_2
+    global STREAM_MODE, FANOUT_CONFIG, SELECTION_CONFIG, COALESCE_CONFIG, PRIORITY_CONFIG, PACING_CONFIG
+    global ADMIN_CONFIG, KEY_POOL, FANOUT_WIDTH, tenant_registry
+
+    server = config.server
+    if (server['port'], server['host']) != (PORT, HOST):
+        logger.warning("监听地址或端口的修改需要重启服务后生效")
+    MIN_RESPONSE_LENGTH = server['min_response_length']
+    REQUEST_TIMEOUT = server['request_timeout']
+    STREAM_MODE = config.stream_mode
+    FANOUT_CONFIG = config.fanout
+    SELECTION_CONFIG = config.selection
+    COALESCE_CONFIG = config.coalesce
+    PRIORITY_CONFIG = config.priority
+    PACING_CONFIG = config.pacing
+    ADMIN_CONFIG = config.admin
+
+    # 租户配置变化时才重建租户表，否则保留各租户的用量
+    if server['api_key'] != API_KEY or config.tenants != applied_tenants['config']:
+        tenant_registry = build_tenant_registry(server['api_key'], config.tenants)
+        applied_tenants['config'] = config.tenants
+        if key_ledger is not None:
+            key_ledger.attach_tenants(tenant_registry)
+    API_KEY = server['api_key']
+
+    admission.max_concurrent = per_worker_limit(config.admission['max_concurrent'], WORKERS_CONFIG['count'])
+    admission.max_queue = per_worker_limit(config.admission['max_queue'], WORKERS_CONFIG['count'])
+    admission.max_queue_time = config.admission['max_queue_time']
+    admission.batch_share = config.priority['batch_share']
+    admission.batch_max_queue_time = config.priority['batch_max_queue_time']
+
+    # 新增密钥使用新的限额，仍然存在的密钥保留用量和熔断状态，被移除的密钥在进行中的请求结束后释放
+    key_scheduler.limits = config.scheduler['limits']
+    key_scheduler.overrides = config.scheduler['overrides']
+    key_scheduler.breaker_config = config.breaker
+    key_scheduler.batch_reserve = config.priority['batch_reserve']
+    BASE_URL = config.base_url
+    API_KEYS_GROUP_1 = config.api_keys['group1']
+    API_KEYS_GROUP_2 = config.api_keys['group2']
+    upstream_router.configure(config.routing)
+    upstream_router.update_upstreams(build_upstreams(
+        BASE_URL, build_key_pool(API_KEYS_GROUP_1, API_KEYS_GROUP_2),
+        config.upstreams, config.protocol, config.gemini))
+    KEY_POOL = upstream_router.keys
+    FANOUT_WIDTH = config.scheduler['fanout_width'] or max(1, math.ceil(len(KEY_POOL) / 2))
+    connection_warmer.configure(config.warmup)
+    logger.info(f"已应用配置 (版本 {config.version}): {len(KEY_POOL)} 个密钥, 超时 {REQUEST_TIMEOUT} 秒")
+
+def reload_config(source: str) -> bool:
+    """重新读取配置文件并应用，配置无法解析时保留当前配置"""
+    logger.info(f"收到重新加载配置的请求 ({source})")
+    if not config_manager.reload_if_changed(force=True):
+        return False
+    apply_config(config_manager.snapshot)
+    return True
+
+def reject_while_draining():
+    raise HTTPException(
+        status_code=503,
+        detail="服务正在关闭，请稍后重试。",
+        headers={"Retry-After": str(drain_controller.retry_after()), "Connection": "close"}
+    )
+
+async def drain_and_exit(timeout: float):
+    """平滑关闭：等待进行中的请求结束（最多timeout秒），然后让uvicorn正常退出"""
+    await drain_controller.drain(timeout)
+    # uvicorn收到SIGTERM后关闭监听并执行lifespan的清理；多工作进程时通知主进程，由它结束所有工作进程
+    os.kill(os.getppid() if WORKERS_CONFIG['count'] > 1 else os.getpid(), signal.SIGTERM)
+
+# --- 上游连接池 ---
+
+# 全局共享的上游客户端，在应用生命周期内复用TCP/TLS连接
+upstream_client: Optional[httpx.AsyncClient] = None
+
+# 连接预热: 启动时和空闲后预先解析上游地址并建立keep-alive连接
+connection_warmer = ConnectionWarmer(config_manager.get_warmup_config())
+
+def create_upstream_client() -> httpx.AsyncClient:
+    """根据配置创建带连接池的上游客户端"""
+    use_http2 = UPSTREAM_CONFIG['http2']
+    if use_http2 and not HTTP2_AVAILABLE:
+        logger.warning("配置启用了HTTP/2，但未安装h2依赖，回退到HTTP/1.1。请运行 'pip install httpx[http2]'")
+        use_http2 = False
     
-    # 过滤掉无效的密钥
-    valid_keys = [key for key in keys if key and not key.startswith("YOUR_") and len(key) > 10]
-    return valid_keys
+    limits = httpx.Limits(
+        max_connections=UPSTREAM_CONFIG['max_connections'],
+        max_keepalive_connections=UPSTREAM_CONFIG['max_keepalive_connections'],
+        keepalive_expiry=UPSTREAM_CONFIG['keepalive_expiry'],
+    )
+    logger.info(f"创建上游连接池: {UPSTREAM_CONFIG}, HTTP/2: {use_http2}")
+    return httpx.AsyncClient(
+        transport=connection_warmer.create_transport(limits, use_http2),
+        timeout=REQUEST_TIMEOUT,
+        event_hooks={"request": [connection_warmer.on_request]},
+    )
+
+def get_upstream_client() -> httpx.AsyncClient:
+    """返回共享的上游客户端，未经lifespan初始化时按需创建"""
+    global upstream_client
+    if upstream_client is None or upstream_client.is_closed:
+        upstream_client = create_upstream_client()
+    return upstream_client
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """应用生命周期：启动时建立连接池并在后台预热、监听SIGHUP，关闭时释放"""
+    global upstream_client
+    upstream_client = create_upstream_client()
+    warmup_task = asyncio.create_task(connection_warmer.run(
+        get_upstream_client, lambda: [upstream.base_url for upstream in upstream_router.upstreams]))
+    background_tasks = [warmup_task, asyncio.create_task(proxy_metrics.monitor_loop_lag())]
+    if key_ledger is not None:
+        background_tasks.append(asyncio.create_task(key_ledger.run()))
+    if WORKERS_CONFIG['count'] > 1:
+        # SIGHUP和 POST /admin/reload 只作用于收到的那个工作进程，修改配置文件后各工作进程自行重新加载
+        background_tasks.append(asyncio.create_task(watch_config(config_manager, apply_config)))
+    # kill -HUP <pid> 重新加载配置（Windows没有SIGHUP，不在主线程运行时无法监听信号，使用 POST /admin/reload）
+    loop = asyncio.get_running_loop()
+    sighup = False
+    if hasattr(signal, "SIGHUP"):
+        try:
+            loop.add_signal_handler(signal.SIGHUP, reload_config, "SIGHUP")
+            sighup = True
+        except (RuntimeError, ValueError) as e:
+            logger.info(f"无法监听SIGHUP，请使用 POST /admin/reload 重新加载配置: {e}")
+    try:
+        yield
+    finally:
+        if sighup:
+            loop.remove_signal_handler(signal.SIGHUP)
+        for task in background_tasks:
+            task.cancel()
+        if key_ledger is not None:
+            key_ledger.close()
+        await upstream_client.aclose()
+        upstream_client = None
+        if response_cache is not None:
+            response_cache.close()
+        logger.info("上游连接池已关闭")
 
 # --- FastAPI应用设置 ---
 
@@ -65,6 +332,7 @@ app = FastAPI(
     title="高效LLM并发中转服务",
     description="使用多个API密钥并发请求LLM，并返回第一个满足条件的响应。",
     version="1.0.0",
+    lifespan=lifespan,
 )
 
 # 添加CORS中间件
@@ -83,178 +351,173 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# 定义与OpenAI API兼容的请求体模型
-class ChatRequest(BaseModel):
-    model: str
-    messages: List[Dict[str, Any]]
-    temperature: float = 0.7
-    max_tokens: int = 4096
-    stream: bool = False
-
 # --- 核心并发逻辑 ---
 
-async def send_single_request(client: httpx.AsyncClient, api_key: str, request_data: dict):
+async def send_single_request(client: httpx.AsyncClient, target: UpstreamTarget, payload: OutboundPayload):
     """
-    使用单个API密钥发送请求。
+    使用单个API密钥向目标上游发送请求。payload的请求体在所有尝试间共享，只编码一次。
     """
-    # 清理请求数据，移除Google API不支持的参数
-    cleaned_data = {}
-    
-    # Google API支持的参数
-    supported_params = {
-        'model', 'messages', 'temperature', 'max_tokens',
-        'top_p', 'top_k', 'stop'
-    }
-    
-    # 只保留支持的参数
-    for key, value in request_data.items():
-        if key in supported_params:
-            cleaned_data[key] = value
-    
-    logger.info(f"清理后的请求参数: {list(cleaned_data.keys())}")
-    
-    # 构造请求头
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json",
-    }
-    
-    # 构造请求URL
-    url = f"{BASE_URL}/openai/chat/completions"
+    api_key = target.key
+    response = None
 
     try:
-        logger.info(f"使用密钥 [***{api_key[-4:]}] 发送请求...")
-        response = await client.post(url, headers=headers, json=cleaned_data, timeout=REQUEST_TIMEOUT)
-        
-        response.raise_for_status()
-        logger.info(f"密钥 [***{api_key[-4:]}] 收到响应，状态码: {response.status_code}")
-        
-        response_text = response.text
+        logger.info(f"使用密钥 [***{api_key[-4:]}] 向上游 {target.upstream.name} 发送请求...")
+        # 请求头、URL和请求体的格式由上游的后端（OpenAI兼容接口或原生Gemini接口）决定
+        request = target.build_request(client, payload, False, REQUEST_TIMEOUT)
+        started = time.monotonic()
+        response = await client.send(request, stream=True)
+        proxy_metrics.observe_upstream_response(api_key, False, response.status_code, time.monotonic() - started)
         
-        # 检查是否是流式响应
-        if "data:" in response_text:
-            logger.info(f"密钥 [***{api_key[-4:]}] 检测到流式响应，转换为标准格式")
-            # 解析流式响应
-            lines = response_text.strip().split('\n')
-            content = ""
-            final_id = ""
-            final_model = ""
-            final_created = int(time.time())
-            
-            for line in lines:
-                if line.startswith("data: "):
-                    try:
-                        data = json.loads(line[6:])
-                        if data == "[DONE]":
-                            continue
-                            
-                        if "choices" in data and data["choices"]:
-                            delta = data["choices"][0].get("delta", {})
-                            if "content" in delta:
-                                content += delta["content"]
-                            
-                            if "id" in data:
-                                final_id = data["id"]
-                            if "model" in data:
-                                final_model = data["model"]
-                            if "created" in data:
-                                final_created = data["created"]
-                                
-                    except json.JSONDecodeError:
-                        continue
+        try:
+            if response.is_error:
+                await response.aread()
+            response.raise_for_status()
+            target.record_success(api_key, time.monotonic() - started)
+            logger.info(f"密钥 [***{api_key[-4:]}] 收到响应，状态码: {response.status_code}")
             
-            if content:
-                logger.info(f"密钥 [***{api_key[-4:]}] 成功解析流式响应，内容长度: {len(content)}")
-                return {
-                    "id": final_id or "chatcmpl-" + str(int(time.time())),
-                    "object": "chat.completion",
-                    "created": final_created,
-                    "model": final_model or "gemini-2.5-flash",
-                    "choices": [
-                        {
-                            "index": 0,
-                            "message": {
-                                "role": "assistant",
-                                "content": content,
-                                "reasoning_content": "",
-                                "tool_calls": []
-                            },
-                            "finish_reason": "stop"
-                        }
-                    ],
-                    "usage": {
-                        "prompt_tokens": 0,
-                        "completion_tokens": 0,
-                        "total_tokens": 0
-                    }
-                }
+            # 检查是否是流式响应：SSE边读边解析，不缓冲整个响应体；原生Gemini响应转换为标准格式
+            aggregator, body = await target.read_completion_body(response, payload.model)
+        finally:
+            await response.aclose()
+            proxy_metrics.observe_upstream_total(api_key, False, time.monotonic() - started)
+        
+        if aggregator is not None:
+            logger.info(f"密钥 [***{api_key[-4:]}] 检测到流式或原生格式响应，转换为标准格式")
+            if aggregator.has_output():
+                logger.info(f"密钥 [***{api_key[-4:]}] 成功解析流式响应，内容长度: {aggregator.content_length}")
+                return aggregator.to_completion()
+            logger.error(f"密钥 [***{api_key[-4:]}] 流式响应中没有任何内容")
+            return None
         
         # 尝试解析标准JSON响应
         try:
-            json_response = response.json()
+            json_response = loads(body)
             logger.info(f"密钥 [***{api_key[-4:]}] 成功解析标准JSON响应")
             return json_response
-        except ValueError as json_error:
+        except DecodeError as json_error:
             logger.error(f"密钥 [***{api_key[-4:]}] JSON解析失败: {json_error}")
-            logger.error(f"密钥 [***{api_key[-4:]}] 原始响应: {response_text}")
+            logger.error(f"密钥 [***{api_key[-4:]}] 原始响应: {body[:1000]!r}")
             return None
             
     except httpx.HTTPStatusError as e:
         logger.error(f"密钥 [***{api_key[-4:]}] 请求失败 (HTTP状态错误): {e.response.status_code} - {e.response.text}")
+        target.record_failure(
+            api_key, e.response.status_code,
+            parse_retry_after(e.response.headers.get("retry-after"), e.response.text),
+            e.response.text)
         return None
     except httpx.RequestError as e:
         logger.error(f"密钥 [***{api_key[-4:]}] 请求失败 (网络或连接错误): {e}")
+        target.record_failure(api_key, 0)
+        if response is None:
+            proxy_metrics.observe_upstream_response(api_key, False, 0)
+            proxy_metrics.observe_upstream_total(api_key, False, time.monotonic() - started)
         return None
     except Exception as e:
         logger.error(f"密钥 [***{api_key[-4:]}] 发生未知错误: {e}")
         return None
 
-async def generate_fake_stream_response(request_data: dict):
+def extract_message_content(result: dict) -> str:
+    """取出响应中第一个choice的消息内容"""
+    return result["choices"][0].get("message", {}).get("content") or ""
+
+def has_enough_output(result: dict) -> bool:
+    """内容长度满足MIN_RESPONSE_LENGTH，或者包含工具调用或推理内容（此时content可以为空）"""
+    return has_structured_output(result) or len(extract_message_content(result)) >= MIN_RESPONSE_LENGTH
+
+def is_usable_response(result: Optional[dict]) -> bool:
+    """判断上游响应格式正确且有足够的输出（见has_enough_output）"""
+    if not result:
+        return False
+    if "choices" not in result or not result["choices"]:
+        logger.warning(f"收到一个格式不正确的响应: {result}")
+        return False
+    
+    if not has_enough_output(result):
+        logger.warning(f"收到一个过短的响应 (长度: {len(extract_message_content(result))}), 已丢弃。")
+        proxy_metrics.record_too_short(False)
+        return False
+    return True
+
+async def fanout_completion(payload: OutboundPayload, policy: SelectionPolicy,
+                            lane: str = LANE_INTERACTIVE) -> Optional[dict]:
     """
-    获取完整的响应内容，然后以流式方式发送给前端。
+    按扇出配置（整组并发或对冲）发送非流式请求，按选择策略返回一个响应。
     """
+    client = get_upstream_client()
+    estimated_tokens = estimate_request_tokens(payload.data)
+    targets = schedule_upstream_targets(estimated_tokens, lane)
     
-    # 获取当前应该使用的API密钥组
-    current_keys = get_current_api_keys()
-    if not current_keys:
-        raise HTTPException(
-            status_code=500,
-            detail="没有可用的API密钥，请检查配置"
-        )
+    async def send(target: UpstreamTarget) -> Optional[dict]:
+        result = None
+        try:
+            result = await send_single_request(client, target, payload)
+            return result
+        finally:
+            usage = (result or {}).get("usage") or {}
+            key_scheduler.release(target.key, estimated_tokens, usage.get("total_tokens") or None)
     
-    logger.info(f"使用第 {2 - current_group_index} 组API密钥进行并发请求")
+    return await run_fanout(
+        targets,
+        send,
+        is_usable_response,
+        hedge_delay=resolve_hedge_delay(FANOUT_CONFIG, completion_latency),
+        tracker=completion_latency,
+        policy=policy,
+    )
+
+async def generate_passthrough_stream_response(payload: OutboundPayload, on_complete=None,
+                                               lane: str = LANE_INTERACTIVE):
+    """
+    并发发起真正的上游流式请求，第一个内容足够长的流胜出并实时转发给前端。
+    所有流式请求均失败时返回None，由调用方回退到伪流式。
+    on_complete在转发结束时调用：完整转发时参数为聚合出的完整响应，中断时为None。
+    """
+    estimated_tokens = estimate_request_tokens(payload.data)
+    targets = schedule_upstream_targets(estimated_tokens, lane)
     
-    async with httpx.AsyncClient() as client:
-        tasks = [
-            asyncio.create_task(send_single_request(client, key, request_data))
-            for key in current_keys
-        ]
-
-        for future in asyncio.as_completed(tasks):
-            try:
-                result = await future
-                
-                if result:
-                    if "choices" in result and result["choices"]:
-                        message_content = result["choices"][0].get("message", {}).get("content", "")
-                        
-                        if len(message_content) >= MIN_RESPONSE_LENGTH:
-                            logger.info(f"找到满足条件的响应 (长度: {len(message_content)}), 开始流式发送。")
-                            
-                            for task in tasks:
-                                if not task.done():
-                                    task.cancel()
-                            
-                            return await stream_response_content(result, message_content)
-                        else:
-                            logger.warning(f"收到一个过短的响应 (长度: {len(message_content)}), 已丢弃。")
-                    else:
-                        logger.warning(f"收到一个格式不正确的响应: {result}")
-
-            except asyncio.CancelledError:
-                logger.info("一个任务被成功取消。")
-            except Exception as e:
-                logger.error(f"处理任务时发生错误: {e}")
+    def release(api_key: str, used_tokens: Optional[int]):
+        key_scheduler.release(api_key, estimated_tokens, used_tokens)
+    
+    stream = await race_upstream_streams(
+        get_upstream_client(),
+        targets,
+        payload,
+        MIN_RESPONSE_LENGTH,
+        REQUEST_TIMEOUT,
+        hedge_delay=resolve_hedge_delay(FANOUT_CONFIG, stream_latency),
+        tracker=stream_latency,
+        release=release,
+    )
+    if stream is None:
+        return None
+    stream.on_complete = on_complete
+    
+    response = StreamingResponse(
+        stream.relay(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "Connection": "keep-alive",
+            "Access-Control-Allow-Origin": "*",
+            "Access-Control-Allow-Headers": "*"
+        }
+    )
+    # 客户端在响应体开始发送前断开时relay不会运行，仍需释放密钥并结束合并请求
+    release_after_body(response, stream.finish)
+    return response
+
+async def generate_fake_stream_response(payload: OutboundPayload, policy: SelectionPolicy, on_complete=None,
+                                        lane: str = LANE_INTERACTIVE, pacing: Optional[Dict[str, Any]] = None):
+    """
+    获取完整的响应内容，然后按pacing的节奏以流式方式发送给前端。
+    """
+    result = await fanout_completion(payload, policy, lane)
+    if result is not None:
+        if on_complete is not None:
+            await on_complete(result)
+        logger.info(f"选出响应 (长度: {len(extract_message_content(result))}), 开始流式发送。")
+        return await stream_response_content(result, pacing)
 
     logger.error("所有并发请求均失败或未返回满足条件的结果。")
     raise HTTPException(
@@ -262,57 +525,21 @@ async def generate_fake_stream_response(request_data: dict):
         detail="所有上游API请求均失败或返回的响应过短，服务暂时不可用。"
     )
 
-async def stream_response_content(result: dict, content: str):
+async def stream_response_content(result: dict, pacing: Optional[Dict[str, Any]] = None):
     """
-    将完整的响应内容以流式方式发送给前端。
+    将完整的响应（推理内容、正文、工具调用和结束原因）以流式方式发送给前端，pacing为空时使用配置中的节奏。
     """
     response_id = result.get("id", f"chatcmpl-{int(time.time())}")
     created_time = result.get("created", int(time.time()))
     model_name = result.get("model", "gemini-2.5-flash")
     
-    async def generate_stream():
-        # 将内容按字符分割，逐个发送
-        chunk_size = max(1, len(content) // 50)  # 分成50个块左右
-        for i in range(0, len(content), chunk_size):
-            chunk = content[i:i+chunk_size]
-            chunk_data = {
-                "id": response_id,
-                "object": "chat.completion.chunk",
-                "created": created_time,
-                "model": model_name,
-                "choices": [
-                    {
-                        "index": 0,
-                        "delta": {
-                            "content": chunk
-                        },
-                        "finish_reason": None
-                    }
-                ]
-            }
-            
-            yield f"data: {json.dumps(chunk_data)}\n\n"
-            await asyncio.sleep(0.01)
-        
-        final_data = {
-            "id": response_id,
-            "object": "chat.completion.chunk",
-            "created": created_time,
-            "model": model_name,
-            "choices": [
-                {
-                    "index": 0,
-                    "delta": {},
-                    "finish_reason": "stop"
-                }
-            ]
-        }
-        
-        yield f"data: {json.dumps(final_data)}\n\n"
-        yield "data: [DONE]\n\n"
+    choice = result["choices"][0]
+    
+    # 增量外壳只序列化一次，每个增量只编码内容
+    envelope = ChunkEnvelope(response_id, created_time, model_name)
     
     return StreamingResponse(
-        generate_stream(),
+        paced_events(envelope, choice.get("message") or {}, pacing or PACING_CONFIG, choice.get("finish_reason")),
         media_type="text/event-stream",
         headers={
             "Cache-Control": "no-cache",
@@ -325,10 +552,37 @@ async def stream_response_content(result: dict, content: str):
 # --- API端点定义 ---
 
 @app.post("/v1/chat/completions")
-async def chat_completions_proxy(chat_request: ChatRequest, request: Request):
+async def chat_completions_proxy(request: Request):
+    """记录请求数和耗时（按是否流式和状态码），流式请求的耗时到响应发送完毕为止"""
+    started = time.monotonic()
+    try:
+        response = await handle_chat_completions(request)
+    except HTTPException as e:
+        proxy_metrics.observe_request(getattr(request.state, "stream", None), e.status_code,
+                                      time.monotonic() - started)
+        raise
+    except Exception:
+        proxy_metrics.observe_request(getattr(request.state, "stream", None), 500, time.monotonic() - started)
+        raise
+
+    def observe():
+        proxy_metrics.observe_request(getattr(request.state, "stream", None), response.status_code,
+                                      time.monotonic() - started)
+
+    if isinstance(response, StreamingResponse):
+        release_after_body(response, observe)
+    else:
+        observe()
+    return response
+
+async def handle_chat_completions(request: Request):
     """
     API密钥认证中间件
     """
+    # 平滑关闭期间不再接受新请求，客户端可以重试或改连其他实例
+    if drain_controller.draining:
+        reject_while_draining()
+    
     api_key_header = request.headers.get("Authorization")
     
     if not api_key_header or not api_key_header.startswith("Bearer "):
@@ -338,72 +592,185 @@ async def chat_completions_proxy(chat_request: ChatRequest, request: Request):
         )
     
     provided_key = api_key_header.split(" ")[1]
-    if provided_key != API_KEY:
+    tenant = tenant_registry.authenticate(provided_key)
+    if tenant is None:
         raise HTTPException(
             status_code=401,
             detail="API密钥无效。"
         )
     
-    logger.info("API密钥认证成功")
-    return await chat_completions_proxy_handler(chat_request, request)
+    logger.info(f"API密钥认证成功 (租户: {tenant.name})")
+    # 请求体只读取和解析一次，只校验代理用到的字段
+    try:
+        body = parse_chat_request(await request.body())
+    except InvalidChatRequest as e:
+        raise HTTPException(status_code=422, detail=e.errors)
+    request.state.stream = body.stream
+    if not drain_controller.enter():
+        reject_while_draining()
+    # 流式响应发送完毕后才算请求结束，平滑关闭会等待它
+    handed_off = False
+    try:
+        response = await chat_completions_proxy_handler(body, request, tenant)
+        if isinstance(response, StreamingResponse):
+            release_after_body(response, drain_controller.exit)
+            handed_off = True
+        return response
+    except ClientDisconnected:
+        # 客户端已经离开，所有未完成的上游请求均已取消，响应不会被读取
+        logger.info("客户端已断开连接，已取消所有未完成的上游请求")
+        return Response(status_code=499)
+    finally:
+        if not handed_off:
+            drain_controller.exit()
+
+async def replay_completion(result: dict, stream: bool, headers: Dict[str, str],
+                            pacing: Optional[Dict[str, Any]] = None):
+    """把一个已有的完整响应（缓存或合并请求的结果）按客户端要求的格式返回"""
+    if stream:
+        response = await stream_response_content(result, pacing)
+    else:
+        response = FastJSONResponse(content=result)
+    response.headers.update(headers)
+    return response
 
-async def chat_completions_proxy_handler(chat_request: ChatRequest, request: Request):
+async def chat_completions_proxy_handler(body: ChatRequestBody, request: Request, tenant):
     """
     代理OpenAI的chat completions端点。
     """
-    current_keys = get_current_api_keys()
-    if not current_keys:
+    request_data = body.data
+
+    # 租户额度：按估算token预扣，请求结束后按实际用量修正
+    try:
+        usage = tenant_registry.begin(tenant, estimate_request_tokens(request_data))
+    except TenantQuotaExceeded as e:
+        logger.warning(f"租户 {tenant.name} 的额度已用完，建议 {math.ceil(e.retry_after)} 秒后重试")
         raise HTTPException(
-            status_code=500,
-            detail="服务器未配置有效的API密钥。请使用GUI配置API密钥。"
+            status_code=429,
+            detail=f"租户 {tenant.name} 的请求额度已用完，请稍后重试。",
+            headers=rate_limit_headers(tenant.capacity(), e.retry_after)
         )
-
-    request_data = await request.json()
-
-    if chat_request.stream:
-        logger.info("检测到流式响应请求，返回流式响应")
-        return await generate_fake_stream_response(request_data)
-
-    current_keys = get_current_api_keys()
-    logger.info(f"使用第 {2 - current_group_index} 组API密钥进行并发请求")
-    
-    async with httpx.AsyncClient() as client:
-        tasks = [
-            asyncio.create_task(send_single_request(client, key, request_data))
-            for key in current_keys
-        ]
-
-        for future in asyncio.as_completed(tasks):
-            try:
-                result = await future
-                
-                if result:
-                    if "choices" in result and result["choices"]:
-                        message_content = result["choices"][0].get("message", {}).get("content", "")
-                        
-                        if len(message_content) >= MIN_RESPONSE_LENGTH:
-                            logger.info(f"找到满足条件的响应 (长度: {len(message_content)}), 立即返回。")
-                            
-                            for task in tasks:
-                                if not task.done():
-                                    task.cancel()
-                            
-                            return JSONResponse(content=result)
-                        else:
-                            logger.warning(f"收到一个过短的响应 (长度: {len(message_content)}), 已丢弃。")
-                    else:
-                        logger.warning(f"收到一个格式不正确的响应: {result}")
-
-            except asyncio.CancelledError:
-                logger.info("一个任务被成功取消。")
-            except Exception as e:
-                logger.error(f"处理任务时发生错误: {e}")
-
-    logger.error("所有并发请求均失败或未返回满足条件的结果。")
-    raise HTTPException(
-        status_code=503,
-        detail="所有上游API请求均失败或返回的响应过短，服务暂时不可用。"
-    )
+    try:
+        return await serve_chat_completion(body, request, request_data, usage)
+    finally:
+        usage.close()
+
+async def serve_chat_completion(body: ChatRequestBody, request: Request, request_data: dict,
+                                usage: TenantUsage):
+    """按缓存、请求合并、准入控制、扇出的顺序处理一个已通过认证和租户额度检查的请求"""
+    tenant = usage.tenant
+    policy = resolve_selection_policy(SELECTION_CONFIG, request.headers)
+    lane = resolve_lane(PRIORITY_CONFIG, request.headers, tenant.priority)
+    pacing = resolve_pacing(PACING_CONFIG, request.headers)
+    payload = build_upstream_payload(request_data)
+    request_key = canonical_request_key(payload)
+    # 发往上游的请求体只编码一次，所有扇出、对冲和重试的尝试共享
+    outbound = OutboundPayload(payload, body.size)
+
+    # 响应缓存：命中时直接返回（流式请求以伪流式回放），未命中时在得到完整响应后写入
+    cache_status = None
+    store_result = None
+    if response_cache is not None and is_cacheable_request(payload, CACHE_CONFIG['deterministic_only']):
+        directives = cache_directives(request.headers)
+        cache_status = "MISS" if directives['read'] else "BYPASS"
+        if directives['read']:
+            cached = await response_cache.get(request_key)
+            if cached is not None:
+                logger.info("命中响应缓存，直接返回")
+                usage.finish(served_locally=True)
+                return await replay_completion(cached, body.stream, {CACHE_STATUS_HEADER: "HIT"}, pacing)
+        
+        async def store_in_cache(result: dict):
+            # 回退得到的过短响应不缓存
+            if has_enough_output(result):
+                await response_cache.put(request_key, result)
+        store_result = store_in_cache if directives['write'] else None
+
+    # 请求合并：相同请求正在进行中时等待并复用它的结果
+    flight = None
+    if COALESCE_CONFIG['enabled']:
+        # 交互请求不等待批量请求的结果，按通道分别合并
+        flight_key = f"{policy.name}:{lane}:{request_key}"
+        existing = single_flight.lookup(flight_key)
+        if existing is not None:
+            logger.info("相同请求正在处理中，等待复用其结果")
+            result = await cancel_on_disconnect(
+                single_flight.follow(existing, COALESCE_CONFIG['follower_timeout']), request.is_disconnected)
+            if result is not None:
+                usage.finish(served_locally=True)
+                return await replay_completion(result, body.stream, {SINGLE_FLIGHT_HEADER: "follower"},
+                                               pacing)
+            logger.warning("合并的请求没有得到可用结果，单独发起请求")
+        flight = single_flight.lead(flight_key)
+
+    async def on_complete(result: Optional[dict]):
+        usage.finish(result)
+        if flight is not None:
+            single_flight.finish(flight, result)
+        if result is not None and store_result is not None:
+            await store_result(result)
+
+    # 真流式转发成功时，由转发结束时的on_complete结束合并请求
+    handed_off = False
+    slot = None
+    try:
+        # 准入控制：并发已满时排队（交互请求排在批量请求之前），队列已满或排队超时立即返回429
+        try:
+            slot = await cancel_on_disconnect(
+                admission.acquire(tenant.name, tenant.weight, tenant_registry.share(tenant), lane),
+                request.is_disconnected)
+        except AdmissionRejected as e:
+            retry_after = max(e.retry_after, key_scheduler.retry_after(estimate_request_tokens(request_data), lane))
+            logger.warning(f"服务繁忙，拒绝请求 ({e.reason})，建议 {math.ceil(retry_after)} 秒后重试")
+            raise HTTPException(
+                status_code=429,
+                detail="服务繁忙，请稍后重试。",
+                headers=rate_limit_headers(key_scheduler.capacity(), retry_after)
+            )
+
+        if body.stream:
+            logger.info("检测到流式响应请求，返回流式响应")
+            response = None
+            # best_of需要比较完整响应，只能使用伪流式
+            if STREAM_MODE == 'passthrough' and policy.first_valid:
+                response = await cancel_on_disconnect(
+                    generate_passthrough_stream_response(outbound, on_complete, lane), request.is_disconnected)
+                handed_off = response is not None
+                if handed_off:
+                    usage.defer()
+                else:
+                    logger.warning("所有真流式请求均失败或过短，回退到伪流式响应")
+            if response is None:
+                response = await cancel_on_disconnect(
+                    generate_fake_stream_response(outbound, policy, on_complete, lane, pacing),
+                    request.is_disconnected)
+            if cache_status:
+                response.headers[CACHE_STATUS_HEADER] = cache_status
+            # 流式响应发送完毕后才释放准入名额
+            release_after_body(response, slot.release)
+            slot = None
+            return response
+
+        result = await cancel_on_disconnect(fanout_completion(outbound, policy, lane), request.is_disconnected)
+        if result is not None:
+            logger.info(f"选出响应 (长度: {len(extract_message_content(result))}), 立即返回。")
+            await on_complete(result)
+            response = FastJSONResponse(content=result)
+            if cache_status:
+                response.headers[CACHE_STATUS_HEADER] = cache_status
+            return response
+
+        logger.error("所有并发请求均失败或未返回满足条件的结果。")
+        raise HTTPException(
+            status_code=503,
+            detail="所有上游API请求均失败或返回的响应过短，服务暂时不可用。"
+        )
+    finally:
+        if slot is not None:
+            slot.release()
+        if flight is not None and not handed_off:
+            # 失败或被取消时通知follower各自单独发起请求（已结束的合并请求不受影响）
+            single_flight.finish(flight, None)
 
 @app.get("/")
 def read_root():
@@ -421,10 +788,24 @@ def read_root():
 @app.get("/health")
 def health_check():
     """健康检查端点"""
-    current_keys = get_current_api_keys()
     return {
-        "status": "healthy",
-        "api_keys_count": len(current_keys),
+        "status": "draining" if drain_controller.draining else "healthy",
+        "api_keys_count": len(KEY_POOL),
+        "fanout_width": FANOUT_WIDTH,
+        "key_health": key_scheduler.health_summary(),
+        "keys": key_scheduler.snapshot(),
+        "upstreams": upstream_router.snapshot(),
+        "warmup": connection_warmer.snapshot(),
+        "json_backend": JSON_BACKEND,
+        "payload_memory": payload_stats.snapshot(),
+        "config_version": config_manager.snapshot.version,
+        "drain": drain_controller.snapshot(),
+        "ledger": key_ledger.snapshot() if key_ledger is not None else None,
+        "cancellations": fanout_stats.snapshot(),
+        "cache": response_cache.snapshot() if response_cache is not None else None,
+        "coalescing": single_flight.snapshot(),
+        "admission": admission.snapshot(),
+        "tenants": tenant_registry.snapshot(),
         "config": {
             "port": PORT,
             "host": HOST,
@@ -433,6 +814,35 @@ def health_check():
         }
     }
 
+@app.get("/metrics")
+def metrics():
+    """Prometheus文本格式的运行指标（多工作进程时为处理本次抓取的进程的指标）"""
+    return Response(content=proxy_metrics.render(), media_type=METRICS_CONTENT_TYPE)
+
+# --- 管理端点 ---
+
+def require_admin(request: Request):
+    """管理端点使用[ADMIN] token认证（未配置时为服务器的api_key）"""
+    if not is_admin_authorized(request.headers, ADMIN_CONFIG['token']):
+        raise HTTPException(status_code=401, detail="管理密钥无效。")
+
+@app.post("/admin/reload")
+def admin_reload(request: Request):
+    """重新加载配置文件，新的密钥池和超时立即对新请求生效，进行中的请求不受影响"""
+    require_admin(request)
+    if not reload_config("管理接口"):
+        raise HTTPException(status_code=500, detail="配置文件无法解析，继续使用当前配置。")
+    return {"status": "reloaded", "version": config_manager.snapshot.version, "api_keys_count": len(KEY_POOL)}
+
+@app.post("/admin/drain")
+async def admin_drain(request: Request, timeout: Optional[float] = None):
+    """平滑关闭：停止接受新请求，等待进行中的请求结束（最多timeout秒）后退出"""
+    require_admin(request)
+    timeout = ADMIN_CONFIG['drain_timeout'] if timeout is None else max(0.0, timeout)
+    if not drain_controller.draining:
+        asyncio.create_task(drain_and_exit(timeout))
+    return {"status": "draining", "in_flight": drain_controller.in_flight, "timeout": timeout}
+
 # --- 运行服务器 ---
 
 if __name__ == "__main__":
@@ -444,9 +854,13 @@ if __name__ == "__main__":
     print("=" * 50)
     
     # 检查是否有有效的API密钥
-    current_keys = get_current_api_keys()
-    if not current_keys:
+    if not KEY_POOL:
         print("警告: 没有配置有效的API密钥，服务可能无法正常工作！")
         print("请使用GUI程序配置API密钥。")
     
-    uvicorn.run(app, host=HOST, port=PORT)
\ No newline at end of file
+    if WORKERS_CONFIG['count'] > 1:
+        # 多工作进程时uvicorn按模块路径在每个子进程中重新导入应用
+        print(f"工作进程数: {WORKERS_CONFIG['count']}，共享密钥状态: {WORKERS_CONFIG['state_path']}")
+        uvicorn.run("llm_proxy:app", host=HOST, port=PORT, workers=WORKERS_CONFIG['count'])
+    else:
+        uvicorn.run(app, host=HOST, port=PORT)
\ No newline at end of file
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本地Gemini模拟服务器
+实现原生generateContent/streamGenerateContent接口，回显最后一条用户消息，用于在没有真实密钥时
+测试原生Gemini后端。使用方法：
+
+    python mock_gemini_server.py --port 8090
+
+然后在config.ini中设置:
+
+    [API]
+    base_url = http://127.0.0.1:8090/v1beta
+    protocol = gemini
+"""
+
+import argparse
+import asyncio
+import json
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+app = FastAPI(title="Mock Gemini API")
+
+
+def _reply_text(body: dict) -> str:
+    contents = body.get("contents") or []
+    parts = contents[-1].get("parts", []) if contents else []
+    prompt = "".join(part.get("text", "") for part in parts)
+    # 回复足够长，满足代理默认的最小响应长度
+    return f"模拟回复: {prompt} " + "这是一段用于测试的模拟内容。" * 40
+
+
+def _usage(body: dict, text: str) -> dict:
+    prompt_tokens = len(json.dumps(body.get("contents") or [], ensure_ascii=False)) // 4
+    candidates_tokens = len(text) // 4
+    return {
+        "promptTokenCount": prompt_tokens,
+        "candidatesTokenCount": candidates_tokens,
+        "totalTokenCount": prompt_tokens + candidates_tokens,
+    }
+
+
+def _thought_parts(body: dict) -> list:
+    thinking_config = (body.get("generationConfig") or {}).get("thinkingConfig") or {}
+    if thinking_config.get("includeThoughts"):
+        return [{"text": f"思考预算: {thinking_config.get('thinkingBudget')}", "thought": True}]
+    return []
+
+
+@app.post("/v1beta/models/{model_action}")
+async def generate(model_action: str, request: Request):
+    model, _, action = model_action.partition(":")
+    if not request.headers.get("x-goog-api-key"):
+        return JSONResponse(status_code=401, content={"error": {"code": 401, "status": "UNAUTHENTICATED"}})
+    body = await request.json()
+    text = _reply_text(body)
+
+    if action == "generateContent":
+        return {
+            "candidates": [{
+                "content": {"role": "model", "parts": _thought_parts(body) + [{"text": text}]},
+                "finishReason": "STOP",
+            }],
+            "usageMetadata": _usage(body, text),
+            "modelVersion": model,
+        }
+
+    if action == "streamGenerateContent":
+        async def events():
+            thoughts = _thought_parts(body)
+            if thoughts:
+                yield f"data: {json.dumps({'candidates': [{'content': {'role': 'model', 'parts': thoughts}}]}, ensure_ascii=False)}\r\n\r\n"
+            for start in range(0, len(text), 40):
+                chunk = {
+                    "candidates": [{"content": {"role": "model", "parts": [{"text": text[start:start + 40]}]}}],
+                    "modelVersion": model,
+                }
+                if start + 40 >= len(text):
+                    chunk["candidates"][0]["finishReason"] = "STOP"
+                    chunk["usageMetadata"] = _usage(body, text)
+                yield f"data: {json.dumps(chunk, ensure_ascii=False)}\r\n\r\n"
+                await asyncio.sleep(0.02)
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return JSONResponse(status_code=404, content={"error": {"code": 404, "status": "NOT_FOUND"}})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="本地Gemini模拟服务器")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    args = parser.parse_args()
+    uvicorn.run(app, host=args.host, port=args.port)
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本地密钥账本服务器
+实现集群模式用到的Redis协议命令子集（数据只保存在内存中），用于在没有Redis时测试集群模式，
+也可以在一台常开的机器上代替Redis。使用方法：
+
+    python mock_ledger_server.py --port 6379
+
+然后在每个代理实例的config.ini中设置:
+
+    [CLUSTER]
+    enabled = true
+    backend_url = redis://<这台机器的地址>:6379/0
+"""
+
+import argparse
+import asyncio
+import time
+from typing import Dict, List, Optional
+
+# 键 -> 哈希（集群模式只使用哈希类型）
+store: Dict[str, Dict[str, str]] = {}
+# 键 -> 过期的时间点
+expires: Dict[str, float] = {}
+
+
+def _encode(value) -> bytes:
+    if value is None:
+        return b"$-1\r\n"
+    if isinstance(value, int):
+        return b":%d\r\n" % value
+    if isinstance(value, list):
+        return b"*%d\r\n" % len(value) + b"".join(_encode(item) for item in value)
+    data = value.encode("utf-8")
+    return b"$%d\r\n%s\r\n" % (len(data), data)
+
+
+def _hash(key: str) -> Optional[Dict[str, str]]:
+    deadline = expires.get(key)
+    if deadline is not None and deadline <= time.monotonic():
+        store.pop(key, None)
+        expires.pop(key, None)
+    return store.get(key)
+
+
+def execute(args: List[str], password: Optional[str], session: Dict[str, bool]) -> bytes:
+    command = args[0].upper()
+    if command == "AUTH":
+        if password is None or args[-1] != password:
+            return b"-WRONGPASS invalid password\r\n"
+        session['authorized'] = True
+        return b"+OK\r\n"
+    if not session['authorized']:
+        return b"-NOAUTH Authentication required.\r\n"
+    if command == "PING":
+        return b"+PONG\r\n"
+    if command == "SELECT":
+        return b"+OK\r\n"
+    if command == "HSET":
+        _hash(args[1])
+        values = store.setdefault(args[1], {})
+        fields = args[2::2]
+        added = sum(1 for field in fields if field not in values)
+        values.update(zip(fields, args[3::2]))
+        return _encode(added)
+    if command == "HGETALL":
+        values = _hash(args[1]) or {}
+        return _encode([item for pair in values.items() for item in pair])
+    if command == "HDEL":
+        values = _hash(args[1]) or {}
+        return _encode(sum(1 for field in args[2:] if values.pop(field, None) is not None))
+    if command == "HINCRBYFLOAT":
+        _hash(args[1])
+        values = store.setdefault(args[1], {})
+        total = float(values.get(args[2], 0)) + float(args[3])
+        values[args[2]] = repr(total)
+        return _encode(repr(total))
+    if command == "DEL":
+        removed = 0
+        for key in args[1:]:
+            removed += _hash(key) is not None
+            store.pop(key, None)
+            expires.pop(key, None)
+        return _encode(removed)
+    if command == "EXPIRE":
+        if _hash(args[1]) is None:
+            return _encode(0)
+        expires[args[1]] = time.monotonic() + int(args[2])
+        return _encode(1)
+    return f"-ERR unknown command '{args[0]}'\r\n".encode("utf-8")
+
+
+async def _read_command(reader: asyncio.StreamReader) -> Optional[List[str]]:
+    line = await reader.readline()
+    if not line:
+        return None
+    if not line.startswith(b"*"):
+        # 内联命令（例如 telnet 中输入 PING）
+        return line.decode("utf-8").split()
+    args = []
+    for _ in range(int(line[1:])):
+        length = int((await reader.readline())[1:])
+        args.append((await reader.readexactly(length + 2))[:-2].decode("utf-8"))
+    return args
+
+
+async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, password: Optional[str]):
+    session = {'authorized': password is None}
+    try:
+        while True:
+            args = await _read_command(reader)
+            if args is None:
+                break
+            if not args:
+                continue
+            if args[0].upper() == "QUIT":
+                writer.write(b"+OK\r\n")
+                break
+            try:
+                writer.write(execute(args, password, session))
+            except (IndexError, ValueError):
+                writer.write(f"-ERR wrong arguments for '{args[0]}' command\r\n".encode("utf-8"))
+            await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(host: str, port: int, password: Optional[str]):
+    server = await asyncio.start_server(lambda r, w: handle(r, w, password), host, port)
+    print(f"密钥账本服务器已启动: redis://{host}:{port}/0")
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="本地密钥账本服务器（Redis协议）")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6379)
+    parser.add_argument("--password", default=None)
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.host, args.port, args.password))
+    except KeyboardInterrupt:
+        pass
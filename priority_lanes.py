@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+优先级通道模块
+请求分为interactive（交互）和batch（批量）两个通道：交互请求优先获得准入名额，
+并优先使用健康、延迟低的密钥；批量请求只使用剩余的额度，在资源紧张时被推迟
+"""
+
+import logging
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+LANE_INTERACTIVE = "interactive"
+LANE_BATCH = "batch"
+LANES = (LANE_INTERACTIVE, LANE_BATCH)
+
+# 客户端按请求选择通道的请求头
+PRIORITY_HEADER = "x-priority"
+
+_LANE_ALIASES = {
+    "interactive": LANE_INTERACTIVE,
+    "high": LANE_INTERACTIVE,
+    "batch": LANE_BATCH,
+    "low": LANE_BATCH,
+    "bulk": LANE_BATCH,
+}
+
+
+def normalize_lane(value: Optional[str]) -> Optional[str]:
+    """把请求头或配置中的优先级名称转换为通道名，无法识别时返回None"""
+    if not value:
+        return None
+    return _LANE_ALIASES.get(value.strip().lower())
+
+
+def resolve_lane(priority_config: Dict[str, Any], headers: Optional[Any] = None,
+                 tenant_lane: Optional[str] = None) -> str:
+    """
+    决定一次请求使用的通道。
+
+    请求头X-Priority优先，其次是租户配置的priority，最后是配置中的default_lane。
+    租户配置为batch时请求头不能把请求提升到interactive，只能降级。
+    """
+    lane = normalize_lane(tenant_lane) or priority_config['default_lane']
+    if headers is not None:
+        requested = headers.get(PRIORITY_HEADER)
+        requested_lane = normalize_lane(requested)
+        if requested_lane is None:
+            if requested:
+                logger.warning(f"请求头指定了未知的优先级 {requested}，使用 {lane}")
+        elif requested_lane == LANE_BATCH or normalize_lane(tenant_lane) != LANE_BATCH:
+            lane = requested_lane
+    return lane
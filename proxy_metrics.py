@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+运行指标模块
+以Prometheus文本格式（/metrics）导出请求量和耗时、每个密钥的上游首字节耗时和总耗时、扇出的胜出和落选、
+过短响应、取消、排队深度和事件循环延迟，用于按数据调整扇出宽度和超时。
+不依赖prometheus_client，指标只保存在当前进程的内存中（多工作进程时每个进程单独导出）。
+"""
+
+import asyncio
+import logging
+import math
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from fanout_engine import fanout_stats
+
+logger = logging.getLogger(__name__)
+
+# Starlette为text/*响应自动追加charset=utf-8
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+# 请求和上游耗时的分桶（秒）
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+# 事件循环延迟的分桶（秒）
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+# 每个客户端请求使用的密钥数的分桶
+KEYS_USED_BUCKETS = (1, 2, 3, 4, 6, 8, 12, 16, 24, 32)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def key_label(key: str) -> str:
+    """指标中只使用密钥的后四位，与日志一致"""
+    return f"***{key[-4:]}"
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(labels: LabelKey, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Histogram:
+    """一个标签组合的分桶计数"""
+
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.sum += value
+        self.count += 1
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+
+
+class MetricFamily:
+    """同名指标的所有标签组合；kind为counter、gauge或histogram"""
+
+    def __init__(self, name: str, kind: str, help_text: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.kind = kind
+        self.help_text = help_text
+        self.buckets = buckets
+        self.series: Dict[LabelKey, Any] = {}
+
+    @staticmethod
+    def _key(labels: Dict[str, Any]) -> LabelKey:
+        return tuple((name, str(value)) for name, value in labels.items())
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.series[key] = self.series.get(key, 0) + amount
+
+    def set(self, value: float, **labels):
+        self.series[self._key(labels)] = value
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        histogram = self.series.get(key)
+        if histogram is None:
+            histogram = self.series[key] = Histogram(self.buckets)
+        histogram.observe(value)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for labels, value in self.series.items():
+            if self.kind != "histogram":
+                lines.append(f"{self.name}{_format_labels(labels)} {_format_value(value)}")
+                continue
+            cumulative = 0
+            for bound, count in zip(value.buckets, value.counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(labels, ('le', _format_value(bound)))} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(labels, ('le', '+Inf'))} {value.count}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(value.sum)}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {value.count}")
+        return lines
+
+
+class ProxyMetrics:
+    """
+    代理的全部指标。
+
+    请求处理路径上只更新内存中的计数；排队深度、扇出统计等已有的状态在抓取时由收集函数读取，
+    不在请求路径上重复记录。
+    """
+
+    def __init__(self):
+        self.requests = MetricFamily(
+            "llm_proxy_requests_total", "counter", "客户端请求数（按是否流式和状态码）")
+        self.request_duration = MetricFamily(
+            "llm_proxy_request_duration_seconds", "histogram",
+            "客户端请求耗时，流式请求到响应发送完毕为止")
+        self.upstream_ttfb = MetricFamily(
+            "llm_proxy_upstream_ttfb_seconds", "histogram", "上游首字节耗时（收到响应头），按密钥后四位")
+        self.upstream_duration = MetricFamily(
+            "llm_proxy_upstream_duration_seconds", "histogram",
+            "上游请求总耗时（读完或关闭响应体），按密钥后四位")
+        self.upstream_responses = MetricFamily(
+            "llm_proxy_upstream_responses_total", "counter", "上游响应数（按密钥后四位和状态码，网络错误为0）")
+        self.too_short = MetricFamily(
+            "llm_proxy_too_short_discarded_total", "counter", "内容短于min_response_length而被丢弃的上游响应数")
+        self.loop_lag = MetricFamily(
+            "llm_proxy_event_loop_lag_seconds", "histogram", "事件循环调度延迟", LAG_BUCKETS)
+        self._families = [self.requests, self.request_duration, self.upstream_ttfb, self.upstream_duration,
+                          self.upstream_responses, self.too_short, self.loop_lag]
+        # 抓取时调用，返回由已有状态生成的指标
+        self._collectors: List[Callable[[], Iterable[MetricFamily]]] = [collect_fanout_metrics]
+        self.last_loop_lag = 0.0
+
+    def add_collector(self, collector: Callable[[], Iterable[MetricFamily]]):
+        self._collectors.append(collector)
+
+    def observe_request(self, stream: Optional[bool], status: int, seconds: float):
+        label = "unknown" if stream is None else ("true" if stream else "false")
+        self.requests.inc(stream=label, status=status)
+        self.request_duration.observe(seconds, stream=label)
+
+    def observe_upstream_response(self, key: str, stream: bool, status: int, ttfb: Optional[float] = None):
+        labels = {"key": key_label(key), "stream": "true" if stream else "false"}
+        self.upstream_responses.inc(status=status, **labels)
+        if ttfb is not None:
+            self.upstream_ttfb.observe(ttfb, **labels)
+
+    def observe_upstream_total(self, key: str, stream: bool, seconds: float):
+        self.upstream_duration.observe(seconds, key=key_label(key), stream="true" if stream else "false")
+
+    def record_too_short(self, stream: bool):
+        self.too_short.inc(stream="true" if stream else "false")
+
+    async def monitor_loop_lag(self, interval: float = 0.5):
+        """后台任务：每隔interval秒测量一次事件循环比预期晚了多久被调度"""
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(interval)
+            self.last_loop_lag = max(0.0, time.monotonic() - started - interval)
+            self.loop_lag.observe(self.last_loop_lag)
+
+    def render(self) -> str:
+        families = list(self._families)
+        for collector in self._collectors:
+            try:
+                families.extend(collector())
+            except Exception as e:
+                logger.error(f"收集指标失败: {e}")
+        lag = MetricFamily("llm_proxy_event_loop_lag_last_seconds", "gauge", "最近一次测量的事件循环延迟")
+        lag.set(self.last_loop_lag)
+        families.append(lag)
+        return "\n".join(line for family in families for line in family.render()) + "\n"
+
+
+def gauge(name: str, help_text: str, value: float, **labels) -> MetricFamily:
+    """只有一个值的仪表指标，供收集函数使用"""
+    family = MetricFamily(name, "gauge", help_text)
+    family.set(value, **labels)
+    return family
+
+
+def collect_fanout_metrics() -> List[MetricFamily]:
+    """扇出的胜出、落选、取消和每个请求使用的密钥数（来自fanout_stats）"""
+    winners = MetricFamily("llm_proxy_fanout_winners_total", "counter",
+                           "选出结果的扇出次数，fallback为回退到过短响应")
+    winners.set(fanout_stats.winners, kind="valid")
+    winners.set(fanout_stats.fallback_winners, kind="fallback")
+    no_winner = MetricFamily("llm_proxy_fanout_no_winner_total", "counter", "没有任何可用结果的扇出次数")
+    no_winner.set(fanout_stats.no_winner)
+    losers = MetricFamily("llm_proxy_fanout_losers_total", "counter",
+                          "未被选中的上游请求数：failed失败或过短，outscored满足条件但未被选中，cancelled选出结果后被取消")
+    for reason, count in fanout_stats.losers.items():
+        losers.set(count, reason=reason)
+    cancellations = MetricFamily("llm_proxy_cancellations_total", "counter",
+                                 "取消次数：client_disconnect客户端提前断开，upstream_cancelled因此被取消的上游请求")
+    cancellations.set(fanout_stats.client_disconnects, kind="client_disconnect")
+    cancellations.set(fanout_stats.upstream_cancelled, kind="upstream_cancelled")
+    keys_used = MetricFamily("llm_proxy_keys_per_request", "histogram",
+                             "每次扇出实际使用的密钥数", KEYS_USED_BUCKETS)
+    histogram = Histogram(KEYS_USED_BUCKETS)
+    for used, count in fanout_stats.keys_used.items():
+        histogram.count += count
+        histogram.sum += used * count
+        for index, bound in enumerate(KEYS_USED_BUCKETS):
+            if used <= bound:
+                histogram.counts[index] += count
+                break
+    keys_used.series[()] = histogram
+    return [winners, no_winner, losers, cancellations, keys_used]
+
+
+def collect_admission_metrics(admission: Any) -> List[MetricFamily]:
+    """准入控制的并发数和排队深度（按通道）"""
+    snapshot = admission.snapshot()
+    active = MetricFamily("llm_proxy_active_requests", "gauge", "正在处理的请求数（按通道）")
+    for lane, count in snapshot['active_by_lane'].items():
+        active.set(count, lane=lane)
+    queued = MetricFamily("llm_proxy_queue_depth", "gauge", "准入队列中等待的请求数（按通道）")
+    for lane, count in snapshot['queued_by_lane'].items():
+        queued.set(count, lane=lane)
+    rejected = MetricFamily("llm_proxy_admission_rejected_total", "counter", "准入控制拒绝的请求数")
+    rejected.set(snapshot['rejected_queue_full'], reason="queue_full")
+    rejected.set(snapshot['rejected_timeout'], reason="timeout")
+    return [active, queued, rejected]
+
+
+def collect_key_metrics(scheduler: Any) -> List[MetricFamily]:
+    """每个密钥的并发数（含其他工作进程或实例）和熔断状态"""
+    in_flight = MetricFamily("llm_proxy_key_in_flight", "gauge", "使用中的请求数（按密钥后四位，含其他进程）")
+    available = MetricFamily("llm_proxy_key_available", "gauge", "密钥的熔断器是否允许请求（1为允许）")
+    now = time.monotonic()
+    for state in scheduler.states.values():
+        in_flight.set(state.in_flight + state.remote_in_flight, key=key_label(state.key))
+        available.set(1 if state.breaker.allows(now) else 0, key=key_label(state.key))
+    return [in_flight, available]
+
+
+proxy_metrics = ProxyMetrics()
@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+请求解析模块
+请求体只读取和解析一次，只校验代理需要的字段；安装了msgspec时messages按类型校验
+（每条消息必须有role，content为字符串、数组或null），同时保留原始JSON字节，
+OpenAI兼容后端转发时直接拼接进上游请求体，多模态请求中的大段base64不必解码再编码。
+发往上游的请求体每个客户端请求只编码一次，扇出、对冲和重试的所有尝试共享同一个bytes
+"""
+
+import logging
+import re
+import threading
+import weakref
+from typing import Any, Callable, Dict, List, Tuple, Union
+
+from json_codec import DecodeError, dumps_bytes, loads
+
+try:
+    import msgspec
+    MSGSPEC_AVAILABLE = True
+except ImportError:
+    MSGSPEC_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+# 保留为原始JSON、需要时才解析的字段
+RAW_FIELDS = ('messages',)
+
+if MSGSPEC_AVAILABLE:
+    # 只切分顶层字段，各字段的值保持为原始字节
+    _FIELD_DECODER = msgspec.json.Decoder(Dict[str, msgspec.Raw])
+
+    class Message(msgspec.Struct):
+        """校验用的消息类型：只声明代理校验的字段，其他字段（name、tool_calls等）忽略；
+        content为数组时各部分保持为原始字节，不解码其中的base64"""
+        role: str
+        content: Union[str, List[msgspec.Raw], None] = None
+
+    _MESSAGES_DECODER = msgspec.json.Decoder(List[Message])
+
+# msgspec校验错误中的位置，例如 `$[0].content`
+_ERROR_PATH = re.compile(r"\[(\d+)\]|\.([^.\[]+)")
+_MISSING_FIELD = re.compile(r"missing required field `([^`]+)`")
+
+
+class RawJSON:
+    """请求中一段未解析的JSON，第一次访问value时才解析"""
+
+    __slots__ = ("raw", "_value", "_decoded")
+
+    def __init__(self, raw: Any):
+        # bytes或msgspec.Raw（引用原始请求体，不复制）
+        self.raw = raw
+        self._value = None
+        self._decoded = False
+
+    @property
+    def value(self) -> Any:
+        if not self._decoded:
+            self._value = loads(bytes(self.raw))
+            self._decoded = True
+        return self._value
+
+    @property
+    def size(self) -> int:
+        return memoryview(self.raw).nbytes
+
+
+def json_value(value: Any) -> Any:
+    """返回字段的Python值，RawJSON在此时解析"""
+    return value.value if isinstance(value, RawJSON) else value
+
+
+def encode_payload(payload: Dict[str, Any]) -> bytes:
+    """
+    把请求参数编码为JSON请求体。RawJSON字段的原始字节直接拼接，不重新序列化，
+    这是转发大请求的快速路径。
+    """
+    raw_fields = [(name, value) for name, value in payload.items() if isinstance(value, RawJSON)]
+    if not raw_fields:
+        return dumps_bytes(payload)
+
+    rest = {name: value for name, value in payload.items() if not isinstance(value, RawJSON)}
+    parts = [dumps_bytes(rest)[:-1] if rest else b"{"]
+    for index, (name, value) in enumerate(raw_fields):
+        if rest or index:
+            parts.append(b",")
+        parts.append(dumps_bytes(name))
+        parts.append(b":")
+        parts.append(value.raw)
+    parts.append(b"}")
+    return b"".join(parts)
+
+
+class InvalidChatRequest(Exception):
+    """请求体不是合法的chat completions请求，errors的格式与FastAPI的422响应相同"""
+
+    def __init__(self, errors: List[Dict[str, Any]]):
+        super().__init__(errors)
+        self.errors = errors
+
+
+def _error(field: str, message: str, error_type: str) -> Dict[str, Any]:
+    return {"loc": ["body", field] if field else ["body"], "msg": message, "type": error_type}
+
+
+class ChatRequestBody:
+    """解析后的请求体：data为顶层字段（messages可能是RawJSON），size为请求体字节数"""
+
+    __slots__ = ("data", "size")
+
+    def __init__(self, data: Dict[str, Any], size: int):
+        self.data = data
+        self.size = size
+
+    @property
+    def stream(self) -> bool:
+        return bool(self.data.get("stream"))
+
+    @property
+    def model(self) -> str:
+        return self.data["model"]
+
+
+def _message_errors(messages: List[Any]) -> List[Dict[str, Any]]:
+    """校验已解析的消息列表，规则与msgspec的Message相同"""
+    errors = []
+    for index, message in enumerate(messages):
+        loc = ["body", "messages", index]
+        if not isinstance(message, dict):
+            errors.append({"loc": loc, "msg": "Input should be a valid dictionary", "type": "dict_type"})
+            continue
+        if "role" not in message:
+            errors.append({"loc": loc + ["role"], "msg": "Field required", "type": "missing"})
+        elif not isinstance(message["role"], str):
+            errors.append({"loc": loc + ["role"], "msg": "Input should be a valid string", "type": "string_type"})
+        content = message.get("content")
+        if content is not None and not isinstance(content, (str, list)):
+            errors.append({"loc": loc + ["content"], "msg": "Input should be a valid string, list or null",
+                           "type": "type_error"})
+    return errors
+
+
+def _raw_message_errors(messages: RawJSON) -> List[Dict[str, Any]]:
+    """按Message类型解码原始的messages（只用于校验，转发时仍使用原始字节）"""
+    try:
+        _MESSAGES_DECODER.decode(messages.raw)
+    except msgspec.ValidationError as e:
+        message, _, path = str(e).partition(" - at ")
+        if not path:
+            # messages本身不是数组
+            return [_error("messages", "Input should be a valid list", "list_type")]
+        loc: List[Any] = ["body", "messages"]
+        for index, name in _ERROR_PATH.findall(path.strip("`").lstrip("$")):
+            loc.append(int(index) if index else name)
+        missing = _MISSING_FIELD.search(message)
+        if missing:
+            return [{"loc": loc + [missing.group(1)], "msg": "Field required", "type": "missing"}]
+        return [{"loc": loc, "msg": message, "type": "type_error"}]
+    return []
+
+
+def _validate(data: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """只校验代理本身用到的字段，其余字段原样转发给上游"""
+    errors = []
+    model = data.get("model")
+    if model is None:
+        errors.append(_error("model", "Field required", "missing"))
+    elif not isinstance(model, str):
+        errors.append(_error("model", "Input should be a valid string", "string_type"))
+
+    messages = data.get("messages")
+    if messages is None:
+        errors.append(_error("messages", "Field required", "missing"))
+    elif isinstance(messages, RawJSON):
+        errors.extend(_raw_message_errors(messages))
+    elif not isinstance(messages, list):
+        errors.append(_error("messages", "Input should be a valid list", "list_type"))
+    else:
+        errors.extend(_message_errors(messages))
+
+    if data.get("stream") is not None and not isinstance(data["stream"], bool):
+        errors.append(_error("stream", "Input should be a valid boolean", "bool_type"))
+    for field in ("temperature", "top_p", "max_tokens"):
+        value = data.get(field)
+        if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float))):
+            errors.append(_error(field, "Input should be a valid number", "float_type"))
+    # 原生Gemini参数，转发时作为整数的thinkingBudget发送
+    thinking_budget = data.get("thinking_budget")
+    if thinking_budget is not None and (isinstance(thinking_budget, bool) or not isinstance(thinking_budget, int)):
+        errors.append(_error("thinking_budget", "Input should be a valid integer", "int_type"))
+    return errors
+
+
+def parse_chat_request(body: bytes) -> ChatRequestBody:
+    """
+    解析chat completions请求体，不合法时抛出InvalidChatRequest。
+
+    安装了msgspec时只切分顶层字段，messages按Message类型校验后保留为RawJSON（原始字节）；
+    否则用当前JSON后端完整解析一次。
+    """
+    try:
+        if MSGSPEC_AVAILABLE:
+            fields = _FIELD_DECODER.decode(body)
+            data = {name: RawJSON(raw) if name in RAW_FIELDS else loads(bytes(raw))
+                    for name, raw in fields.items()}
+        else:
+            data = loads(body)
+    except DecodeError as e:
+        if MSGSPEC_AVAILABLE and isinstance(e, msgspec.ValidationError):
+            # 顶层不是对象
+            data = None
+        else:
+            raise InvalidChatRequest([_error("", f"JSON decode error: {e}", "json_invalid")])
+    if not isinstance(data, dict):
+        raise InvalidChatRequest([_error("", "Input should be a valid dictionary", "dict_type")])
+
+    errors = _validate(data)
+    if errors:
+        raise InvalidChatRequest(errors)
+    return ChatRequestBody(data, len(body))
+
+
+class PayloadMemoryStats:
+    """
+    请求体占用内存的统计：客户端请求体和编码后的上游请求体在OutboundPayload存活期间计入，
+    对象被回收时扣除；shared_bytes为共享请求体而免去的编码和复制字节数。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.live_bytes = 0
+        self.peak_bytes = 0
+        self.live_payloads = 0
+        self.total_payloads = 0
+        self.largest_payload = 0
+        self.encodes = 0
+        self.sends = 0
+        self.shared_bytes = 0
+
+    def acquire(self, size: int):
+        with self._lock:
+            self.live_payloads += 1
+            self.total_payloads += 1
+            self._add(size)
+
+    def grow(self, size: int):
+        with self._lock:
+            self.encodes += 1
+            self._add(size)
+
+    def _add(self, size: int):
+        self.live_bytes += size
+        self.peak_bytes = max(self.peak_bytes, self.live_bytes)
+
+    def record_send(self, size: int, shared: bool):
+        with self._lock:
+            self.sends += 1
+            if shared:
+                self.shared_bytes += size
+
+    def release(self, usage: List[int]):
+        """OutboundPayload被回收时调用，usage为[该请求计入的字节数]"""
+        with self._lock:
+            self.live_payloads -= 1
+            self.live_bytes -= usage[0]
+            self.largest_payload = max(self.largest_payload, usage[0])
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "live_payloads": self.live_payloads,
+                "live_bytes": self.live_bytes,
+                "peak_bytes": self.peak_bytes,
+                "largest_payload_bytes": self.largest_payload,
+                "total_payloads": self.total_payloads,
+                "encodes": self.encodes,
+                "sends": self.sends,
+                "shared_bytes": self.shared_bytes,
+            }
+
+
+payload_stats = PayloadMemoryStats()
+
+
+class OutboundPayload:
+    """
+    一个客户端请求发往上游的请求参数。
+
+    每种请求体（由后端的body_key区分，例如OpenAI兼容接口的流式和非流式请求）只编码一次，
+    编码结果为不可变的bytes，所有上游尝试只更换认证请求头，共享同一个请求体。
+    """
+
+    __slots__ = ("data", "request_bytes", "_bodies", "_usage", "__weakref__")
+
+    def __init__(self, data: Dict[str, Any], request_bytes: int = 0):
+        self.data = data
+        # 客户端请求体的大小（RawJSON字段引用其中的字节）
+        self.request_bytes = request_bytes
+        self._bodies: Dict[Any, bytes] = {}
+        self._usage = [request_bytes]
+        payload_stats.acquire(request_bytes)
+        weakref.finalize(self, payload_stats.release, self._usage)
+
+    @property
+    def model(self) -> str:
+        return self.data.get("model", "")
+
+    def body(self, key: Tuple[Any, ...], encode: Callable[[Dict[str, Any]], bytes]) -> bytes:
+        """返回key对应的请求体，第一次请求时调用encode(data)编码"""
+        body = self._bodies.get(key)
+        shared = body is not None
+        if body is None:
+            body = self._bodies[key] = encode(self.data)
+            self._usage[0] += len(body)
+            payload_stats.grow(len(body))
+        payload_stats.record_send(len(body), shared)
+        return body
+
+    @property
+    def encoded_bytes(self) -> int:
+        return sum(len(body) for body in self._bodies.values())
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+响应缓存模块
+以清理后请求参数的规范化哈希为键，缓存完整的chat.completion响应：
+内存中按LRU淘汰并限制总字节数和TTL，可选的SQLite磁盘层在重启后仍然有效
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from json_codec import dumps_bytes, loads
+from request_ingest import RawJSON
+
+logger = logging.getLogger(__name__)
+
+# 客户端绕过缓存的请求头
+CACHE_BYPASS_HEADER = "x-cache-bypass"
+
+# 缓存结果在响应头中的标记
+CACHE_STATUS_HEADER = "X-Cache"
+
+
+def canonical_request_key(payload: Dict[str, Any]) -> str:
+    """
+    计算清理后请求参数的规范化哈希，键的顺序和空白不影响结果。
+
+    未解析的RawJSON字段（如messages）按原始字节参与哈希，不为计算缓存键而解析；
+    此时这些字段内部的空白和键顺序不同会得到不同的键，只影响命中率，不影响正确性。
+    """
+    # 固定使用标准库json，使缓存键不随JSON后端变化（磁盘缓存跨重启仍然有效）
+    rest = {key: value for key, value in payload.items() if not isinstance(value, RawJSON)}
+    canonical = json.dumps(rest, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    digest = hashlib.sha256(canonical.encode("utf-8"))
+    for key in sorted(key for key, value in payload.items() if isinstance(value, RawJSON)):
+        digest.update(b"\0" + key.encode("utf-8") + b"\0")
+        digest.update(payload[key].raw)
+    return digest.hexdigest()
+
+
+def cache_directives(headers: Any) -> Dict[str, bool]:
+    """
+    解析请求的缓存指令。
+
+    Cache-Control: no-cache 跳过读取但仍写入新结果；
+    Cache-Control: no-store 或 X-Cache-Bypass: 1 既不读取也不写入。
+    """
+    cache_control = (headers.get("cache-control") or "").lower()
+    bypass = (headers.get(CACHE_BYPASS_HEADER) or "").strip().lower() in ("1", "true", "yes")
+    no_store = bypass or "no-store" in cache_control
+    return {
+        "read": not no_store and "no-cache" not in cache_control,
+        "write": not no_store,
+    }
+
+
+class DiskCacheTier:
+    """基于SQLite的磁盘缓存层，所有操作在线程池中执行，不阻塞事件循环"""
+
+    def __init__(self, path: str, max_entries: int):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS response_cache ("
+            "key TEXT PRIMARY KEY, expires_at REAL NOT NULL, "
+            "stored_at REAL NOT NULL, body BLOB NOT NULL)"
+        )
+        self._conn.commit()
+        self._prune()
+
+    def _get(self, key: str) -> Optional[tuple]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT expires_at, body FROM response_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and row[0] <= time.time():
+                self._conn.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+                self._conn.commit()
+                return None
+            return row
+
+    def _put(self, key: str, expires_at: float, body: bytes):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO response_cache (key, expires_at, stored_at, body) "
+                "VALUES (?, ?, ?, ?)", (key, expires_at, time.time(), body)
+            )
+            self._conn.commit()
+
+    def _prune(self):
+        """删除过期条目，并在超过条目上限时删除最早写入的条目"""
+        with self._lock:
+            self._conn.execute("DELETE FROM response_cache WHERE expires_at <= ?", (time.time(),))
+            if self.max_entries > 0:
+                self._conn.execute(
+                    "DELETE FROM response_cache WHERE key NOT IN ("
+                    "SELECT key FROM response_cache ORDER BY stored_at DESC LIMIT ?)",
+                    (self.max_entries,)
+                )
+            self._conn.commit()
+
+    async def get(self, key: str) -> Optional[tuple]:
+        return await asyncio.to_thread(self._get, key)
+
+    async def put(self, key: str, expires_at: float, body: bytes):
+        await asyncio.to_thread(self._put, key, expires_at, body)
+
+    async def prune(self):
+        await asyncio.to_thread(self._prune)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class ResponseCache:
+    """内存LRU缓存，可选SQLite磁盘层"""
+
+    # 每写入这么多条目清理一次磁盘层
+    PRUNE_EVERY = 200
+
+    def __init__(self, ttl: float, max_entries: int, max_bytes: int, max_entry_bytes: int,
+                 disk_path: str = "", disk_max_entries: int = 10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        # key -> (过期时间, 序列化后的响应)
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.current_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self._writes_since_prune = 0
+
+        self.disk: Optional[DiskCacheTier] = None
+        if disk_path:
+            try:
+                self.disk = DiskCacheTier(disk_path, disk_max_entries)
+                logger.info(f"响应缓存磁盘层已启用: {disk_path}")
+            except sqlite3.Error as e:
+                logger.error(f"无法打开响应缓存数据库 {disk_path}，仅使用内存缓存: {e}")
+
+    def _remember(self, key: str, expires_at: float, body: bytes):
+        """写入内存层，并按条目数和总字节数淘汰最久未使用的条目"""
+        if key in self._entries:
+            self.current_bytes -= len(self._entries.pop(key)[1])
+        self._entries[key] = (expires_at, body)
+        self.current_bytes += len(body)
+        while self._entries and (
+                (self.max_entries > 0 and len(self._entries) > self.max_entries)
+                or self.current_bytes > self.max_bytes):
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self.current_bytes -= len(evicted)
+            self.evictions += 1
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """读取缓存的响应，未命中或已过期时返回None"""
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return loads(entry[1])
+            self.current_bytes -= len(self._entries.pop(key)[1])
+
+        if self.disk is not None:
+            try:
+                row = await self.disk.get(key)
+            except sqlite3.Error as e:
+                logger.error(f"读取响应缓存数据库失败: {e}")
+                row = None
+            if row is not None:
+                expires_at, body = row
+                self._remember(key, expires_at, bytes(body))
+                self.hits += 1
+                self.disk_hits += 1
+                return loads(body)
+
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, result: Dict[str, Any]):
+        """缓存一个完整的响应，超过单条大小上限的响应不缓存"""
+        body = dumps_bytes(result)
+        if len(body) > self.max_entry_bytes:
+            return
+        expires_at = time.time() + self.ttl
+        self._remember(key, expires_at, body)
+        self.stores += 1
+
+        if self.disk is not None:
+            try:
+                await self.disk.put(key, expires_at, body)
+                self._writes_since_prune += 1
+                if self._writes_since_prune >= self.PRUNE_EVERY:
+                    self._writes_since_prune = 0
+                    await self.disk.prune()
+            except sqlite3.Error as e:
+                logger.error(f"写入响应缓存数据库失败: {e}")
+
+    def close(self):
+        if self.disk is not None:
+            self.disk.close()
+            self.disk = None
+
+    def snapshot(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.current_bytes,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "disk_enabled": self.disk is not None,
+        }
+
+
+def is_cacheable_request(payload: Dict[str, Any], deterministic_only: bool) -> bool:
+    """deterministic_only时只缓存temperature为0的请求，其他请求每次结果不同，不应复用"""
+    if not deterministic_only:
+        return True
+    try:
+        return float(payload.get("temperature", 1)) == 0
+    except (TypeError, ValueError):
+        return False
+
+
+def create_response_cache(cache_config: Dict[str, Any]) -> Optional[ResponseCache]:
+    """按配置创建响应缓存，未启用时返回None"""
+    if not cache_config['enabled']:
+        return None
+    return ResponseCache(
+        ttl=cache_config['ttl'],
+        max_entries=cache_config['max_entries'],
+        max_bytes=cache_config['max_bytes'],
+        max_entry_bytes=cache_config['max_entry_bytes'],
+        disk_path=cache_config['disk_path'],
+        disk_max_entries=cache_config['disk_max_entries'],
+    )
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+响应选择策略模块
+决定扇出请求在收到多个上游响应时何时返回、返回哪一个：
+first_valid 第一个满足条件的响应立即返回；
+best_of 在截止时间内收集最多N个满足条件的响应，按评分函数选出最好的一个。
+两种策略都可以在没有满足条件的响应时回退到评分最高的过短响应，而不是返回503。
+"""
+
+import logging
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+POLICY_FIRST_VALID = "first_valid"
+POLICY_BEST_OF = "best_of"
+POLICIES = (POLICY_FIRST_VALID, POLICY_BEST_OF)
+
+# 客户端按请求选择策略的请求头
+POLICY_HEADER = "x-selection-policy"
+DEADLINE_HEADER = "x-selection-deadline"
+
+
+def response_content(result: Any) -> str:
+    """取出响应中第一个choice的消息内容，格式不正确时返回空字符串"""
+    try:
+        return result["choices"][0].get("message", {}).get("content") or ""
+    except (KeyError, IndexError, TypeError, AttributeError):
+        return ""
+
+
+def has_structured_output(result: Any) -> bool:
+    """第一个choice是否包含工具调用或推理内容，这类响应的content可以为空"""
+    try:
+        message = result["choices"][0].get("message") or {}
+    except (KeyError, IndexError, TypeError, AttributeError):
+        return False
+    return bool(message.get("tool_calls") or message.get("reasoning_content"))
+
+
+def output_length(result: Any) -> int:
+    """第一个choice的输出长度：内容、推理内容和工具调用（函数名和参数）的字符数之和"""
+    try:
+        message = result["choices"][0].get("message") or {}
+    except (KeyError, IndexError, TypeError, AttributeError):
+        return 0
+    length = len(message.get("content") or "") + len(message.get("reasoning_content") or "")
+    for tool_call in message.get("tool_calls") or []:
+        function = tool_call.get("function") or {}
+        length += len(function.get("name") or "") + len(function.get("arguments") or "")
+    return length
+
+
+def score_by_length(result: Any) -> float:
+    """按输出长度评分（含推理内容和工具调用）"""
+    return float(output_length(result))
+
+
+def score_by_completion(result: Any) -> float:
+    """正常结束（finish_reason为stop或tool_calls）的响应优先，其次按输出长度评分"""
+    try:
+        finished = result["choices"][0].get("finish_reason") in ("stop", "tool_calls")
+    except (KeyError, IndexError, TypeError, AttributeError):
+        finished = False
+    length = output_length(result)
+    return length + (1e9 if finished and length else 0)
+
+
+SCORERS: Dict[str, Callable[[Any], float]] = {
+    "length": score_by_length,
+    "completion": score_by_completion,
+}
+
+
+def register_scorer(name: str, scorer: Callable[[Any], float]):
+    """注册自定义评分函数，之后可以在配置的scorer中按名称使用"""
+    SCORERS[name] = scorer
+
+
+class SelectionPolicy:
+    """一次扇出请求使用的响应选择策略"""
+
+    def __init__(self, name: str = POLICY_FIRST_VALID, deadline: float = 15.0, best_of: int = 0,
+                 fallback_short: bool = True, scorer: str = "length"):
+        self.name = name if name in POLICIES else POLICY_FIRST_VALID
+        self.deadline = max(0.0, deadline)
+        # 0表示不限数量，收集截止时间内所有满足条件的响应
+        self.best_of = max(0, best_of)
+        self.fallback_short = fallback_short
+        if scorer not in SCORERS:
+            logger.warning(f"未知的评分函数 {scorer}，使用length")
+            scorer = "length"
+        self.scorer_name = scorer
+
+    @property
+    def first_valid(self) -> bool:
+        return self.name == POLICY_FIRST_VALID
+
+    def score(self, result: Any) -> float:
+        return SCORERS[self.scorer_name](result)
+
+    def is_enough(self, candidates: int) -> bool:
+        """已收集的满足条件的响应数量是否足以立即做出选择"""
+        if self.first_valid:
+            return candidates >= 1
+        return self.best_of > 0 and candidates >= self.best_of
+
+    def accepts_fallback(self, result: Any) -> bool:
+        """过短响应能否作为回退候选：只接受有内容的响应"""
+        return self.fallback_short and self.score(result) > 0
+
+    def __repr__(self):
+        return (f"SelectionPolicy({self.name}, deadline={self.deadline}, best_of={self.best_of}, "
+                f"fallback_short={self.fallback_short}, scorer={self.scorer_name})")
+
+
+def resolve_selection_policy(selection_config: Dict[str, Any],
+                             headers: Optional[Any] = None) -> SelectionPolicy:
+    """
+    根据配置创建本次请求的选择策略，请求头中的X-Selection-Policy和
+    X-Selection-Deadline可以覆盖配置中的策略和截止时间。
+    """
+    name = selection_config['policy']
+    deadline = selection_config['deadline']
+    if headers is not None:
+        requested = (headers.get(POLICY_HEADER) or "").strip().lower()
+        if requested in POLICIES:
+            name = requested
+        elif requested:
+            logger.warning(f"请求头指定了未知的选择策略 {requested}，使用配置中的 {name}")
+        try:
+            deadline = float(headers.get(DEADLINE_HEADER) or deadline)
+        except ValueError:
+            logger.warning(f"请求头中的截止时间无效: {headers.get(DEADLINE_HEADER)}")
+    return SelectionPolicy(
+        name,
+        deadline=deadline,
+        best_of=selection_config['best_of'],
+        fallback_short=selection_config['fallback_short'],
+        scorer=selection_config['scorer'],
+    )
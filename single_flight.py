@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+请求合并模块（single-flight）
+相同的请求同时到达时，只有第一个请求（leader）真正向上游扇出，
+其余请求（follower）等待并复用它的结果，无论它们要求JSON还是流式响应
+"""
+
+import asyncio
+import logging
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# 标记响应来自合并请求的响应头
+SINGLE_FLIGHT_HEADER = "X-Single-Flight"
+
+
+class Flight:
+    """一个正在进行中的上游请求"""
+
+    __slots__ = ("key", "future", "followers")
+
+    def __init__(self, key: str):
+        self.key = key
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.followers = 0
+
+
+class SingleFlight:
+    """按请求键合并同时进行的相同请求"""
+
+    def __init__(self):
+        self._flights: Dict[str, Flight] = {}
+        self.leaders = 0
+        self.followers = 0
+
+    def lookup(self, key: str) -> Optional[Flight]:
+        """返回该键正在进行中的请求，没有时返回None"""
+        return self._flights.get(key)
+
+    def lead(self, key: str) -> Flight:
+        """登记一个新的进行中请求，调用方负责在结束时调用finish"""
+        flight = Flight(key)
+        self._flights[key] = flight
+        self.leaders += 1
+        return flight
+
+    def finish(self, flight: Flight, result: Optional[Any]):
+        """
+        结束一个进行中请求并把结果交给所有follower；result为None表示失败，
+        follower会各自单独发起请求。重复调用时只有第一次生效。
+        """
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+        if not flight.future.done():
+            flight.future.set_result(result)
+            if flight.followers:
+                logger.info(f"合并请求已完成，结果共享给 {flight.followers} 个相同请求")
+
+    async def follow(self, flight: Flight, timeout: float) -> Optional[Any]:
+        """等待进行中请求的结果，超时或leader失败时返回None"""
+        flight.followers += 1
+        self.followers += 1
+        try:
+            # shield: 某个follower断开时不能取消共享的结果
+            return await asyncio.wait_for(asyncio.shield(flight.future), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"等待合并请求的结果超过 {timeout} 秒")
+            return None
+
+    def snapshot(self) -> Dict[str, int]:
+        return {
+            "in_flight": len(self._flights),
+            "leaders": self.leaders,
+            "followers": self.followers,
+        }
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+增量SSE解析模块
+按字节增量解码上游的Server-Sent Events，把每个事件解析为类型化的增量，
+供聚合（非流式）路径和真流式转发路径共同使用
+"""
+
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from json_codec import DecodeError, loads
+
+
+class SSEDecoder:
+    """
+    字节级增量SSE解码器
+
+    可以逐块喂入从socket读到的字节，正确处理跨块拆分的行和多字节UTF-8字符，
+    每遇到空行就产出一个完整事件的data内容。
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._scan_pos = 0
+        self._data_lines: List[str] = []
+
+    def feed(self, chunk: bytes) -> List[str]:
+        """喂入一块字节，返回本次解析出的完整事件data列表"""
+        self._buffer.extend(chunk)
+        events = []
+        start = 0
+        while True:
+            newline = self._buffer.find(b"\n", max(start, self._scan_pos))
+            if newline == -1:
+                break
+            line = bytes(self._buffer[start:newline]).rstrip(b"\r")
+            start = newline + 1
+            event = self._process_line(line)
+            if event is not None:
+                events.append(event)
+
+        if start:
+            del self._buffer[:start]
+        # 下次只需从未扫描过的位置开始查找换行，避免长行被反复扫描
+        self._scan_pos = len(self._buffer)
+        return events
+
+    def flush(self) -> List[str]:
+        """流结束时调用，处理残留的不完整行和未以空行结尾的事件"""
+        events = []
+        if self._buffer:
+            line = bytes(self._buffer).rstrip(b"\r")
+            self._buffer.clear()
+            self._scan_pos = 0
+            event = self._process_line(line)
+            if event is not None:
+                events.append(event)
+        if self._data_lines:
+            events.append("\n".join(self._data_lines))
+            self._data_lines = []
+        return events
+
+    def _process_line(self, line: bytes) -> Optional[str]:
+        if not line:
+            # 空行表示一个事件结束
+            if not self._data_lines:
+                return None
+            data = "\n".join(self._data_lines)
+            self._data_lines = []
+            return data
+
+        if line.startswith(b":"):
+            # 注释行（常用作心跳）
+            return None
+
+        field, _, value = line.partition(b":")
+        if value.startswith(b" "):
+            value = value[1:]
+        if field == b"data":
+            self._data_lines.append(value.decode("utf-8", errors="replace"))
+        return None
+
+
+class ChunkEvent:
+    """一个解析后的chat.completion.chunk增量事件"""
+
+    __slots__ = ("raw", "done", "data", "id", "model", "created",
+                 "content", "reasoning_content", "tool_calls", "finish_reason", "usage")
+
+    def __init__(self, raw: str, data: Optional[Dict[str, Any]] = None, done: bool = False):
+        self.raw = raw
+        self.done = done
+        self.data = data
+        self.id = None
+        self.model = None
+        self.created = None
+        self.content = None
+        self.reasoning_content = None
+        self.tool_calls = None
+        self.finish_reason = None
+        self.usage = None
+
+        if data is None:
+            return
+        self.id = data.get("id")
+        self.model = data.get("model")
+        self.created = data.get("created")
+        self.usage = data.get("usage")
+        choices = data.get("choices")
+        if choices:
+            choice = choices[0]
+            delta = choice.get("delta") or {}
+            self.content = delta.get("content")
+            self.reasoning_content = delta.get("reasoning_content") or delta.get("reasoning")
+            self.tool_calls = delta.get("tool_calls")
+            self.finish_reason = choice.get("finish_reason")
+
+
+def parse_chunk_event(raw: str) -> Optional[ChunkEvent]:
+    """把一个SSE事件的data解析为ChunkEvent，无法解析时返回None"""
+    if raw.strip() == "[DONE]":
+        return ChunkEvent(raw, done=True)
+    try:
+        data = loads(raw)
+    except DecodeError:
+        return None
+    if not isinstance(data, dict):
+        return None
+    return ChunkEvent(raw, data)
+
+
+async def aiter_chunk_events(byte_stream: AsyncIterator[bytes]) -> AsyncIterator[ChunkEvent]:
+    """从字节流中逐个产出ChunkEvent"""
+    decoder = SSEDecoder()
+    async for chunk in byte_stream:
+        for raw in decoder.feed(chunk):
+            event = parse_chunk_event(raw)
+            if event is not None:
+                yield event
+    for raw in decoder.flush():
+        event = parse_chunk_event(raw)
+        if event is not None:
+            yield event
+
+
+class StreamAggregator:
+    """把增量事件聚合为完整的chat.completion响应，内容使用列表拼接保证线性复杂度"""
+
+    def __init__(self):
+        self.id = ""
+        self.model = ""
+        self.created = int(time.time())
+        self.finish_reason = None
+        self.usage = None
+        self.content_length = 0
+        self._content_parts: List[str] = []
+        self._reasoning_parts: List[str] = []
+        self._tool_calls: Dict[int, Dict[str, Any]] = {}
+
+    def add(self, event: ChunkEvent):
+        """合并一个增量事件"""
+        if event.done:
+            return
+        if event.id:
+            self.id = event.id
+        if event.model:
+            self.model = event.model
+        if event.created:
+            self.created = event.created
+        if event.usage:
+            self.usage = event.usage
+        if event.finish_reason:
+            self.finish_reason = event.finish_reason
+        if event.content:
+            self._content_parts.append(event.content)
+            self.content_length += len(event.content)
+        if event.reasoning_content:
+            self._reasoning_parts.append(event.reasoning_content)
+        if event.tool_calls:
+            for position, tool_delta in enumerate(event.tool_calls):
+                self._add_tool_call(tool_delta.get("index", position), tool_delta)
+
+    def _add_tool_call(self, index: int, tool_delta: Dict[str, Any]):
+        tool_call = self._tool_calls.setdefault(index, {
+            "id": "",
+            "type": "function",
+            "function": {"name": "", "arguments": []}
+        })
+        if tool_delta.get("id"):
+            tool_call["id"] = tool_delta["id"]
+        if tool_delta.get("type"):
+            tool_call["type"] = tool_delta["type"]
+        function = tool_delta.get("function") or {}
+        if function.get("name"):
+            tool_call["function"]["name"] += function["name"]
+        if function.get("arguments"):
+            tool_call["function"]["arguments"].append(function["arguments"])
+
+    @property
+    def content(self) -> str:
+        return "".join(self._content_parts)
+
+    def has_output(self) -> bool:
+        """是否收到了任何内容、推理或工具调用"""
+        return bool(self._content_parts or self._reasoning_parts or self._tool_calls)
+
+    def has_structured_output(self) -> bool:
+        """是否收到了推理内容或工具调用，这类响应的content可以为空"""
+        return bool(self._reasoning_parts or self._tool_calls)
+
+    def to_completion(self, default_model: str = "gemini-2.5-flash") -> Dict[str, Any]:
+        """生成与OpenAI兼容的chat.completion响应"""
+        tool_calls = []
+        for index in sorted(self._tool_calls):
+            tool_call = self._tool_calls[index]
+            tool_calls.append({
+                "id": tool_call["id"],
+                "type": tool_call["type"],
+                "function": {
+                    "name": tool_call["function"]["name"],
+                    "arguments": "".join(tool_call["function"]["arguments"])
+                }
+            })
+
+        finish_reason = self.finish_reason or ("tool_calls" if tool_calls else "stop")
+        # 没有推理内容或工具调用时不输出这两个字段，与上游的非流式响应一致
+        message = {"role": "assistant", "content": self.content}
+        if self._reasoning_parts:
+            message["reasoning_content"] = "".join(self._reasoning_parts)
+        if tool_calls:
+            message["tool_calls"] = tool_calls
+        return {
+            "id": self.id or "chatcmpl-" + str(int(time.time())),
+            "object": "chat.completion",
+            "created": self.created,
+            "model": self.model or default_model,
+            "choices": [
+                {
+                    "index": 0,
+                    "message": message,
+                    "finish_reason": finish_reason
+                }
+            ],
+            "usage": self.usage or {
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+                "total_tokens": 0
+            }
+        }
+
+
+def aggregate_sse_bytes(body: bytes) -> StreamAggregator:
+    """聚合一个已经完整读取的SSE响应体"""
+    decoder = SSEDecoder()
+    aggregator = StreamAggregator()
+    for raw in decoder.feed(body) + decoder.flush():
+        event = parse_chunk_event(raw)
+        if event is not None:
+            aggregator.add(event)
+    return aggregator
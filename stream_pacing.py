@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+伪流式节奏模块
+把完整的响应（推理内容、正文和工具调用）切分为SSE增量发送给客户端，支持四种节奏：
+slices平均切分为约50段、每段之间等待frame_delay秒（默认，与早期版本的伪流式相同）；
+instant一次性发送；fixed按固定字节数切分；rate按目标token速率在词边界切分。
+没有等待的连续增量合并为一次写入，减少小包和系统调用
+"""
+
+import asyncio
+import logging
+import re
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
+from json_codec import SSE_DONE, ChunkEnvelope
+
+logger = logging.getLogger(__name__)
+
+PACING_SLICES = "slices"
+PACING_INSTANT = "instant"
+PACING_FIXED = "fixed"
+PACING_RATE = "rate"
+PACING_MODES = (PACING_SLICES, PACING_INSTANT, PACING_FIXED, PACING_RATE)
+
+# 客户端按请求选择节奏的请求头，例如 slices:100、instant、fixed:256、rate:80
+PACING_HEADER = "x-stream-pacing"
+
+# 一个"词"：一个中日韩字符，或一段非空白字符，连同其后的空白
+_CJK = "\u3040-\u30ff\u3400-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef"
+_WORD_PATTERN = re.compile(rf"(?:[{_CJK}]|[^\s{_CJK}]+)\s*|\s+")
+
+
+def resolve_pacing(pacing_config: Dict[str, Any], headers: Optional[Any] = None) -> Dict[str, Any]:
+    """
+    决定一次请求的伪流式节奏。请求头X-Stream-Pacing优先于配置：
+    值为模式名，slices、fixed和rate可以在冒号后指定段数、每帧字节数或每秒token数。
+    """
+    pacing = dict(pacing_config)
+    value = headers.get(PACING_HEADER) if headers is not None else None
+    if not value:
+        return pacing
+
+    mode, _, argument = value.strip().lower().partition(":")
+    if mode not in PACING_MODES:
+        logger.warning(f"请求头指定了未知的流式节奏 {value}，使用 {pacing['mode']}")
+        return pacing
+    pacing['mode'] = mode
+    try:
+        if argument and mode == PACING_SLICES:
+            pacing['slices'] = max(1, int(argument))
+        elif argument and mode == PACING_FIXED:
+            pacing['frame_bytes'] = max(1, int(argument))
+        elif argument and mode == PACING_RATE:
+            pacing['tokens_per_second'] = max(1.0, float(argument))
+    except ValueError:
+        logger.warning(f"请求头中的流式节奏参数无效: {value}")
+    return pacing
+
+
+def split_slices(content: str, slices: int) -> List[str]:
+    """按字符数平均切分为约slices段"""
+    size = max(1, len(content) // slices)
+    return [content[index:index + size] for index in range(0, len(content), size)]
+
+
+def split_fixed(content: str, frame_bytes: int) -> List[str]:
+    """
+    按UTF-8编码后的字节数切分，每帧不超过frame_bytes字节且不拆分字符；
+    帧内有空白时在最后一个空白之后切分，避免把单词拆到两帧。
+    """
+    frames: List[str] = []
+    start = 0
+    size = 0
+    last_space = -1
+    for index, char in enumerate(content):
+        char_bytes = len(char.encode("utf-8"))
+        if size + char_bytes > frame_bytes and index > start:
+            cut = index
+            # 空白之后的部分不超过半帧时在空白处切分
+            if last_space >= start and last_space + 1 > start + (index - start) // 2:
+                remainder = len(content[last_space + 1:index].encode("utf-8"))
+                if remainder + char_bytes <= frame_bytes:
+                    cut = last_space + 1
+            frames.append(content[start:cut])
+            size = len(content[cut:index].encode("utf-8"))
+            start = cut
+        size += char_bytes
+        if char.isspace():
+            last_space = index
+    if start < len(content):
+        frames.append(content[start:])
+    return frames
+
+
+def _word_tokens(word: str) -> float:
+    """一个词的大致token数：中日韩字符各算一个，其他文本约4个字符一个"""
+    stripped = word.strip()
+    if not stripped:
+        return 0.0
+    if len(stripped) == 1 and re.match(rf"[{_CJK}]", stripped):
+        return 1.0
+    return max(1.0, len(stripped) / 4)
+
+
+def split_rate(content: str, tokens_per_frame: float) -> List[str]:
+    """按词边界切分，每帧约tokens_per_frame个token"""
+    frames: List[str] = []
+    frame: List[str] = []
+    tokens = 0.0
+    for match in _WORD_PATTERN.finditer(content):
+        word = match.group(0)
+        frame.append(word)
+        tokens += _word_tokens(word)
+        if tokens >= tokens_per_frame:
+            frames.append("".join(frame))
+            frame = []
+            tokens = 0.0
+    if frame:
+        frames.append("".join(frame))
+    return frames
+
+
+def plan_frames(content: str, pacing: Dict[str, Any]) -> Iterator[Tuple[str, float]]:
+    """产出(帧内容, 发送该帧后的等待秒数)"""
+    mode = pacing['mode']
+    if mode == PACING_INSTANT or not content:
+        frames, delay = [content] if content else [], 0.0
+    elif mode == PACING_SLICES:
+        frames, delay = split_slices(content, pacing['slices']), pacing['frame_delay']
+    elif mode == PACING_FIXED:
+        frames, delay = split_fixed(content, pacing['frame_bytes']), pacing['frame_delay']
+    else:
+        interval = pacing['frame_interval']
+        frames = split_rate(content, max(1.0, pacing['tokens_per_second'] * interval))
+        delay = interval
+        # 总时长超过max_duration时按比例缩短每帧的等待
+        if pacing['max_duration'] > 0 and len(frames) * delay > pacing['max_duration']:
+            delay = pacing['max_duration'] / len(frames)
+
+    for index, frame in enumerate(frames):
+        yield frame, delay if index < len(frames) - 1 else 0.0
+
+
+def _message_events(envelope: ChunkEnvelope, message: Dict[str, Any],
+                    pacing: Dict[str, Any]) -> Iterator[Tuple[bytes, float]]:
+    """产出(SSE事件, 发送后的等待秒数)：先推理内容，再正文，工具调用在正文之后作为一个增量"""
+    reasoning = message.get("reasoning_content") or ""
+    for frame, delay in plan_frames(reasoning, pacing):
+        yield envelope.delta({"reasoning_content": frame}), delay
+    for frame, delay in plan_frames(message.get("content") or "", pacing):
+        yield envelope.content(frame), delay
+    tool_calls = message.get("tool_calls")
+    if tool_calls:
+        yield envelope.delta({"tool_calls": [dict(tool_call, index=index)
+                                             for index, tool_call in enumerate(tool_calls)]}), 0.0
+
+
+async def paced_events(envelope: ChunkEnvelope, message: Dict[str, Any], pacing: Dict[str, Any],
+                       finish_reason: Optional[str] = None) -> AsyncIterator[bytes]:
+    """
+    把一个完整的消息按节奏产出为SSE事件字节串，最后一个增量带finish_reason
+    （未指定时有工具调用为tool_calls，否则为stop）。
+    两次等待之间的事件合并为一次写入，单次写入超过coalesce_bytes时提前发送。
+    """
+    coalesce_bytes = pacing['coalesce_bytes']
+    buffer: List[bytes] = []
+    buffered = 0
+    for event, delay in _message_events(envelope, message, pacing):
+        buffer.append(event)
+        buffered += len(event)
+        if delay > 0 or buffered >= coalesce_bytes:
+            yield b"".join(buffer)
+            buffer = []
+            buffered = 0
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    buffer.append(envelope.delta({}, finish_reason or ("tool_calls" if message.get("tool_calls") else "stop")))
+    buffer.append(SSE_DONE)
+    yield b"".join(buffer)
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+多租户模块
+每个下游客户端密钥对应一个租户，拥有独立的请求/token额度、调度权重和用量统计；
+未单独配置租户时，服务器配置中的API密钥作为default租户
+"""
+
+import hmac
+import logging
+import math
+import time
+from typing import Any, Dict, List, Optional
+
+from key_scheduler import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TENANT = "default"
+
+
+class Tenant:
+    """一个下游租户的额度与用量"""
+
+    def __init__(self, name: str, key: str, weight: float = 1.0, rpm: int = 0, tpm: int = 0, rpd: int = 0,
+                 priority: str = ""):
+        self.name = name
+        self.key = key
+        self.weight = max(0.01, float(weight))
+        # 该租户请求默认使用的优先级通道，空字符串表示使用全局默认值
+        self.priority = priority
+        self.rpm = TokenBucket(rpm, 60)
+        self.tpm = TokenBucket(tpm, 60)
+        self.rpd = TokenBucket(rpd, 86400)
+        self.requests = 0
+        self.rejected = 0
+        self.served_locally = 0
+        self.failed = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.total_tokens = 0
+        self.in_flight = 0
+
+    def retry_after(self, estimated_tokens: int) -> float:
+        """额度不足时需要等待的秒数，额度充足时返回0"""
+        now = time.monotonic()
+        return max(self.rpm.time_until(1, now), self.rpd.time_until(1, now),
+                   self.tpm.time_until(estimated_tokens, now))
+
+    def capacity(self) -> Dict[str, Dict[str, float]]:
+        """该租户的每分钟请求数和token额度，格式与KeyScheduler.capacity相同"""
+        now = time.monotonic()
+        result = {}
+        for name, bucket in (("requests", self.rpm), ("tokens", self.tpm)):
+            if bucket.unlimited:
+                continue
+            remaining = max(0.0, bucket.available(now))
+            result[name] = {
+                "limit": bucket.capacity,
+                "remaining": math.floor(remaining),
+                "reset": (bucket.capacity - remaining) / bucket.rate,
+            }
+        return result
+
+    def snapshot(self) -> Dict[str, Any]:
+        now = time.monotonic()
+
+        def fmt(bucket: TokenBucket):
+            return None if bucket.unlimited else round(bucket.available(now), 1)
+        return {
+            "tenant": self.name,
+            "weight": self.weight,
+            "priority": self.priority or None,
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "rejected": self.rejected,
+            "served_locally": self.served_locally,
+            "failed": self.failed,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "total_tokens": self.total_tokens,
+            "rpm_remaining": fmt(self.rpm),
+            "tpm_remaining": fmt(self.tpm),
+            "rpd_remaining": fmt(self.rpd),
+        }
+
+
+class TenantUsage:
+    """
+    一次请求对租户额度的占用。
+
+    开始时按估算token扣减额度，结束时按实际用量修正；finish可以重复调用，只有第一次生效。
+    """
+
+    def __init__(self, tenant: Tenant, estimated_tokens: int, ledger: Any = None):
+        self.tenant = tenant
+        self.estimated_tokens = estimated_tokens
+        self.ledger = ledger
+        self._finished = False
+        self._deferred = False
+
+    def defer(self):
+        """请求结束的时间推迟到流式转发结束，由转发结束时调用finish"""
+        self._deferred = True
+
+    def close(self):
+        """请求处理结束时调用：没有推迟且还没有结束时按失败结束"""
+        if not self._deferred:
+            self.finish()
+
+    def finish(self, result: Optional[Dict[str, Any]] = None, served_locally: bool = False):
+        """
+        结束本次请求。result为上游的完整响应（用于统计token），
+        served_locally表示由缓存或合并请求直接返回，没有消耗上游额度。
+        """
+        if self._finished:
+            return
+        self._finished = True
+        tenant = self.tenant
+        tenant.in_flight = max(0, tenant.in_flight - 1)
+
+        usage = (result or {}).get("usage") or {}
+        used_tokens = usage.get("total_tokens") or 0
+        if served_locally:
+            tenant.served_locally += 1
+            used_tokens = 0
+        elif result is None:
+            tenant.failed += 1
+        else:
+            tenant.prompt_tokens += usage.get("prompt_tokens") or 0
+            tenant.completion_tokens += usage.get("completion_tokens") or 0
+            tenant.total_tokens += used_tokens
+
+        # 按实际用量修正预扣的token额度；没有用量信息的上游响应保留估算值
+        if served_locally or result is None or used_tokens:
+            difference = used_tokens - self.estimated_tokens
+            if difference and self.ledger is not None:
+                self.ledger.record_tenant_usage(tenant.name, 0, difference)
+            if difference > 0:
+                tenant.tpm.consume(difference)
+            else:
+                tenant.tpm.refund(-difference)
+
+
+class TenantQuotaExceeded(Exception):
+    """租户额度不足"""
+
+    def __init__(self, tenant: Tenant, retry_after: float):
+        super().__init__(tenant.name)
+        self.tenant = tenant
+        self.retry_after = retry_after
+
+
+class TenantRegistry:
+    """按客户端密钥查找租户"""
+
+    def __init__(self, tenants: List[Tenant]):
+        self.tenants = {tenant.name: tenant for tenant in tenants}
+        # 多工作进程或集群模式时由KeyLedger.attach_tenants设置，租户额度在所有进程间共享
+        self.ledger: Any = None
+
+    @property
+    def total_weight(self) -> float:
+        return sum(tenant.weight for tenant in self.tenants.values()) or 1.0
+
+    def share(self, tenant: Tenant) -> float:
+        """租户权重占全部租户权重的比例"""
+        return tenant.weight / self.total_weight
+
+    def authenticate(self, client_key: str) -> Optional[Tenant]:
+        """按客户端密钥查找租户，使用常量时间比较"""
+        if not client_key:
+            return None
+        for tenant in self.tenants.values():
+            if hmac.compare_digest(tenant.key.encode("utf-8"), client_key.encode("utf-8")):
+                return tenant
+        return None
+
+    def begin(self, tenant: Tenant, estimated_tokens: int) -> TenantUsage:
+        """检查并扣减租户额度，额度不足时抛出TenantQuotaExceeded"""
+        retry_after = tenant.retry_after(estimated_tokens)
+        if retry_after > 0:
+            tenant.rejected += 1
+            raise TenantQuotaExceeded(tenant, retry_after)
+
+        now = time.monotonic()
+        tenant.rpm.consume(1, now)
+        tenant.rpd.consume(1, now)
+        tenant.tpm.consume(estimated_tokens, now)
+        tenant.requests += 1
+        tenant.in_flight += 1
+        if self.ledger is not None:
+            self.ledger.record_tenant_usage(tenant.name, 1, estimated_tokens)
+        return TenantUsage(tenant, estimated_tokens, self.ledger)
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        return [tenant.snapshot() for tenant in self.tenants.values()]
+
+
+def build_tenant_registry(server_api_key: str, tenant_configs: Dict[str, Dict[str, Any]]) -> TenantRegistry:
+    """
+    根据配置创建租户表。服务器配置的API密钥总是作为default租户可用，
+    除非某个租户显式使用了同一个密钥。
+    """
+    tenants = []
+    for name, options in tenant_configs.items():
+        key = options.get("key", "")
+        if not key:
+            logger.warning(f"租户 {name} 没有配置客户端密钥，已忽略")
+            continue
+        tenants.append(Tenant(
+            name, key,
+            weight=options.get("weight", 1.0),
+            rpm=options.get("rpm", 0),
+            tpm=options.get("tpm", 0),
+            rpd=options.get("rpd", 0),
+            priority=options.get("priority", ""),
+        ))
+
+    if server_api_key and all(tenant.key != server_api_key for tenant in tenants) \
+            and DEFAULT_TENANT not in {tenant.name for tenant in tenants}:
+        tenants.insert(0, Tenant(DEFAULT_TENANT, server_api_key))
+    return TenantRegistry(tenants)
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+上游路由模块
+可以配置多个上游（Gemini官方端点、区域中转、自建镜像），每个上游有自己的密钥池和协议
+（OpenAI兼容接口或原生Gemini接口）；
+按首字节耗时和错误率的指数加权移动平均为上游排序，错误率过高的上游自动让位给其他上游，
+长时间没有样本的上游会定期收到一个探测请求，使延迟变化能及时反映到排序中
+"""
+
+import logging
+import math
+import time
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
+import httpx
+
+from backend_adapters import BACKEND_OPENAI, GEMINI_OPTIONS, create_backend
+from key_scheduler import KeyScheduler, build_key_pool
+from priority_lanes import LANE_INTERACTIVE
+from request_ingest import OutboundPayload
+from sse_parser import ChunkEvent, StreamAggregator
+
+logger = logging.getLogger(__name__)
+
+# 没有单独配置上游时使用的上游名称
+DEFAULT_UPSTREAM = "default"
+
+# OpenAI兼容接口相对于base_url的默认路径（Gemini的OpenAI兼容端点）
+DEFAULT_CHAT_PATH = "/openai/chat/completions"
+
+
+class UpstreamEndpoint:
+    """一个上游端点及其延迟和错误率统计"""
+
+    def __init__(self, name: str, base_url: str, keys: List[str], path: str = DEFAULT_CHAT_PATH,
+                 backend: Optional[Any] = None):
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        self.path = path if path.startswith("/") else f"/{path}"
+        self.keys = keys
+        self.key_set = set(keys)
+        # 请求的构造和响应的解析方式（OpenAIBackend或GeminiBackend）
+        self.backend = backend or create_backend(BACKEND_OPENAI)
+        # 首字节耗时（秒）和错误率的指数加权移动平均
+        self.ttfb: Optional[float] = None
+        self.error_rate = 0.0
+        self.requests = 0
+        self.failures = 0
+        self.last_sample = 0.0
+        self.probe_started = 0.0
+
+    @property
+    def url(self) -> str:
+        return f"{self.base_url}{self.path}"
+
+    def record(self, alpha: float, latency: Optional[float] = None, failed: bool = False):
+        self.requests += 1
+        self.last_sample = time.monotonic()
+        if failed:
+            self.failures += 1
+        self.error_rate = (1 - alpha) * self.error_rate + alpha * (1.0 if failed else 0.0)
+        if latency is not None:
+            self.ttfb = latency if self.ttfb is None else (1 - alpha) * self.ttfb + alpha * latency
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "base_url": self.base_url,
+            "protocol": self.backend.name,
+            "keys": len(self.keys),
+            "ttfb_ms": None if self.ttfb is None else round(self.ttfb * 1000),
+            "error_rate": round(self.error_rate, 3),
+            "requests": self.requests,
+            "failures": self.failures,
+        }
+
+
+class UpstreamTarget:
+    """
+    一次上游请求的目标：上游端点加密钥。
+
+    实现与KeyScheduler相同的record_success/record_failure接口，可以直接作为key_health使用，
+    上报的结果同时更新密钥熔断器和上游的延迟、错误率统计；请求的构造和响应的解析交给上游的后端。
+    """
+
+    __slots__ = ("router", "upstream", "key", "failed")
+
+    def __init__(self, router: "UpstreamRouter", upstream: UpstreamEndpoint, key: str):
+        self.router = router
+        self.upstream = upstream
+        self.key = key
+        # 本次请求因上游本身的问题（网络错误或5xx）失败
+        self.failed = False
+
+    @property
+    def url(self) -> str:
+        return self.upstream.url
+
+    def build_request(self, client: httpx.AsyncClient, payload: OutboundPayload, stream: bool,
+                      timeout: float) -> httpx.Request:
+        upstream = self.upstream
+        return upstream.backend.build_request(client, upstream.base_url, upstream.path, self.key,
+                                              payload, stream, timeout)
+
+    async def read_completion_body(self, response: httpx.Response,
+                                   model: str = "") -> Tuple[Optional[StreamAggregator], bytes]:
+        return await self.upstream.backend.read_completion_body(response, model)
+
+    def stream_events(self, response: httpx.Response, model: str = "") -> AsyncIterator[ChunkEvent]:
+        return self.upstream.backend.stream_events(response, model)
+
+    def record_success(self, api_key: str, latency: Optional[float] = None):
+        self.router.scheduler.record_success(api_key, latency)
+        self.upstream.record(self.router.alpha, latency)
+
+    def record_failure(self, api_key: str, status_code: int, retry_after: Optional[float] = None,
+                       body: str = ""):
+        """status_code为0表示网络或连接错误"""
+        self.router.scheduler.record_failure(api_key, status_code, retry_after, body)
+        # 429和其他4xx是密钥或请求本身的问题，只有网络错误和5xx计入上游错误率
+        if status_code == 0 or status_code >= 500:
+            self.failed = True
+            self.upstream.record(self.router.alpha, failed=True)
+
+    def __repr__(self):
+        return f"UpstreamTarget({self.upstream.name}, ***{self.key[-4:]})"
+
+
+class UpstreamRouter:
+    """在多个上游之间按延迟和错误率分配请求，所有上游的密钥共用一个KeyScheduler"""
+
+    def __init__(self, scheduler: KeyScheduler, upstreams: List[UpstreamEndpoint],
+                 routing_config: Dict[str, Any]):
+        self.scheduler = scheduler
+        self.upstreams: List[UpstreamEndpoint] = []
+        self.configure(routing_config)
+        self.update_upstreams(upstreams)
+
+    def configure(self, routing_config: Dict[str, Any]):
+        self.alpha = routing_config['ewma_alpha']
+        self.error_penalty = routing_config['error_penalty']
+        self.failover_error_rate = routing_config['failover_error_rate']
+        self.probe_interval = routing_config['probe_interval']
+
+    def update_upstreams(self, upstreams: List[UpstreamEndpoint]):
+        """更新上游列表，保留名称和地址都未变化的上游的统计数据，并同步密钥池"""
+        existing = {(upstream.name, upstream.url): upstream for upstream in self.upstreams}
+        updated = []
+        for upstream in upstreams:
+            previous = existing.get((upstream.name, upstream.url))
+            if previous is not None:
+                previous.keys = upstream.keys
+                previous.key_set = upstream.key_set
+                previous.backend = upstream.backend
+                upstream = previous
+            updated.append(upstream)
+        self.upstreams = updated
+        self.scheduler.update_keys(self.keys)
+
+    @property
+    def keys(self) -> List[str]:
+        """所有上游的密钥（去重），同一个密钥在不同上游共用额度和熔断状态"""
+        return build_key_pool(*(upstream.keys for upstream in self.upstreams))
+
+    def _rank_key(self, upstream: UpstreamEndpoint, now: float):
+        unhealthy = upstream.error_rate >= self.failover_error_rate
+        # 长时间没有样本的上游（包括从未使用过的）优先收到一个探测请求
+        probe = (now - upstream.last_sample >= self.probe_interval
+                 and now - upstream.probe_started >= self.probe_interval)
+        if upstream.ttfb is None:
+            score = math.inf
+        else:
+            score = upstream.ttfb * (1 + self.error_penalty * upstream.error_rate)
+        return (not probe, unhealthy, score, upstream.error_rate)
+
+    def rank(self) -> List[UpstreamEndpoint]:
+        """
+        按优先顺序排列的上游：需要探测的在前（错误率过高的上游也借此恢复），
+        其次是健康的上游，同一类中按错误率加权后的首字节耗时排序
+        """
+        now = time.monotonic()
+        return sorted(self.upstreams, key=lambda upstream: self._rank_key(upstream, now))
+
+    def acquire(self, estimated_tokens: int = 0, exclude: Optional[List[str]] = None,
+                lane: str = LANE_INTERACTIVE) -> Optional[UpstreamTarget]:
+        """按上游排序依次尝试分配密钥，排在前面的上游没有可用密钥时自动使用下一个"""
+        exclude = exclude or []
+        all_keys = self.scheduler.keys
+        for upstream in self.rank():
+            foreign = [key for key in all_keys if key not in upstream.key_set]
+            key = self.scheduler.acquire(estimated_tokens, exclude=foreign + exclude, lane=lane)
+            if key is None:
+                continue
+            now = time.monotonic()
+            if now - upstream.last_sample >= self.probe_interval:
+                upstream.probe_started = now
+            return UpstreamTarget(self, upstream, key)
+        return None
+
+    def iter_targets(self, width: int, estimated_tokens: int = 0,
+                     lane: str = LANE_INTERACTIVE) -> Iterator[UpstreamTarget]:
+        """
+        按需逐个分配最多width个使用不同密钥的目标，每次分配时重新为上游排序。
+
+        已分配的目标因上游本身的问题失败时，额外再分配一个目标（通常落在另一个上游），
+        使对冲模式下上游故障可以在同一次请求内切换到其他上游。
+        """
+        used: List[str] = []
+        targets: List[UpstreamTarget] = []
+        while len(used) < width + sum(1 for target in targets if target.failed):
+            target = self.acquire(estimated_tokens, exclude=used, lane=lane)
+            if target is None:
+                return
+            used.append(target.key)
+            targets.append(target)
+            yield target
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        now = time.monotonic()
+        ranked = self.rank()
+        result = []
+        for upstream in self.upstreams:
+            entry = upstream.snapshot()
+            entry["rank"] = ranked.index(upstream) + 1
+            entry["healthy"] = not self._rank_key(upstream, now)[1]
+            result.append(entry)
+        return result
+
+
+def build_upstreams(base_url: str, default_keys: List[str],
+                    upstream_configs: Dict[str, Dict[str, Any]], protocol: str = BACKEND_OPENAI,
+                    gemini_options: Optional[Dict[str, Any]] = None) -> List[UpstreamEndpoint]:
+    """
+    根据配置创建上游列表。没有配置[UPSTREAMS]时只有一个使用[API] base_url、protocol和主密钥池的
+    default上游；某个上游没有配置keys时使用主密钥池，没有配置protocol时使用[API]的protocol，
+    thinking_budget、include_thoughts、safety_threshold覆盖[GEMINI]中的默认值。
+    """
+    gemini_options = gemini_options or {}
+
+    def default_upstream():
+        return UpstreamEndpoint(DEFAULT_UPSTREAM, base_url, default_keys,
+                                backend=create_backend(protocol, gemini_options))
+
+    if not upstream_configs:
+        return [default_upstream()]
+
+    upstreams = []
+    for name, options in upstream_configs.items():
+        url = options.get("base_url", "")
+        if not url:
+            logger.warning(f"上游 {name} 没有配置base_url，已忽略")
+            continue
+        keys = build_key_pool(options["keys"]) if "keys" in options else default_keys
+        backend_options = dict(gemini_options)
+        backend_options.update({option: options[option] for option in GEMINI_OPTIONS if option in options})
+        backend = create_backend(options.get("protocol", protocol), backend_options)
+        upstreams.append(UpstreamEndpoint(name, url, keys, options.get("path", DEFAULT_CHAT_PATH), backend))
+    if not upstreams:
+        logger.warning("[UPSTREAMS]中没有有效的上游，使用[API] base_url")
+        return [default_upstream()]
+    return upstreams
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+上游真流式转发模块
+使用httpx流式读取上游SSE，在内容满足最小长度后立即把增量转发给客户端
+"""
+
+import logging
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, List, Optional
+
+import httpx
+
+from backend_adapters import NATIVE_PARAMS, SUPPORTED_PARAMS
+from fanout_engine import LatencyTracker, run_fanout
+from key_scheduler import parse_retry_after
+from proxy_metrics import proxy_metrics
+from request_ingest import OutboundPayload
+from sse_parser import ChunkEvent, StreamAggregator
+
+logger = logging.getLogger(__name__)
+
+
+def build_upstream_payload(request_data: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    清理请求数据，只保留上游支持的参数。
+
+    原生Gemini参数（思考预算、安全设置等）也会保留，由各后端决定是否发送；
+    它们同样是响应缓存和请求合并的键的一部分。
+    """
+    return {key: value for key, value in request_data.items()
+            if key in SUPPORTED_PARAMS or key in NATIVE_PARAMS}
+
+
+class UpstreamStream:
+    """一个已经建立并预读过的上游流式响应"""
+
+    def __init__(self, api_key: str, response: httpx.Response, events: AsyncIterator[ChunkEvent],
+                 on_close: Optional[Callable[[str, Optional[int]], None]] = None,
+                 started: Optional[float] = None):
+        self.api_key = api_key
+        # 发出上游请求的时间，关闭时记录上游总耗时（只记录一次）
+        self.started: Optional[float] = time.monotonic() if started is None else started
+        self.response = response
+        self.events = events
+        self.on_close = on_close
+        self.buffered: List[ChunkEvent] = []
+        self.aggregator = StreamAggregator()
+        self.finished = False
+        # 转发结束后调用：完整转发时参数为聚合出的chat.completion，中断时为None
+        self.on_complete: Optional[Callable[[Optional[Dict[str, Any]]], Awaitable[None]]] = None
+
+    @property
+    def content_length(self) -> int:
+        return self.aggregator.content_length
+
+    def has_enough_output(self, min_length: int) -> bool:
+        """内容长度达到min_length，或者收到了工具调用或推理内容"""
+        return self.content_length >= min_length or self.aggregator.has_structured_output()
+
+    async def relay(self) -> AsyncIterator[str]:
+        """先把预读缓冲的数据合并为一次写入发送，再边读边转发剩余的上游增量"""
+        completion = None
+        try:
+            if self.buffered:
+                yield "".join(f"data: {event.raw}\n\n" for event in self.buffered)
+            self.buffered = []
+
+            if not self.finished:
+                async for event in self.events:
+                    if event.done:
+                        break
+                    self.aggregator.add(event)
+                    yield f"data: {event.raw}\n\n"
+            yield "data: [DONE]\n\n"
+            completion = self.aggregator.to_completion()
+        except httpx.HTTPError as e:
+            logger.error(f"密钥 [***{self.api_key[-4:]}] 流式转发中断: {e}")
+        finally:
+            await self.finish(completion)
+
+    async def finish(self, completion: Optional[Dict[str, Any]] = None):
+        """
+        结束转发：关闭上游连接、释放密钥并调用on_complete，只执行一次。
+        响应体还没开始发送客户端就断开时relay不会运行，由响应的release_after_body调用。
+        """
+        await self.aclose()
+        if self.on_complete is not None:
+            on_complete, self.on_complete = self.on_complete, None
+            await on_complete(completion)
+
+    async def aclose(self):
+        """关闭上游连接，并通知调用方该密钥的本次使用已结束（只通知一次）"""
+        await self.response.aclose()
+        if self.started is not None:
+            proxy_metrics.observe_upstream_total(self.api_key, True, time.monotonic() - self.started)
+            self.started = None
+        if self.on_close is not None:
+            on_close, self.on_close = self.on_close, None
+            usage = self.aggregator.usage or {}
+            on_close(self.api_key, usage.get("total_tokens"))
+
+
+async def open_upstream_stream(client: httpx.AsyncClient, target: Any,
+                               payload: OutboundPayload, min_length: int, timeout: float,
+                               on_close: Optional[Callable[[str, Optional[int]], None]] = None
+                               ) -> Optional[UpstreamStream]:
+    """
+    向一个目标（UpstreamTarget）发起流式请求，预读直到内容长度达到min_length或收到工具调用、推理内容。
+
+    请求的构造和增量的解析由目标所在上游的后端完成；目标同时用于上报上游状态码和首字节耗时，
+    驱动密钥熔断器和上游路由，网络错误以状态码0上报。
+
+    Returns:
+        满足长度要求的UpstreamStream；失败或内容过短时返回None
+    """
+    api_key = target.key
+    request = target.build_request(client, payload, True, timeout)
+
+    try:
+        logger.info(f"使用密钥 [***{api_key[-4:]}] 发送流式请求...")
+        started = time.monotonic()
+        response = await client.send(request, stream=True)
+    except httpx.RequestError as e:
+        logger.error(f"密钥 [***{api_key[-4:]}] 流式请求失败 (网络或连接错误): {e}")
+        target.record_failure(api_key, 0)
+        proxy_metrics.observe_upstream_response(api_key, True, 0)
+        proxy_metrics.observe_upstream_total(api_key, True, time.monotonic() - started)
+        return None
+
+    proxy_metrics.observe_upstream_response(api_key, True, response.status_code, time.monotonic() - started)
+    try:
+        if response.status_code >= 400:
+            await response.aread()
+            logger.error(f"密钥 [***{api_key[-4:]}] 流式请求失败 (HTTP状态错误): {response.status_code} - {response.text}")
+            await response.aclose()
+            proxy_metrics.observe_upstream_total(api_key, True, time.monotonic() - started)
+            target.record_failure(
+                api_key, response.status_code,
+                parse_retry_after(response.headers.get("retry-after"), response.text),
+                response.text)
+            return None
+
+        target.record_success(api_key, time.monotonic() - started)
+
+        stream = UpstreamStream(api_key, response, target.stream_events(response, payload.model),
+                                on_close, started)
+        async for event in stream.events:
+            if event.done:
+                stream.finished = True
+                break
+
+            stream.buffered.append(event)
+            stream.aggregator.add(event)
+            if stream.has_enough_output(min_length):
+                break
+        else:
+            stream.finished = True
+
+        if not stream.has_enough_output(min_length):
+            logger.warning(f"密钥 [***{api_key[-4:]}] 流式响应过短 (长度: {stream.content_length}), 已丢弃。")
+            proxy_metrics.record_too_short(True)
+            await response.aclose()
+            proxy_metrics.observe_upstream_total(api_key, True, time.monotonic() - started)
+            return None
+
+        logger.info(f"密钥 [***{api_key[-4:]}] 流式响应已满足最小长度，开始转发")
+        return stream
+    except BaseException as e:
+        await response.aclose()
+        proxy_metrics.observe_upstream_total(api_key, True, time.monotonic() - started)
+        if isinstance(e, httpx.HTTPError):
+            logger.error(f"密钥 [***{api_key[-4:]}] 读取流式响应失败: {e}")
+            return None
+        raise
+
+
+async def race_upstream_streams(client: httpx.AsyncClient, targets: Iterable[Any],
+                                payload: OutboundPayload, min_length: int, timeout: float,
+                                hedge_delay: Optional[float] = None,
+                                tracker: Optional[LatencyTracker] = None,
+                                release: Optional[Callable[[str, Optional[int]], None]] = None
+                                ) -> Optional[UpstreamStream]:
+    """
+    向多个目标发起流式请求（一次性扇出或对冲），返回第一个满足长度要求的流，其余全部取消并关闭。
+
+    targets为UpstreamTarget（提供密钥和上游后端，同时用于上报结果），可以是按需分配的迭代器。
+    release在每个密钥的本次使用结束时调用（参数为密钥和实际token用量）：
+    失败的请求立即调用，胜出的流在转发结束关闭时调用。
+    """
+    async def send(target: Any) -> Optional[UpstreamStream]:
+        stream = None
+        try:
+            stream = await open_upstream_stream(client, target, payload, min_length, timeout, release)
+            return stream
+        finally:
+            if stream is None and release is not None:
+                release(target.key, None)
+
+    async def discard(stream: UpstreamStream):
+        await stream.aclose()
+
+    return await run_fanout(
+        targets, send,
+        is_usable=lambda stream: stream is not None,
+        hedge_delay=hedge_delay,
+        discard=discard,
+        tracker=tracker,
+    )